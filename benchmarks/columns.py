@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Compare building columns from CDRs row by row, from dicts coerced by json_parser, against to_columns on records
+decoded without coercion.
+
+    python -m benchmarks.columns [records]
+"""
+import sys
+import json
+from timeit import default_timer
+
+from versature.request_handler import RequestHandler
+from versature.columns import to_columns, numpy
+from benchmarks.json_decoding import cdrs
+
+__author__ = 'DavidWard'
+
+
+def row_by_row(content):
+    rows = json.loads(content.decode('utf-8'), object_hook=RequestHandler().json_parser)
+    columns = {}
+    for row in rows:
+        for k, v in row.items():
+            columns.setdefault(k, []).append(v)
+    return columns
+
+
+def vectorized(content):
+    return to_columns(json.loads(content.decode('utf-8')))
+
+
+def run(build, content, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        build(content)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(count=20000):
+    if numpy is None:
+        raise SystemExit('numpy must be installed')
+
+    content = cdrs(count)
+    results = [('row by row (json_parser)', run(row_by_row, content)),
+               ('to_columns', run(vectorized, content))]
+
+    print('%s CDRs, %.1f KB' % (count, len(content) / 1024.0))
+    for name, elapsed in results:
+        print('%-26s %8.2f ms' % (name, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
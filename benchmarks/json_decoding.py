@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Compare json decoding of a realistic CDR payload with the default json_parser hook, the fast_json_parser hook, a field
+schema and the orjson backend.
+
+    python -m benchmarks.json_decoding [records]
+"""
+import sys
+import json
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+from versature.request_handler import RequestHandler, orjson
+
+__author__ = 'DavidWard'
+
+CDR_SCHEMA = {'start_time': 'datetime', 'answer_time': 'datetime', 'end_time': 'datetime', 'cost': 'float'}
+
+
+class Response(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self, **kwargs):
+        return json.loads(self.content.decode('utf-8'), **kwargs)
+
+
+def cdrs(count):
+    start = datetime(2018, 3, 1, 8, 0, 0)
+    records = []
+    for i in range(count):
+        start_time = start + timedelta(seconds=37 * i)
+        records.append({
+            'call_id': '%032x' % i,
+            'from': {'user': '1%02d' % (i % 50), 'domain': 'example.com', 'name': 'Agent %s' % (i % 50),
+                     'id': '+1613555%04d' % (i % 10000), 'call_id': '%032x_from' % i},
+            'to': {'user': None, 'domain': 'example.com', 'name': 'Caller', 'id': '+1416555%04d' % (i % 9999),
+                   'call_id': '%032x_to' % i},
+            'start_time': start_time.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+            'answer_time': (start_time + timedelta(seconds=4)).strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+            'end_time': (start_time + timedelta(seconds=124)).strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+            'duration': 120,
+            'cost': '0.0300',
+            'release_text': 'Orig: Bye',
+            'direction': 'outbound' if i % 2 else 'inbound',
+        })
+    return json.dumps(records).encode('utf-8')
+
+
+def run(request_handler, content, schema=None, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        request_handler.decode_json(Response(content), schema)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(count=5000):
+    content = cdrs(count)
+    results = [('json_parser', run(RequestHandler(), content)),
+               ('fast_json_parser', run(RequestHandler(fast_json=True), content)),
+               ('schema', run(RequestHandler(), content, CDR_SCHEMA))]
+
+    if orjson is not None:
+        results.append(('orjson + fast_json_parser', run(RequestHandler(json_backend='orjson', fast_json=True), content)))
+        results.append(('orjson + schema', run(RequestHandler(json_backend='orjson'), content, CDR_SCHEMA)))
+
+    print('%s CDRs, %.1f KB' % (count, len(content) / 1024.0))
+    for name, elapsed in results:
+        print('%-26s %8.2f ms' % (name, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the memory held by decoded call records as the dicts coerced by json_parser (the default) and as Cdr records,
+which keep their values as received and parse timestamps and costs on access.
+
+    python -m benchmarks.record_memory [records]
+"""
+import sys
+import json
+import tracemalloc
+from timeit import default_timer
+
+from versature.request_handler import RequestHandler
+from versature.records import Cdr
+from benchmarks.json_decoding import cdrs
+
+__author__ = 'DavidWard'
+
+
+def coerced_dicts(content):
+    return json.loads(content.decode('utf-8'), object_hook=RequestHandler().json_parser)
+
+
+def records(content):
+    return [Cdr.from_dict(value) for value in json.loads(content.decode('utf-8'))]
+
+
+def run(decode, content):
+    """
+    :return: The bytes held by the decoded records and the seconds taken to decode them
+    """
+    start = default_timer()
+    decode(content)
+    elapsed = default_timer() - start
+
+    tracemalloc.start()
+    try:
+        result = decode(content)
+        held = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    del result
+    return held, elapsed
+
+
+def main(count=20000):
+    content = cdrs(count)
+    results = [('dicts (json_parser)', run(coerced_dicts, content)),
+               ('Cdr records', run(records, content))]
+
+    print('%s CDRs, %.1f KB' % (count, len(content) / 1024.0))
+    for name, (held, elapsed) in results:
+        print('%-20s %10.1f KB %8.1f bytes/record %8.2f ms' % (name, held / 1024.0, float(held) / count,
+                                                                 elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
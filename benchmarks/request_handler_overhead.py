@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the per request overhead of creating a new RequestHandler for every call (the previous behaviour) against
+reusing the pooled, process wide handler.
+
+    python -m benchmarks.request_handler_overhead [requests]
+"""
+import sys
+import json
+import threading
+from timeit import default_timer
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from versature.request_handler import RequestHandler, default_request_handler
+
+__author__ = 'DavidWard'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = json.dumps({'id': 1, 'user': '101', 'name': 'Test User'}).encode('utf-8')
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def new_request_handler():
+    handler = RequestHandler()
+    yield handler
+    handler.close()
+
+
+def pooled_request_handler():
+    yield default_request_handler()
+
+
+def run(request_handlers, url, count):
+    start = default_timer()
+    for _ in range(count):
+        for handler in request_handlers():
+            handler.get_content(handler.request('GET', url, timeout=10))
+    return (default_timer() - start) / count
+
+
+def main(count=500):
+    server = start_stub_server()
+    url = 'http://127.0.0.1:%s/users/' % server.server_port
+
+    try:
+        per_request = run(new_request_handler, url, count)
+        pooled = run(pooled_request_handler, url, count)
+    finally:
+        server.shutdown()
+
+    print('new handler per request: %.3f ms/request' % (per_request * 1000))
+    print('pooled handler:          %.3f ms/request' % (pooled * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -21,6 +21,11 @@ setup(
     include_package_data=True,
     platforms='any',
     install_requires=[
-        'requests-futures'
-    ]
+        'requests-futures',
+        'python-dateutil>=2.7.0'
+    ],
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+        'columns': ['numpy>=1.17', 'pyarrow>=1.0']
+    }
 )
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from versature.cdr_store import CdrStore
+from versature.async_resources import AsyncVersature
+from versature.records import Cdr
+from test.resources import StubServerTestCase, query
+
+__author__ = 'DavidWard'
+
+
+def cdr(call_id, start_time, user):
+    return {'call_id': call_id, 'start_time': start_time.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+            'from': {'user': user, 'call_id': '%s_from' % call_id}, 'to': {'user': None, 'call_id': '%s_to' % call_id}}
+
+
+class CdrStoreTest(StubServerTestCase):
+
+    def setUp(self):
+        super(CdrStoreTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.records = [cdr('call_%s' % i, self.now - timedelta(hours=40 - i), '10%s' % (i % 2)) for i in range(10)]
+        self.requested = []
+
+        def route(handler):
+            q = query(handler)
+            start_date, end_date = datetime.fromisoformat(q['start_date']), datetime.fromisoformat(q['end_date'])
+            self.requested.append(start_date)
+            records = [r for r in self.records if start_date <= datetime.fromisoformat(r['start_time'][:19]) < end_date]
+            offset, limit = int(q.get('offset', 0)), int(q['limit'])
+            return 200, {}, records[offset:offset + limit]
+
+        self.server.route('GET', '/cdrs/users/', route)
+        self.store = CdrStore(self.versature, os.path.join(directory, 'cdrs.sqlite'), domain='example.com')
+        self.addCleanup(self.store.close)
+
+    def sync(self):
+        return self.store.sync(start_date=self.now - timedelta(days=2), window=timedelta(days=1), retry_interval=0)
+
+    ###################
+    #### CDR Store ####
+    ###################
+
+    def test_sync_from_watermark(self):
+        self.assertEqual(self.sync(), 10)
+        self.assertEqual(self.store.watermark(), self.now)
+
+        self.records.append(cdr('call_10', self.now - timedelta(minutes=10), '100'))
+        del self.requested[:]
+
+        self.assertEqual(self.sync(), 1)
+        self.assertGreaterEqual(min(self.requested), self.now - timedelta(hours=1))
+        self.assertEqual(len(self.store.cdrs()), 11)
+
+    def test_query(self):
+        self.sync()
+
+        records = self.store.cdrs(start_date=self.now - timedelta(hours=36), user='101')
+        self.assertEqual([r['call_id'] for r in records], ['call_5', 'call_7', 'call_9'])
+        self.assertEqual(records[0]['start_time'], (self.now - timedelta(hours=35)).replace(tzinfo=timezone.utc))
+
+        self.assertEqual(self.store.cdrs(call_id='call_3', record_class=Cdr)[0].from_.user, '101')
+        self.assertEqual(self.store.cdrs(end_date=self.now - timedelta(days=3)), [])
+
+    def test_async_client_is_refused(self):
+        versature = AsyncVersature(access_token='token', api_url=self.server.url)
+        self.assertRaises(TypeError, CdrStore, versature, self.store.path)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from datetime import datetime
+
+from versature.columns import to_columns, to_arrow, numpy, pyarrow
+from versature.records import Cdr
+from benchmarks.json_decoding import cdrs
+
+__author__ = 'DavidWard'
+
+
+class ColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = json.loads(cdrs(3))
+        self.records[1]['start_time'] = '2018-03-01T03:00:37-05:00'
+        self.records[2]['cost'] = None
+        self.records[2]['start_time'] = None
+
+    #################
+    #### Columns ####
+    #################
+
+    def test_lists(self):
+        columns = to_columns([Cdr.from_dict(record) for record in self.records], arrays=False)
+
+        self.assertEqual(columns['start_time'], [datetime(2018, 3, 1, 8, 0, 0), datetime(2018, 3, 1, 8, 0, 37), None])
+        self.assertEqual(columns['cost'], [0.03, 0.03, None])
+        self.assertEqual(columns['from.user'], ['100', '101', '102'])
+        self.assertEqual(columns['duration'], [120] * 3)
+
+    def test_dotted_strings(self):
+        records = [{'ip': '10.0.0.1', 'version': '1.7.0', 'separator': '.', 'mos': '4.2'},
+                   {'ip': '10.0.0.2', 'version': '1.8', 'separator': '.', 'mos': None}]
+        columns = to_columns(records, arrays=False)
+
+        self.assertEqual(columns['ip'], ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(columns['version'], ['1.7.0', '1.8'])
+        self.assertEqual(columns['separator'], ['.', '.'])
+        self.assertEqual(columns['mos'], [4.2, None])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_arrays(self):
+        columns = to_columns(self.records, types={'from.user': 'int'})
+
+        self.assertEqual(columns['start_time'].tolist(), [datetime(2018, 3, 1, 8, 0, 0),
+                                                          datetime(2018, 3, 1, 8, 0, 37), None])
+        self.assertEqual(columns['cost'].dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(columns['cost'][2]))
+        self.assertEqual(columns['duration'].dtype, numpy.int64)
+        self.assertEqual(columns['from.user'].tolist(), [100, 101, 102])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow(self):
+        table = to_arrow(self.records)
+
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(str(table.schema.field('start_time').type), 'timestamp[s, tz=UTC]')
+        self.assertEqual(table.column('cost').null_count, 1)
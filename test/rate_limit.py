@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from versature.rate_limit import RateLimit, RateLimiter
+from versature.storage import SQLiteStorage
+from versature.resources import Versature
+from versature.request_handler import RequestHandler
+from test.stub_server import StubServer
+
+__author__ = 'DavidWard'
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rate_limiter = RateLimiter([RateLimit('cdrs/', rate=10, burst=2),
+                                         RateLimit('call_queues/*/stats/', rate=1)])
+
+    ##############################
+    #### Token Bucket Limiter ####
+    ##############################
+
+    def test_path_families(self):
+        self.assertEqual(self.rate_limiter.match('cdrs/users/101/').path, 'cdrs/')
+        self.assertEqual(self.rate_limiter.match('call_queues/8001/stats/live/').path, 'call_queues/*/stats/')
+        self.assertIsNone(self.rate_limiter.match('call_queues/stats/'))
+        self.assertIsNone(self.rate_limiter.match('calls/'))
+
+    def test_burst_then_rate(self):
+        delays = [self.rate_limiter.reserve('cdrs/users/', 'token') for _ in range(4)]
+        self.assertEqual(delays[:2], [0, 0])
+        self.assertAlmostEqual(delays[2], 0.1, places=2)
+        self.assertAlmostEqual(delays[3], 0.2, places=2)
+        self.assertEqual(self.rate_limiter.stats['cdrs/']['throttled'], 2)
+        self.assertAlmostEqual(self.rate_limiter.throttled_time('cdrs/'), 0.3, places=2)
+
+    def test_buckets_per_access_token(self):
+        self.rate_limiter.reserve('call_queues/1/stats/', 'token')
+        self.assertEqual(self.rate_limiter.reserve('call_queues/1/stats/', 'other token'), 0)
+        self.assertGreater(self.rate_limiter.reserve('call_queues/2/stats/', 'token'), 0.9)
+
+    def test_unlimited_path(self):
+        self.assertEqual([self.rate_limiter.reserve('calls/', 'token') for _ in range(10)], [0] * 10)
+
+    def test_shared_storage(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'rate_limit.sqlite')
+
+        limits = [RateLimit('cdrs/', rate=1)]
+        with SQLiteStorage(path) as first, SQLiteStorage(path) as second:
+            RateLimiter(limits, first).reserve('cdrs/users/', 'token')
+            self.assertGreater(RateLimiter(limits, second).reserve('cdrs/users/', 'token'), 0.9)
+
+    def test_requests_are_throttled(self):
+        server = StubServer().start()
+        self.addCleanup(server.stop)
+        server.route('GET', '/call_queues/8001/stats/', lambda handler: (200, {}, []))
+
+        request_handler = RequestHandler(max_workers=2)
+        self.addCleanup(request_handler.close)
+        rate_limiter = RateLimiter([RateLimit('call_queues/*/stats/', rate=20, burst=1)])
+        v = Versature(access_token='token', api_url=server.url, request_handler=request_handler,
+                      rate_limiter=rate_limiter)
+
+        for _ in range(3):
+            v.call_queue_stats(queue='8001', start_date='2018-01-01', end_date='2018-01-02', use_cache=False)
+
+        self.assertEqual(server.count('GET', '/call_queues/8001/stats/'), 3)
+        self.assertEqual(rate_limiter.stats['call_queues/*/stats/']['throttled'], 2)
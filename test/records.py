@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+import pickle
+import unittest
+from datetime import datetime, timezone
+
+from versature.records import Cdr
+from versature.request_handler import RequestHandler
+from benchmarks.json_decoding import cdrs
+from test.resources import StubServerTestCase
+
+__author__ = 'DavidWard'
+
+
+class CdrTest(unittest.TestCase):
+
+    def setUp(self):
+        self.value = json.loads(cdrs(2))[1]
+        self.value['recording'] = True
+        self.cdr = Cdr.from_dict(self.value)
+
+    ####################
+    #### Cdr Record ####
+    ####################
+
+    def test_fields_are_coerced_on_access(self):
+        self.assertEqual(self.cdr._start_time, '2018-03-01T08:00:37+00:00')
+        self.assertEqual(self.cdr.start_time, datetime(2018, 3, 1, 8, 0, 37, tzinfo=timezone.utc))
+        self.assertEqual(self.cdr.cost, 0.03)
+        self.assertEqual(self.cdr.from_.user, '101')
+        self.assertEqual(self.cdr['end_time'], self.cdr.end_time)
+        self.assertEqual(self.cdr['recording'], True)
+        self.assertRaises(AttributeError, setattr, self.cdr, 'cost', 1.0)
+
+    def test_to_dict(self):
+        self.assertEqual(self.cdr.to_dict(coerce_values=False), self.value)
+        self.assertEqual(self.cdr.to_dict(), RequestHandler().json_parser(dict(self.value)))
+
+    def test_pickle(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.cdr)), self.cdr)
+
+
+class CdrRequestTest(StubServerTestCase):
+
+    def setUp(self):
+        super(CdrRequestTest, self).setUp()
+        content = json.loads(cdrs(3))
+        self.server.route('GET', '/cdrs/users/', lambda handler: (200, {}, content))
+
+    #####################
+    #### Cdr Request ####
+    #####################
+
+    def test_cdrs_as_records(self):
+        records = self.versature.cdrs(start_date='2018-03-01', record_class=Cdr)
+        dicts = self.versature.cdrs(start_date='2018-03-01')
+
+        self.assertEqual([cdr.to_dict() for cdr in records], dicts)
+        self.assertEqual(self.versature.cdrs(start_date='2018-03-01', record_class=Cdr), records)
+        self.assertEqual(self.server.count('GET', '/cdrs/users/'), 2)
+
+    def test_streamed_records(self):
+        records = list(self.versature.cdrs(start_date='2018-03-01', record_class=Cdr, stream=True))
+        self.assertEqual([cdr.call_id for cdr in records], ['%032x' % i for i in range(3)])
@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+import json
+import gzip
+import zlib
+import time
+import asyncio
+import unittest
+import tracemalloc
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from versature.request_handler import ResourceRequest, RequestHandler, RetryPolicy, CacheStats, TransferStats, \
+    JsonArrayParser, orjson
+from versature.exceptions import HTTPError, RateLimitExceeded, NotFound
+from versature.storage import DictionaryStorage
+from test.stub_server import StubServer
+
+try:
+    import aiohttp
+    from versature.async_request_handler import AsyncRequestHandler, AsyncResourceRequest, \
+        default_async_request_handler, close_default_async_request_handler
+except ImportError:
+    aiohttp = None
+
+__author__ = 'DavidWard'
+
+
+class JsonResponse(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self, **kwargs):
+        return json.loads(self.content.decode('utf-8'), **kwargs)
+
+
+def slow_users(handler):
+    time.sleep(0.2)
+    return 200, {}, [{'user': '101'}]
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.server.route('GET', '/users/', slow_users)
+        self.request_handler = RequestHandler(max_workers=4)
+
+    def tearDown(self):
+        self.request_handler.close()
+        self.server.stop()
+
+    def resource_request(self, **kwargs):
+        return ResourceRequest(api_url=self.server.url, api_version=None, request_handler=self.request_handler,
+                               **kwargs)
+
+    ############################
+    #### Coalesce In Flight ####
+    ############################
+
+    def test_concurrent_requests_are_coalesced(self):
+        def users():
+            return self.resource_request().request('GET', path='users/', _limit_concurrent_requests=True)
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda _: users(), range(10)))
+
+        self.assertEqual(self.server.count('GET', '/users/'), 1)
+        self.assertEqual(results, [[{'user': '101'}]] * 10)
+
+    def test_async_requests_are_coalesced(self):
+        requests = [self.resource_request(run_async=True).request('GET', path='users/', _limit_concurrent_requests=True)
+                    for _ in range(5)]
+
+        results = [r.resolve() for r in requests]
+
+        self.assertEqual(self.server.count('GET', '/users/'), 1)
+        self.assertEqual(results, [[{'user': '101'}]] * 5)
+
+    def test_sequential_requests_are_not_coalesced(self):
+        self.resource_request().request('GET', path='users/', _limit_concurrent_requests=True)
+        self.resource_request().request('GET', path='users/', _limit_concurrent_requests=True)
+        self.assertEqual(self.server.count('GET', '/users/'), 2)
+
+    def test_leader_result_is_cached(self):
+        storage = DictionaryStorage()
+        self.resource_request(storage=storage).request('GET', path='users/', _limit_concurrent_requests=True)
+        result = self.resource_request(storage=storage).request('GET', path='users/', _limit_concurrent_requests=True)
+        self.assertEqual(result, [{'user': '101'}])
+        self.assertEqual(self.server.count('GET', '/users/'), 1)
+
+    def test_writes_are_not_coalesced(self):
+        self.server.route('DELETE', '/users/', slow_users)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            for method in ('GET', 'DELETE', 'DELETE'):
+                executor.submit(self.resource_request().request, method, path='users/',
+                                _limit_concurrent_requests=True)
+
+        self.assertEqual(self.server.count('GET', '/users/'), 1)
+        self.assertEqual(self.server.count('DELETE', '/users/'), 2)
+
+    def test_identical_writes_wait_for_the_lease(self):
+        active, overlapped = [], []
+
+        def grant(handler):
+            active.append(handler)
+            overlapped.append(len(active) > 1)
+            time.sleep(0.1)
+            active.remove(handler)
+            return 200, {}, {'access_token': 'token'}
+
+        self.server.route('POST', '/oauth/token/', grant)
+        storage = DictionaryStorage()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for _ in range(2):
+                executor.submit(self.resource_request(storage=storage).request, 'POST', path='oauth/token/',
+                                data={'grant_type': 'client_credentials'}, _limit_concurrent_requests=True)
+
+        self.assertEqual(overlapped, [False, False])
+        self.assertEqual(len(storage.storage_dict), 0)
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_cancelled_leader_completes_flight(self):
+        async def users(request_handler):
+            request = AsyncResourceRequest(api_url=self.server.url, api_version=None, request_handler=request_handler)
+            return await request.request('GET', path='users/', _limit_concurrent_requests=True)
+
+        async def requests():
+            request_handler = AsyncRequestHandler()
+            try:
+                leader = asyncio.ensure_future(users(request_handler))
+                await asyncio.sleep(0.05)
+                follower = asyncio.ensure_future(users(request_handler))
+                await asyncio.sleep(0.05)
+                leader.cancel()
+                await asyncio.gather(leader, follower, return_exceptions=True)
+                return await asyncio.wait_for(users(request_handler), 5)
+            finally:
+                await request_handler.close()
+
+        self.assertEqual(asyncio.run(requests()), [{'user': '101'}])
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class DefaultAsyncRequestHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.server.route('GET', '/users/', lambda handler: (200, {}, [{'user': '101'}]))
+
+    def tearDown(self):
+        self.server.stop()
+
+    ##############################################
+    #### Default Asynchronous Request Handler ####
+    ##############################################
+
+    def test_close_default_handler(self):
+        async def requests():
+            request = AsyncResourceRequest(api_url=self.server.url, api_version=None)
+            await request.request('GET', path='users/')
+            request_handler = default_async_request_handler()
+            session = request_handler.session
+
+            await close_default_async_request_handler()
+            return request_handler, session, default_async_request_handler()
+
+        request_handler, session, next_request_handler = asyncio.run(requests())
+        self.assertTrue(session.closed)
+        self.assertIsNot(next_request_handler, request_handler)
+
+
+def failing(status_codes, headers=None):
+    """
+    A route responding with each status code in turn and then 200
+    """
+    status_codes = list(status_codes)
+
+    def route(handler):
+        if status_codes:
+            return status_codes.pop(0), dict(headers or {}), {'error': 'unavailable'}
+        return 200, {}, [{'user': '101'}]
+    return route
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.request_handler = RequestHandler(max_workers=4, retry_policy=RetryPolicy(backoff_factor=0.01))
+
+    def tearDown(self):
+        self.request_handler.close()
+        self.server.stop()
+
+    def resource_request(self, **kwargs):
+        return ResourceRequest(api_url=self.server.url, api_version=None, request_handler=self.request_handler,
+                               **kwargs)
+
+    ##################
+    #### Retrying ####
+    ##################
+
+    def test_get_is_retried(self):
+        self.server.route('GET', '/users/', failing([503, 502], {'Retry-After': '0'}))
+        result = self.resource_request().request('GET', path='users/')
+        self.assertEqual(result, [{'user': '101'}])
+        self.assertEqual(self.server.count('GET', '/users/'), 3)
+
+    def test_post_is_not_retried(self):
+        self.server.route('POST', '/calls/', failing([503]))
+        with self.assertRaises(HTTPError):
+            self.resource_request().request('POST', path='calls/')
+        self.assertEqual(self.server.count('POST', '/calls/'), 1)
+
+    def test_max_retries(self):
+        self.server.route('GET', '/users/', failing([429] * 5))
+        with self.assertRaises(RateLimitExceeded):
+            self.resource_request(retry_policy=RetryPolicy(max_retries=2, backoff_factor=0.01)).request('GET', path='users/')
+        self.assertEqual(self.server.count('GET', '/users/'), 3)
+
+    def test_retry_after_beyond_budget(self):
+        self.server.route('GET', '/users/', failing([429], {'Retry-After': '120'}))
+        with self.assertRaises(RateLimitExceeded):
+            self.resource_request().request('GET', path='users/')
+        self.assertEqual(self.server.count('GET', '/users/'), 1)
+
+    def test_retry_after_date(self):
+        retry_after = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        self.assertEqual(RetryPolicy.retry_after({'Retry-After': retry_after}), 0)
+        self.assertEqual(RetryPolicy.retry_after({'Retry-After': '3'}), 3)
+        self.assertIsNone(RetryPolicy.retry_after({}))
+
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.versions = iter(range(1, 10))
+        self.server = StubServer().start()
+        self.server.route('GET', '/calls/active/', lambda handler: (200, {}, [{'version': next(self.versions)}]))
+        self.request_handler = RequestHandler(max_workers=4)
+        self.storage = DictionaryStorage()
+        self.cache_stats = CacheStats()
+
+    def tearDown(self):
+        self.request_handler.close()
+        self.server.stop()
+
+    def active_calls(self, **kwargs):
+        request = ResourceRequest(api_url=self.server.url, api_version=None, request_handler=self.request_handler,
+                                  storage=self.storage, cache_timeout=0.1, **kwargs)
+        request.cache_stats = self.cache_stats
+        return request.request('GET', path='calls/active/')
+
+    def wait_for(self, event):
+        for _ in range(100):
+            if self.cache_stats[event]:
+                return
+            time.sleep(0.01)
+        self.fail('%s was not recorded' % event)
+
+    ################################
+    #### Stale While Revalidate ####
+    ################################
+
+    def test_stale_result_is_served_and_refreshed(self):
+        self.assertEqual(self.active_calls(max_stale=10), [{'version': 1}])
+        time.sleep(0.15)
+
+        self.assertEqual(self.active_calls(max_stale=10), [{'version': 1}])
+        self.assertEqual(self.active_calls(max_stale=10), [{'version': 1}])
+        self.wait_for('revalidate')
+
+        self.assertEqual(self.active_calls(max_stale=10), [{'version': 2}])
+        self.assertEqual(self.server.count('GET', '/calls/active/'), 2)
+        self.assertEqual(self.cache_stats['stale'], 2)
+        self.assertEqual(self.cache_stats['hit'], 1)
+
+    def test_expired_result_without_max_stale(self):
+        self.active_calls()
+        time.sleep(0.15)
+
+        self.assertEqual(self.active_calls(), [{'version': 2}])
+        self.assertEqual(self.cache_stats['miss'], 2)
+        self.assertEqual(self.cache_stats['stale'], 0)
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_cancelled_refresh_is_not_an_error(self):
+        errors = []
+
+        async def active_calls():
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+            request_handler = AsyncRequestHandler()
+            try:
+                request = AsyncResourceRequest(api_url=self.server.url, api_version=None,
+                                               request_handler=request_handler, storage=self.storage,
+                                               cache_timeout=0.1, max_stale=10)
+                request.cache_stats = self.cache_stats
+                return await request.request('GET', path='calls/active/')
+            finally:
+                await request_handler.close()
+
+        asyncio.run(active_calls())
+        time.sleep(0.15)
+        self.server.route('GET', '/calls/active/', slow_users)
+
+        self.assertEqual(asyncio.run(active_calls()), [{'version': 1}])
+        self.assertEqual([context['message'] for context in errors if 'exception' in context], [])
+        self.assertEqual(self.cache_stats['revalidate_failed'], 1)
+        # Only the cached result is left, the refresh lease was released
+        self.assertEqual(len(self.storage.storage_dict), 1)
+
+    def test_empty_result_is_cached(self):
+        self.server.route('GET', '/calls/active/', lambda handler: (200, {}, []))
+
+        self.assertEqual(self.active_calls(max_stale=10), [])
+        self.assertEqual(self.active_calls(max_stale=10), [])
+        self.assertEqual(self.cache_stats['hit'], 1)
+        time.sleep(0.15)
+
+        self.assertEqual(self.active_calls(max_stale=10), [])
+        self.wait_for('revalidate')
+        self.assertEqual(self.server.count('GET', '/calls/active/'), 2)
+        self.assertEqual(self.cache_stats['stale'], 1)
+
+
+def users_with_etag(handler):
+    if handler.headers.get('If-None-Match') == '"v1"':
+        return 304, {'ETag': '"v1"'}, b''
+    return 200, {'ETag': '"v1"'}, [{'user': '101'}]
+
+
+class ConditionalRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.server.route('GET', '/users/', users_with_etag)
+        self.request_handler = RequestHandler(max_workers=4)
+        self.storage = DictionaryStorage()
+        self.cache_stats = CacheStats()
+
+    def tearDown(self):
+        self.request_handler.close()
+        self.server.stop()
+
+    def users(self, **kwargs):
+        request = ResourceRequest(api_url=self.server.url, api_version=None, request_handler=self.request_handler,
+                                  storage=self.storage, cache_timeout=0.1, **kwargs)
+        request.cache_stats = self.cache_stats
+        return request.request('GET', path='users/')
+
+    ##############################
+    #### Conditional Requests ####
+    ##############################
+
+    def test_not_modified_refreshes_cache(self):
+        self.assertEqual(self.users(), [{'user': '101'}])
+        time.sleep(0.15)
+
+        self.assertEqual(self.users(), [{'user': '101'}])
+        self.assertEqual(self.users(), [{'user': '101'}])
+
+        self.assertEqual(self.server.count('GET', '/users/'), 2)
+        self.assertEqual(self.server.requests[1][2].get('If-None-Match'), '"v1"')
+        self.assertEqual(self.cache_stats['not_modified'], 1)
+        self.assertEqual(self.cache_stats['hit'], 1)
+
+    def test_validators_are_kept_for_a_few_cache_timeouts(self):
+        self.users()
+        key = list(self.storage.storage_dict)[0]
+        self.assertLess(self.storage.expiry_dict[key] - time.monotonic(), 0.5)
+
+    def test_run_async_not_modified(self):
+        self.users()
+        time.sleep(0.15)
+
+        self.assertEqual(self.users(run_async=True).resolve(), [{'user': '101'}])
+        self.assertEqual(self.cache_stats['not_modified'], 1)
+
+
+CDRS = [{'call_id': str(i), 'from': {'user': '101'}, 'to': {'call_id': '16135551234'}, 'duration': 30}
+        for i in range(500)]
+
+
+def compressed(encoding, compress):
+    def route(handler):
+        return 200, {'Content-Type': 'application/json', 'Content-Encoding': encoding}, \
+            compress(json.dumps(CDRS).encode('utf-8'))
+    return route
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.server.route('GET', '/cdrs/users/', compressed('gzip', gzip.compress))
+        self.server.route('GET', '/call_queues/reports/splits/', compressed('deflate', zlib.compress))
+        self.transfer_stats = TransferStats()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def request(self, request_handler, resource_request_class, path):
+        request_handler.transfer_stats = self.transfer_stats
+        return resource_request_class(api_url=self.server.url, api_version=None,
+                                      request_handler=request_handler).request('GET', path=path)
+
+    def assertTransferCounted(self):
+        self.assertEqual(self.server.requests[0][2].get('Accept-Encoding')[:13], 'gzip, deflate')
+        for endpoint in ('/cdrs/users/', '/call_queues/reports/splits/'):
+            stats = self.transfer_stats.endpoints[endpoint]
+            self.assertEqual(stats['decompressed_bytes'], len(json.dumps(CDRS)))
+            self.assertLess(stats['compressed_bytes'], stats['decompressed_bytes'] / 10)
+        self.assertGreater(self.transfer_stats.savings(), 0.9)
+
+    #####################
+    #### Compression ####
+    #####################
+
+    def test_compressed_responses(self):
+        request_handler = RequestHandler(max_workers=2)
+        self.addCleanup(request_handler.close)
+
+        self.assertEqual(self.request(request_handler, ResourceRequest, 'cdrs/users/'), CDRS)
+        self.assertEqual(self.request(request_handler, ResourceRequest, 'call_queues/reports/splits/'), CDRS)
+        self.assertTransferCounted()
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_compressed_responses(self):
+        async def requests():
+            request_handler = AsyncRequestHandler()
+            try:
+                return [await self.request(request_handler, AsyncResourceRequest, path)
+                        for path in ('cdrs/users/', 'call_queues/reports/splits/')]
+            finally:
+                await request_handler.close()
+
+        self.assertEqual(asyncio.run(requests()), [CDRS, CDRS])
+        self.assertTransferCounted()
+
+
+def cdr_chunks(count):
+    """
+    A json array of call records, one chunk per record
+    """
+    yield b'['
+    for i in range(count):
+        record = {'call_id': str(i), 'start_time': '2018-01-01T10:00:00', 'duration': 30, 'notes': 'x' * 200}
+        yield (b',' if i else b'') + json.dumps(record).encode('utf-8')
+    yield b']'
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.server.route('GET', '/cdrs/users/', lambda handler: (200, {'Content-Type': 'application/json'},
+                                                                  cdr_chunks(2000)))
+
+    def tearDown(self):
+        self.server.stop()
+
+    ###################
+    #### Streaming ####
+    ###################
+
+    def test_parser_handles_any_chunking(self):
+        body = json.dumps([{'name': u'Caf\u00e9 ] , "quoted"', 'values': [1, 2.5, [3]]}, 12345, -0.5, 'text', None,
+                           True, {}], ensure_ascii=False).encode('utf-8')
+
+        for size in (1, 2, 3, 7, len(body)):
+            parser = JsonArrayParser()
+            elements = []
+            for i in range(0, len(body), size):
+                elements.extend(parser.feed(body[i:i + size]))
+            elements.extend(parser.close())
+            self.assertEqual(elements, json.loads(body.decode('utf-8')))
+
+    def test_incomplete_array(self):
+        parser = JsonArrayParser()
+        parser.feed(b'[1, 2')
+        self.assertRaises(ValueError, parser.close)
+
+    def test_stream_memory_is_flat(self):
+        request_handler = RequestHandler(max_workers=2)
+        self.addCleanup(request_handler.close)
+
+        tracemalloc.start()
+        try:
+            records = ResourceRequest(api_url=self.server.url, api_version=None, request_handler=request_handler,
+                                      stream=True).request('GET', path='cdrs/users/')
+            count = 0
+            for record in records:
+                self.assertEqual(record['start_time'], datetime(2018, 1, 1, 10))
+                count += 1
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        # The body is about 540 KB
+        self.assertEqual(count, 2000)
+        self.assertLess(peak, 128 * 1024)
+
+    def test_stream_errors_are_raised_immediately(self):
+        request_handler = RequestHandler(max_workers=2)
+        self.addCleanup(request_handler.close)
+
+        request = ResourceRequest(api_url=self.server.url, api_version=None, request_handler=request_handler,
+                                  stream=True)
+        self.assertRaises(NotFound, request.request, 'GET', path='cdrs/missing/')
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_stream(self):
+        async def records():
+            request_handler = AsyncRequestHandler()
+            try:
+                request = AsyncResourceRequest(api_url=self.server.url, api_version=None,
+                                               request_handler=request_handler, stream=True)
+                return [record['call_id'] async for record in await request.request('GET', path='cdrs/users/')]
+            finally:
+                await request_handler.close()
+
+        self.assertEqual(asyncio.run(records()), [str(i) for i in range(2000)])
+
+
+class JsonDecodingTest(unittest.TestCase):
+
+    content = json.dumps([{'start_time': '2018-03-01T08:00:00+00:00', 'cost': '0.0300', 'name': 'Agent',
+                           'from': {'answer_time': '2018-03-01T08:00:04-05:00', 'id': '+16135551234'}}])
+
+    def decode(self, schema=None, **kwargs):
+        response = JsonResponse(self.content.encode('utf-8'))
+        return RequestHandler(max_workers=1, **kwargs).decode_json(response, schema)
+
+    ######################
+    #### JSON Parsers ####
+    ######################
+
+    def test_fast_json_parser_matches_json_parser(self):
+        self.assertEqual(self.decode(fast_json=True), self.decode())
+
+    def test_fast_json_parser_matches_json_parser_for_short_strings(self):
+        request_handler = RequestHandler(max_workers=1)
+        value = dict((v, v) for v in ('', '.', '1', '1.', '.5', '-.5', '5.0', '1.a', 'a.b'))
+        self.assertEqual(request_handler.fast_json_parser(dict(value)), request_handler.json_parser(dict(value)))
+        request_handler.close()
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_backend_matches_json_backend(self):
+        self.assertEqual(self.decode(json_backend='orjson', fast_json=True), self.decode())
+
+    def test_schema_only_coerces_named_fields(self):
+        result = self.decode(schema={'start_time': 'datetime'})[0]
+        self.assertEqual(result['start_time'], datetime(2018, 3, 1, 8, tzinfo=timezone.utc))
+        self.assertEqual(result['cost'], '0.0300')
+        self.assertEqual(result['from']['answer_time'], '2018-03-01T08:00:04-05:00')
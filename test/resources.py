@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import asyncio
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+from versature.resources import Versature
+from versature.request_handler import RequestHandler, CursorResponse
+from versature.storage import DictionaryStorage, SQLiteStorage
+from versature.exceptions import AuthenticationException, NotFound
+from test.stub_server import StubServer
+
+try:
+    import aiohttp
+    from versature.async_resources import AsyncVersature
+    from versature.async_request_handler import AsyncRequestHandler
+except ImportError:
+    aiohttp = None
+
+__author__ = 'DavidWard'
+
+
+def query(handler):
+    return dict((k, v[0]) for k, v in parse_qs(urlparse(handler.path).query).items())
+
+
+def cdr_pages(pages, page_size):
+    """
+    Serve pages of call records, following the cursor query parameter
+    """
+    def route(handler):
+        page = int(query(handler).get('cursor', 0))
+        records = [{'call_id': '%s_%s' % (page, i)} for i in range(page_size)]
+        headers = {'more': 'true' if page + 1 < pages else 'false', 'cursor': str(page + 1)}
+        return 200, headers, records
+    return route
+
+
+def cdr_range(times, limit_failures=0):
+    """
+    Serve the call records whose start_time falls within [start_date, end_date), limited and offset by the query
+    """
+    failures = [limit_failures]
+
+    def route(handler):
+        if failures[0]:
+            failures[0] -= 1
+            return 500, {}, {}
+
+        q = query(handler)
+        start_date, end_date = datetime.fromisoformat(q['start_date']), datetime.fromisoformat(q['end_date'])
+        offset, limit = int(q.get('offset', 0)), int(q['limit'])
+        records = [{'start_time': t.isoformat()} for t in times if start_date <= t < end_date]
+        return 200, {}, records[offset:offset + limit]
+    return route
+
+
+class StubServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.request_handler = RequestHandler(max_workers=4)
+        self.storage = DictionaryStorage()
+        self.versature = Versature(access_token='token', api_url=self.server.url, request_handler=self.request_handler,
+                                   storage=self.storage)
+
+    def tearDown(self):
+        self.request_handler.close()
+        self.server.stop()
+
+
+class IterCDRsTest(StubServerTestCase):
+
+    ######################
+    #### Iterate CDRs ####
+    ######################
+
+    def test_iter_cdrs_follows_cursor(self):
+        self.server.route('GET', '/cdrs/users/', cdr_pages(pages=3, page_size=5))
+
+        call_ids = [cdr['call_id'] for cdr in self.versature.iter_cdrs(start_date='2018-01-01')]
+
+        self.assertEqual(call_ids, ['%s_%s' % (page, i) for page in range(3) for i in range(5)])
+        self.assertEqual(self.server.count('GET', '/cdrs/users/'), 3)
+
+    def test_iter_cdrs_does_not_cache_pages(self):
+        self.server.route('GET', '/cdrs/users/', cdr_pages(pages=2, page_size=5))
+
+        list(self.versature.iter_cdrs(start_date='2018-01-01'))
+
+        self.assertEqual(len(self.storage.storage_dict), 0)
+
+
+class ExportCDRsTest(StubServerTestCase):
+
+    def setUp(self):
+        super(ExportCDRsTest, self).setUp()
+        self.start_date = datetime(2018, 3, 1)
+        self.end_date = datetime(2018, 3, 3)
+        # A busy hour of 40 calls on the first day and a call every 2 hours otherwise
+        self.times = sorted([self.start_date + timedelta(hours=10, seconds=90 * i) for i in range(40)] +
+                            [self.start_date + timedelta(hours=2 * i, minutes=7) for i in range(24)])
+
+    def export(self, **kwargs):
+        return [cdr['start_time'] for cdr in
+                self.versature.export_cdrs(self.start_date, self.end_date, window=timedelta(hours=12), limit=10,
+                                           retry_interval=0, **kwargs)]
+
+    #####################
+    #### Export CDRs ####
+    #####################
+
+    def test_export_returns_every_record_in_order(self):
+        self.server.route('GET', '/cdrs/users/', cdr_range(self.times))
+        self.assertEqual(self.export(), self.times)
+
+    def test_export_pages_minimum_windows(self):
+        self.server.route('GET', '/cdrs/users/', cdr_range(self.times))
+        self.assertEqual(self.export(min_window=timedelta(hours=12)), self.times)
+
+    def test_export_retries_failed_windows(self):
+        self.server.route('GET', '/cdrs/users/', cdr_range(self.times, limit_failures=2))
+        self.assertEqual(self.export(), self.times)
+
+
+class CachePolicyTest(StubServerTestCase):
+
+    def setUp(self):
+        super(CachePolicyTest, self).setUp()
+        self.numbers = []
+        self.server.route('GET', '/caller_id_numbers/', lambda handler: (200, {}, list(self.numbers)))
+        self.server.route('POST', '/caller_id_numbers/',
+                          lambda handler: (200, {}, self.numbers.append(query(handler)['e164'])))
+        self.server.route('GET', '/call_queues/8000/agents/', lambda handler: (200, {}, [{'agent': '101'}]))
+
+    ######################
+    #### Cache Policy ####
+    ######################
+
+    def test_write_invalidates_tagged_results(self):
+        self.assertEqual(self.versature.caller_id_numbers(), [])
+        self.versature.call_queue_agents(queue='8000')
+
+        self.versature.add_caller_id_number('16135551234', 'Main')
+        self.versature.add_caller_id_number('16135551234', 'Main')
+
+        self.assertEqual(self.versature.caller_id_numbers(), ['16135551234', '16135551234'])
+        self.versature.call_queue_agents(queue='8000')
+        self.assertEqual(self.server.count('GET', '/caller_id_numbers/'), 2)
+        self.assertEqual(self.server.count('POST', '/caller_id_numbers/'), 2)
+        self.assertEqual(self.server.count('GET', '/call_queues/8000/agents/'), 1)
+
+    def test_policy_timeout(self):
+        request = self.versature.authenticated_resource_request()
+        request.apply_cache_policy('GET', 'users/101/')
+        self.assertEqual(request.cache_timeout, 3600)
+
+        request = self.versature.authenticated_resource_request(cache_timeout=5)
+        request.apply_cache_policy('GET', 'users/101/')
+        self.assertEqual(request.cache_timeout, 5)
+
+        request = self.versature.authenticated_resource_request()
+        self.assertFalse(request.apply_cache_policy('POST', 'oauth/token/'))
+        self.assertEqual(request.cache_timeout, 60)
+
+    def test_closed_range_is_cached_long_term(self):
+        request = self.versature.authenticated_resource_request()
+        request.apply_cache_policy('GET', 'call_queues/8000/reports/splits/', {'end_date': '2018-03-01'})
+        self.assertEqual(request.cache_timeout, 30 * 86400)
+
+        request = self.versature.authenticated_resource_request()
+        request.apply_cache_policy('GET', 'call_queues/8000/reports/splits/', {'end_date': datetime.utcnow()})
+        self.assertEqual(request.cache_timeout, 60)
+
+    def test_range_is_normalized(self):
+        self.server.route('GET', '/call_queues/8000/reports/splits/', lambda handler: (200, {}, [query(handler)]))
+
+        now = datetime.utcnow()
+        for microsecond in (1, 2):
+            result = self.versature.call_queue_split_report(queue='8000', start_date=now.replace(minute=5),
+                                                            end_date=now.replace(microsecond=microsecond),
+                                                            period=Versature.HOUR)
+
+        self.assertEqual(self.server.count('GET', '/call_queues/8000/reports/splits/'), 1)
+        self.assertEqual(result[0]['start_date'], str(now.replace(minute=0, second=0, microsecond=0)))
+        self.assertEqual(result[0]['end_date'],
+                         str(now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)))
+
+
+class ResultKeyTest(StubServerTestCase):
+
+    def setUp(self):
+        super(ResultKeyTest, self).setUp()
+        self.server.route('GET', '/cdrs/users/', lambda handler: (200, {}, [{'cost': '0.03', 'duration': '120'}]))
+
+    #####################
+    #### Result Keys ####
+    #####################
+
+    def test_schema_is_part_of_the_key(self):
+        self.assertEqual(self.versature.cdrs(start_date='2018-03-01', schema={}), [{'cost': '0.03', 'duration': '120'}])
+        self.assertEqual(self.versature.cdrs(start_date='2018-03-01'), [{'cost': 0.03, 'duration': '120'}])
+        self.assertEqual(self.versature.cdrs(start_date='2018-03-01', schema={'duration': 'int'}),
+                         [{'cost': '0.03', 'duration': 120}])
+        self.assertEqual(self.versature.cdrs(start_date='2018-03-01', schema={}), [{'cost': '0.03', 'duration': '120'}])
+        self.assertEqual(self.server.count('GET', '/cdrs/users/'), 3)
+
+    def test_cursor_response_is_part_of_the_key(self):
+        self.assertIsInstance(self.versature.cdrs(start_date='2018-03-01', cursor_response=True), CursorResponse)
+        self.assertEqual(self.versature.cdrs(start_date='2018-03-01'), [{'cost': 0.03, 'duration': '120'}])
+        self.assertIsInstance(self.versature.cdrs(start_date='2018-03-01', cursor_response=True), CursorResponse)
+        self.assertEqual(self.server.count('GET', '/cdrs/users/'), 2)
+
+    def test_unnamed_schema_function_is_not_cached(self):
+        for _ in range(2):
+            result = self.versature.cdrs(start_date='2018-03-01', schema={'duration': lambda v: int(v) * 2})
+            self.assertEqual(result, [{'cost': '0.03', 'duration': 240}])
+        self.assertEqual(self.server.count('GET', '/cdrs/users/'), 2)
+
+
+class NegativeCacheTest(StubServerTestCase):
+
+    ########################
+    #### Negative Cache ####
+    ########################
+
+    def test_not_found_is_cached(self):
+        self.versature.negative_cache_timeout = 30
+
+        for _ in range(3):
+            self.assertRaises(NotFound, self.versature.users, user='404')
+
+        self.assertEqual(self.server.count('GET', '/users/404/'), 1)
+
+    def test_not_found_is_not_cached_by_default(self):
+        for _ in range(2):
+            self.assertRaises(NotFound, self.versature.users, user='404')
+
+        self.assertEqual(self.server.count('GET', '/users/404/'), 2)
+
+
+def token_grants(tokens):
+    """
+    Grant the next token from tokens for every oauth request
+    """
+    def route(handler):
+        return 200, {}, {'access_token': next(tokens), 'expires_in': 3600, 'refresh_token': 'refresh',
+                         'scope': 'basic', 'token_type': 'Bearer'}
+    return route
+
+
+def authenticated(token, content):
+    """
+    Return content if the request is authenticated with token, otherwise a 401
+    """
+    def route(handler):
+        if handler.headers.get('Authorization') != 'Bearer %s' % token:
+            return 401, {}, {}
+        time.sleep(0.05)
+        return 200, {}, content
+    return route
+
+
+class ObtainAccessTest(StubServerTestCase):
+
+    def setUp(self):
+        super(ObtainAccessTest, self).setUp()
+        self.server.route('POST', '/oauth/token/', token_grants(iter(['new_token', 'newer_token'])))
+        self.server.route('GET', '/users/current/', authenticated('new_token', {'user': '101'}))
+        self.versature.storage = None
+        self.versature.user.refresh_token = 'refresh'
+
+    #######################
+    #### Token Renewal ####
+    #######################
+
+    def test_expired_token_is_renewed_once(self):
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            results = list(executor.map(lambda _: self.versature.current_user(), range(20)))
+
+        self.assertEqual(results, [{'user': '101'}] * 20)
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+        self.assertEqual(self.versature.user.access_token, 'new_token')
+
+    def test_expiring_token_is_renewed_before_request(self):
+        self.versature.user.expires_in = 30
+
+        self.assertEqual(self.versature.current_user(), {'user': '101'})
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+        self.assertEqual(self.server.count('GET', '/users/current/'), 1)
+
+    def test_failed_retry_is_not_repeated(self):
+        self.server.route('GET', '/users/current/', authenticated('other_token', {'user': '101'}))
+
+        self.assertRaises(AuthenticationException, self.versature.current_user)
+        self.assertEqual(self.server.count('GET', '/users/current/'), 2)
+
+
+class GatherTest(StubServerTestCase):
+
+    def setUp(self):
+        super(GatherTest, self).setUp()
+        self.server.route('POST', '/oauth/token/', token_grants(iter(['new_token'])))
+        self.versature.user.refresh_token = 'refresh'
+        for user in ('101', '102', '103'):
+            self.server.route('GET', '/users/%s/' % user, authenticated('new_token', {'user': user}))
+
+    ################
+    #### Gather ####
+    ################
+
+    def test_gather_returns_results_in_order(self):
+        results = self.versature.gather([partial(self.versature.users, user=user) for user in ('103', '101', '404')])
+
+        self.assertEqual(results[:2], [{'user': '103'}, {'user': '101'}])
+        self.assertIsInstance(results[2], NotFound)
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+
+    def test_gather_limits_concurrency(self):
+        active, most_active = [], []
+
+        def route(handler):
+            active.append(handler)
+            most_active.append(len(active))
+            time.sleep(0.05)
+            active.remove(handler)
+            return 200, {}, {'user': handler.path.split('/')[-2]}
+
+        self.versature.user.access_token = 'new_token'
+        users = [str(200 + i) for i in range(6)]
+        for user in users:
+            self.server.route('GET', '/users/%s/' % user, route)
+
+        results = self.versature.gather([partial(self.versature.users, user=user) for user in users], concurrency=2)
+
+        self.assertEqual(results, [{'user': user} for user in users])
+        self.assertEqual(max(most_active), 2)
+
+    def test_batch(self):
+        with self.versature.batch(concurrency=2) as batch:
+            for user in ('101', '102', '103', '101'):
+                batch.users(user=user)
+
+        self.assertEqual(batch.results, [{'user': '101'}, {'user': '102'}, {'user': '103'}, {'user': '101'}])
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+
+
+class FanOutTest(StubServerTestCase):
+
+    #################
+    #### Fan Out ####
+    #################
+
+    def test_devices_many(self):
+        for user in ('101', '102'):
+            self.server.route('GET', '/devices/users/%s/' % user, lambda handler, user=user: (200, {}, [{'user': user}]))
+        self.versature.devices(user='101')
+
+        results = self.versature.devices_many(['101', '102', '101', '404'])
+
+        self.assertEqual(dict(results), {'101': [{'user': '101'}], '102': [{'user': '102'}]})
+        self.assertEqual(list(results.errors), ['404'])
+        self.assertIsInstance(results.errors['404'], NotFound)
+        self.assertEqual(self.server.count('GET', '/devices/users/101/'), 1)
+        self.assertEqual(self.server.count('GET', '/devices/users/102/'), 1)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncStubServerTestCase(StubServerTestCase):
+
+    def setUp(self):
+        super(AsyncStubServerTestCase, self).setUp()
+        self.versature = AsyncVersature(access_token='token', api_url=self.server.url,
+                                        request_handler=AsyncRequestHandler(), storage=self.storage)
+
+    def run_async(self, awaitable):
+        """
+        Run the awaitable on a new event loop, closing the client's connections before the loop is closed
+        """
+        async def run():
+            try:
+                return await awaitable
+            finally:
+                await self.versature.request_handler.close()
+        return asyncio.run(run())
+
+
+class AsyncObtainAccessTest(AsyncStubServerTestCase):
+
+    def setUp(self):
+        super(AsyncObtainAccessTest, self).setUp()
+        self.server.route('POST', '/oauth/token/', token_grants(iter(['new_token', 'newer_token'])))
+        self.server.route('GET', '/users/current/', authenticated('new_token', {'user': '101'}))
+        self.versature.storage = None
+        self.versature.user.refresh_token = 'refresh'
+
+    ####################################
+    #### Asynchronous Token Renewal ####
+    ####################################
+
+    def test_expired_token_is_renewed_once(self):
+        async def current_users():
+            return await asyncio.gather(*[self.versature.current_user() for _ in range(20)])
+
+        self.assertEqual(self.run_async(current_users()), [{'user': '101'}] * 20)
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+        self.assertEqual(self.versature.user.access_token, 'new_token')
+
+    def test_expiring_token_is_renewed_before_request(self):
+        self.versature.user.expires_in = 30
+
+        self.assertEqual(self.run_async(self.versature.current_user()), {'user': '101'})
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+        self.assertEqual(self.server.count('GET', '/users/current/'), 1)
+
+    def test_failed_retry_is_not_repeated(self):
+        self.server.route('GET', '/users/current/', authenticated('other_token', {'user': '101'}))
+
+        self.assertRaises(AuthenticationException, self.run_async, self.versature.current_user())
+        self.assertEqual(self.server.count('GET', '/users/current/'), 2)
+
+    def test_result_is_served_from_storage(self):
+        self.versature.storage = self.storage
+        self.versature.user.access_token = 'new_token'
+
+        async def current_user_twice():
+            return [await self.versature.current_user(), await self.versature.current_user()]
+
+        self.assertEqual(self.run_async(current_user_twice()), [{'user': '101'}] * 2)
+        self.assertEqual(self.server.count('GET', '/users/current/'), 1)
+
+
+class AsyncGatherTest(AsyncStubServerTestCase):
+
+    def setUp(self):
+        super(AsyncGatherTest, self).setUp()
+        self.server.route('POST', '/oauth/token/', token_grants(iter(['new_token'])))
+        self.versature.user.refresh_token = 'refresh'
+        for user in ('101', '102', '103'):
+            self.server.route('GET', '/users/%s/' % user, authenticated('new_token', {'user': user}))
+
+    #############################
+    #### Asynchronous Gather ####
+    #############################
+
+    def test_gather_returns_results_in_order(self):
+        results = self.run_async(self.versature.gather([partial(self.versature.users, user=user)
+                                                        for user in ('103', '101', '404')]))
+
+        self.assertEqual(results[:2], [{'user': '103'}, {'user': '101'}])
+        self.assertIsInstance(results[2], NotFound)
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+
+    def test_batch(self):
+        async def users():
+            async with self.versature.batch(concurrency=2) as batch:
+                for user in ('101', '102', '103', '101'):
+                    batch.users(user=user)
+            return batch.results
+
+        self.assertEqual(self.run_async(users()), [{'user': '101'}, {'user': '102'}, {'user': '103'}, {'user': '101'}])
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+
+    def test_sync_batch_is_refused(self):
+        def users():
+            with self.versature.batch() as batch:
+                batch.users(user='101')
+
+        self.assertRaises(TypeError, users)
+
+    def test_fan_out(self):
+        results = self.run_async(self.versature.fan_out(self.versature.users, ['101', '102', '101', '404']))
+
+        self.assertEqual(dict(results), {'101': {'user': '101'}, '102': {'user': '102'}})
+        self.assertIsInstance(results.errors['404'], NotFound)
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+
+
+class AsyncIterCDRsTest(AsyncStubServerTestCase):
+
+    ###################################
+    #### Asynchronous Iterate CDRs ####
+    ###################################
+
+    def test_iter_cdrs_follows_cursor(self):
+        self.server.route('GET', '/cdrs/users/', cdr_pages(pages=3, page_size=5))
+
+        async def call_ids():
+            return [cdr['call_id'] async for cdr in self.versature.iter_cdrs(start_date='2018-01-01')]
+
+        self.assertEqual(self.run_async(call_ids()), ['%s_%s' % (page, i) for page in range(3) for i in range(5)])
+        self.assertEqual(self.server.count('GET', '/cdrs/users/'), 3)
+        self.assertEqual(len(self.storage.storage_dict), 0)
+
+
+class AsyncExportCDRsTest(AsyncStubServerTestCase):
+
+    def setUp(self):
+        super(AsyncExportCDRsTest, self).setUp()
+        self.start_date = datetime(2018, 3, 1)
+        self.end_date = datetime(2018, 3, 3)
+        self.times = sorted([self.start_date + timedelta(hours=10, seconds=90 * i) for i in range(40)] +
+                            [self.start_date + timedelta(hours=2 * i, minutes=7) for i in range(24)])
+
+    def export(self, **kwargs):
+        async def start_times():
+            return [cdr['start_time'] async for cdr in
+                    self.versature.export_cdrs(self.start_date, self.end_date, window=timedelta(hours=12), limit=10,
+                                               retry_interval=0, **kwargs)]
+        return self.run_async(start_times())
+
+    ##################################
+    #### Asynchronous Export CDRs ####
+    ##################################
+
+    def test_export_returns_every_record_in_order(self):
+        self.server.route('GET', '/cdrs/users/', cdr_range(self.times))
+        self.assertEqual(self.export(), self.times)
+
+    def test_export_retries_failed_windows(self):
+        self.server.route('GET', '/cdrs/users/', cdr_range(self.times, limit_failures=2))
+        self.assertEqual(self.export(), self.times)
+
+
+def current_user_from_process(args):
+    api_url, path = args
+    with SQLiteStorage(path) as token_storage:
+        versature = Versature(client_id='client', client_secret='secret', api_url=api_url,
+                              request_handler=RequestHandler(max_workers=1), token_storage=token_storage)
+        return versature.current_user()
+
+
+class TokenStoreTest(StubServerTestCase):
+
+    def setUp(self):
+        super(TokenStoreTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tokens.db')
+
+        def slow_grant(handler):
+            time.sleep(0.2)
+            return 200, {}, {'access_token': 'shared_token', 'expires_in': 3600, 'scope': 'basic',
+                             'token_type': 'Bearer'}
+
+        self.server.route('POST', '/oauth/token/', slow_grant)
+        self.server.route('GET', '/users/current/', authenticated('shared_token', {'user': '101'}))
+
+    def tearDown(self):
+        super(TokenStoreTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    #####################
+    #### Token Store ####
+    #####################
+
+    def test_processes_share_one_grant(self):
+        pool = Pool(4)
+        try:
+            results = pool.map(current_user_from_process, [(self.server.url, self.path)] * 8)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(results, [{'user': '101'}] * 8)
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
+
+    def test_token_is_published(self):
+        current_user_from_process((self.server.url, self.path))
+
+        with SQLiteStorage(self.path) as token_storage:
+            versature = Versature(client_id='client', client_secret='secret', api_url=self.server.url,
+                                  token_storage=token_storage)
+            self.assertEqual(versature.obtain_token(), 'shared_token')
+        self.assertEqual(self.server.count('POST', '/oauth/token/'), 1)
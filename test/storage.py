@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from multiprocessing import Pool
+
+from versature.storage import Storage, DictionaryStorage, SQLiteStorage
+
+__author__ = 'DavidWard'
+
+
+def add_from_process(args):
+    path, key = args
+    with SQLiteStorage(path) as storage:
+        return storage.add(key, os.getpid(), 30)
+
+
+class StorageKeyTest(unittest.TestCase):
+
+    ######################
+    #### Storage Keys ####
+    ######################
+
+    def create_storage_key(self, **kwargs):
+        arguments = {'access_token': 'token', 'api_version': '1.7.0', 'path': 'cdrs/users/',
+                     'params': {'start_date': datetime(2018, 1, 1), 'end_date': None, 'limit': 100}, 'data': None}
+        arguments.update(kwargs)
+        return Storage.create_storage_key(**arguments)
+
+    def test_key_is_stable_across_processes(self):
+        code = 'from test.storage import StorageKeyTest; print(StorageKeyTest().create_storage_key())'
+        keys = set()
+        for seed in ('1', '2'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            keys.add(subprocess.check_output([sys.executable, '-c', code], env=env).decode('utf-8').strip())
+
+        self.assertEqual(keys, set([self.create_storage_key()]))
+
+    def test_key_is_canonical(self):
+        self.assertEqual(self.create_storage_key(),
+                         self.create_storage_key(params={'limit': 100, 'start_date': datetime(2018, 1, 1)}))
+        self.assertNotEqual(self.create_storage_key(), self.create_storage_key(params={'limit': 200}))
+
+    def test_key_does_not_contain_token(self):
+        self.assertNotIn('token', self.create_storage_key(access_token='token'))
+        self.assertNotEqual(self.create_storage_key(access_token='a'), self.create_storage_key(access_token='b'))
+
+    def test_scope_replaces_token(self):
+        self.assertEqual(self.create_storage_key(access_token='a', scope='domain'),
+                         self.create_storage_key(access_token='b', scope='domain'))
+
+
+class AtomicStorageTestMixin(object):
+
+    def storage(self):
+        raise NotImplementedError
+
+    #################
+    #### Add/CAS ####
+    #################
+
+    def test_add(self):
+        storage = self.storage()
+        self.assertTrue(storage.add('key', 'first', 30))
+        self.assertFalse(storage.add('key', 'second', 30))
+        self.assertEqual(storage.get('key'), 'first')
+
+    def test_add_after_expiry(self):
+        storage = self.storage()
+        storage.set('key', 'expired', -1)
+        self.assertTrue(storage.add('key', 'value', 30))
+        self.assertEqual(storage.get('key'), 'value')
+
+    def test_cas(self):
+        storage = self.storage()
+        storage.set('key', 'first', 30)
+        self.assertFalse(storage.cas('key', 'other', 'second', 30))
+        self.assertTrue(storage.cas('key', 'first', 'second', 30))
+        self.assertEqual(storage.get('key'), 'second')
+        self.assertTrue(storage.cas('key', 'second', None))
+        self.assertIsNone(storage.get('key'))
+
+    ################
+    #### Leases ####
+    ################
+
+    def test_lease(self):
+        storage = self.storage()
+        token = storage.acquire_lease('lease', 30)
+        self.assertIsNotNone(token)
+        self.assertIsNone(storage.acquire_lease('lease', 30))
+        self.assertTrue(storage.renew_lease('lease', token, 30))
+        self.assertFalse(storage.release_lease('lease', 'not the token'))
+        self.assertTrue(storage.release_lease('lease', token))
+        self.assertIsNotNone(storage.acquire_lease('lease', 30))
+
+
+class DictionaryStorageTest(AtomicStorageTestMixin, unittest.TestCase):
+
+    def storage(self):
+        return DictionaryStorage()
+
+
+class BoundedDictionaryStorageTest(unittest.TestCase):
+
+    ##################
+    #### Eviction ####
+    ##################
+
+    def test_max_entries_evicts_least_recently_used(self):
+        storage = DictionaryStorage(max_entries=2)
+        storage.set('a', 1, 30)
+        storage.set('b', 2, 30)
+        storage.get('a')
+        storage.set('c', 3, 30)
+
+        self.assertEqual(len(storage.storage_dict), 2)
+        self.assertIsNone(storage.get('b'))
+        self.assertEqual(storage.get('a'), 1)
+        self.assertEqual(storage.get('c'), 3)
+
+    def test_max_bytes(self):
+        storage = DictionaryStorage(max_bytes=10, sizeof=len)
+        storage.set('a', 'xxxx', 30)
+        storage.set('b', 'xxxx', 30)
+        storage.set('c', 'xxxx', 30)
+
+        self.assertEqual(storage.bytes, 8)
+        self.assertIsNone(storage.get('a'))
+
+        storage.set('b', 'x', 30)
+        self.assertEqual(storage.bytes, 5)
+
+    def test_expired_entries_are_purged(self):
+        storage = DictionaryStorage()
+        for i in range(100):
+            storage.set('expired_%s' % i, i, 0.01)
+        storage.set('kept', 'value')
+
+        time.sleep(0.02)
+        storage.purge_expired()
+
+        self.assertEqual(len(storage.storage_dict), 1)
+        self.assertEqual(storage.expiry_heap, [])
+
+
+class SQLiteStorageTest(AtomicStorageTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'storage.db')
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        shutil.rmtree(self.directory)
+
+    def storage(self, **kwargs):
+        storage = SQLiteStorage(self.path, **kwargs)
+        self.storages.append(storage)
+        return storage
+
+    def test_add_across_processes(self):
+        # Close the parent's connection so it is not inherited by the pool
+        self.storage().close()
+        pool = Pool(4)
+        try:
+            results = pool.map(add_from_process, [(self.path, 'lease')] * 16)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(results.count(True), 1)
+
+    def test_connection_is_reopened_after_fork(self):
+        storage = self.storage()
+        storage.set('key', 'parent')
+        connection = storage.connection
+
+        storage.pid = -1
+        self.assertIsNot(storage.connection, connection)
+        self.assertEqual(storage.get('key'), 'parent')
+        connection.close()
+
+    def test_expired_rows_are_purged(self):
+        storage = self.storage(purge_interval=0)
+        storage.set('expired', 'value', 0.01)
+        storage.cas('bucket', None, 'value', 0.01)
+        time.sleep(0.02)
+
+        storage.set('key', 'value')
+        self.assertEqual(storage.connection.execute('SELECT key FROM storage').fetchall(), [('key',)])
+
+    def test_close(self):
+        with SQLiteStorage(self.path) as storage:
+            storage.set('key', 'value')
+            connection = storage.connection
+        self.assertRaises(Exception, connection.execute, 'SELECT 1')
+        self.assertEqual(storage.get('key'), 'value')
+        storage.close()
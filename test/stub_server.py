@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import json
+import types
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__author__ = 'DavidWard'
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the routes registered on the StubServer. A route is a function taking the request handler and returning a
+    tuple of status code, headers and body. A generator body is sent in chunks.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def handle_request(self):
+        self.server.stub.requests.append((self.command, self.path, dict(self.headers)))
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+        route = self.server.stub.routes.get((self.command, self.path.split('?')[0]))
+        status_code, headers, body = route(self) if route else (404, {}, b'')
+
+        if isinstance(body, types.GeneratorType):
+            return self.send_chunked(status_code, headers, body)
+
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunked(self, status_code, headers, chunks):
+        """
+        Send a body generated in chunks with chunked transfer encoding
+        """
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        for chunk in chunks:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(object):
+    """
+    A local HTTP server standing in for the Versature API.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_port
+
+    def route(self, method, path, func):
+        self.routes[(method, path)] = func
+
+    def count(self, method, path):
+        return len([r for r in self.requests if r[0] == method and r[1].split('?')[0] == path])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
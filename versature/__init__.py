@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
 __author__ = 'DavidWard'
 
-from resources import *
+from .resources import *
+from .async_resources import AsyncVersature
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+import json
+import zlib
+import asyncio
+import logging
+from time import monotonic
+from functools import partial
+from weakref import WeakKeyDictionary
+from urllib.parse import urlparse
+
+from .request_handler import (RequestHandler, ResourceRequest, AuthenticatedResourceRequest, RetryPolicy, JsonArrayParser,
+                              single_flight, orjson, brotli, CACHEABLE_METHODS, CACHE_MISS, ACCEPT_ENCODING)
+from .exceptions import ContentTypeNotSupported
+
+try:
+    import aiohttp
+except ImportError:
+    pass
+
+__author__ = 'DavidWard'
+
+_logger = logging.getLogger(__name__)
+# Add NullHandler to prevent logging warnings on startup
+null_handler = logging.NullHandler()
+_logger.addHandler(null_handler)
+
+_default_async_request_handlers = WeakKeyDictionary()
+
+
+def default_async_request_handler():
+    """
+    Get the AsyncRequestHandler shared by every request made on the current event loop. Like the process wide
+    RequestHandler it keeps its connections alive between calls. Its aiohttp session belongs to the loop, so await
+    close_default_async_request_handler() before the loop is closed.
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    request_handler = _default_async_request_handlers.get(loop)
+
+    if request_handler is None:
+        request_handler = AsyncRequestHandler()
+        _default_async_request_handlers[loop] = request_handler
+
+    return request_handler
+
+
+async def close_default_async_request_handler():
+    """
+    Close the connections of the AsyncRequestHandler shared on the running event loop. A later request on the loop
+    creates a new one.
+    :return:
+    """
+    request_handler = _default_async_request_handlers.pop(asyncio.get_event_loop(), None)
+
+    if request_handler is not None:
+        await request_handler.close()
+
+
+class ContentDecoder(object):
+    """
+    Incrementally decode a gzip, deflate or brotli encoded response body. Bodies in any other coding are passed through.
+    """
+
+    def __init__(self, content_encoding=None):
+        self.encoding = encoding = (content_encoding or 'identity').strip().lower()
+        self.decoder = None
+        self.first_chunk = True
+
+        if encoding in ('gzip', 'x-gzip'):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = zlib.decompressobj()
+        elif encoding == 'br' and brotli is not None:
+            self.decoder = brotli.Decompressor()
+
+    def decompress(self, chunk):
+        if self.decoder is None:
+            return chunk
+
+        if self.encoding == 'br':
+            return self.decoder.process(chunk) if hasattr(self.decoder, 'process') else self.decoder.decompress(chunk)
+
+        if self.encoding == 'deflate' and self.first_chunk:
+            self.first_chunk = False
+            try:
+                return self.decoder.decompress(chunk)
+            except zlib.error:
+                # Some servers send deflate without the zlib header
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return self.decoder.decompress(chunk)
+
+    def flush(self):
+        if self.decoder is not None and hasattr(self.decoder, 'flush'):
+            return self.decoder.flush()
+        return b''
+
+
+class AsyncResponse(object):
+    """
+    A fully read response. Exposes the parts of the requests Response interface used by RequestHandler so the content
+    and validation logic can be shared between the sync and async handlers.
+    """
+
+    def __init__(self, status_code, reason, headers, content, encoding='utf-8', url=None, raw_size=None, stream=None):
+        """
+
+        :param status_code:
+        :param reason:
+        :param headers:
+        :param content:
+        :param encoding:
+        :param url:
+        :param raw_size: The size of the body as received
+        :param stream: The aiohttp response whose body has not been read, for requests made with stream=True
+        """
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+        self.url = url
+        self.raw_size = len(content or b'') if raw_size is None else raw_size
+        self.stream = stream
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+
+class AsyncRequestHandler(RequestHandler):
+    """
+    Perform requests on a single asyncio event loop using aiohttp. request() and resolve_future() are coroutines.
+    """
+
+    def __init__(self, limit=100, limit_per_host=0, keep_alive=True, json_backend='json', fast_json=False,
+                 retry_policy=None):
+        """
+
+        :param limit: The maximum number of simultaneous connections
+        :param limit_per_host: The maximum number of simultaneous connections to a single host. 0 is unlimited
+        :param keep_alive: If False connections are closed after each request
+        :param json_backend: 'json' or 'orjson'. orjson must be installed
+        :param fast_json: If True use fast_json_parser to coerce values
+        :param retry_policy: The RetryPolicy for requests. Use RetryPolicy(max_retries=0) to disable retries
+        """
+        if json_backend == 'orjson' and orjson is None:
+            raise ImportError('orjson must be installed to use the orjson json_backend')
+
+        self.json_backend = json_backend
+        self.fast_json = fast_json
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keep_alive = keep_alive
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             force_close=not self.keep_alive)
+            # Bodies are decoded by read() so the bytes received can be counted
+            self._session = aiohttp.ClientSession(connector=connector, auto_decompress=False,
+                                                  headers={'Accept-Encoding': ACCEPT_ENCODING})
+        return self._session
+
+    async def close(self):
+        """
+        Release any open connections
+        :return:
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def clean_params(params):
+        """
+        Serialize the parameters the same way requests does. None values are dropped and everything else is sent as a
+        string.
+        :param params:
+        :return:
+        """
+        if not params:
+            return None
+
+        return dict((k, str(v)) for k, v in params.items() if v is not None)
+
+    async def request(self, method, url, params=None, data=None, files=None, headers=None, timeout=None,
+                      retry_policy=None, stream=False, **kwargs):
+        """
+        Perform the request and read the full response body, retrying as permitted by the retry policy
+
+        :param method:
+        :param url:
+        :param params:
+        :param data:
+        :param files: Not supported
+        :param headers:
+        :param timeout:
+        :param retry_policy: Overrides the handler's RetryPolicy for this request
+        :param stream: If True the body is left to be read by stream_content
+        :param kwargs:
+        :return: AsyncResponse
+        """
+        if files:
+            raise NotImplementedError('File uploads are not supported by the AsyncRequestHandler')
+
+        retry_policy = retry_policy or self.retry_policy
+        client_timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+        if isinstance(data, dict):
+            data = self.clean_params(data)
+
+        start = monotonic()
+        attempt = 0
+
+        while True:
+            response = await self.session.request(method, url, params=self.clean_params(params), data=data,
+                                                  headers=headers, timeout=client_timeout, **kwargs)
+            delay = retry_policy.delay(method, response.status, response.headers, attempt, monotonic() - start)
+
+            if delay is None and stream:
+                return AsyncResponse(response.status, response.reason, response.headers, None, response.charset,
+                                     str(response.url), 0, stream=response)
+
+            async with response:
+                response = await self.read(response)
+
+            if delay is None:
+                return response
+
+            _logger.info('Retrying %s %s in %.2f seconds. Status Code: %s', method, url, delay, response.status_code)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    async def read(response):
+        """
+        Read and decode the body of an aiohttp response as it arrives
+        :param response:
+        :return: AsyncResponse
+        """
+        decoder = ContentDecoder(response.headers.get('Content-Encoding'))
+        raw_size = 0
+        chunks = []
+
+        async for chunk in response.content.iter_chunked(65536):
+            raw_size += len(chunk)
+            chunks.append(decoder.decompress(chunk))
+        chunks.append(decoder.flush())
+
+        return AsyncResponse(response.status, response.reason, response.headers, b''.join(chunks), response.charset,
+                             str(response.url), raw_size)
+
+    def transfer_sizes(self, response):
+        return response.raw_size, len(response.content)
+
+    def stream_content(self, response, schema=None):
+        """
+        Validate a response requested with stream=True and parse its json array as it is received
+        :param response:
+        :param schema: Optional field schema used to coerce json values, see schema_parser
+        :return: An async generator of the elements of the array
+        """
+        try:
+            self.validate_response(response)
+            content_type = response.headers.get('content-type', '')
+            if self.get_status_code(response) != 204 and 'application/json' not in content_type:
+                raise ContentTypeNotSupported('Content Type: %s is not supported' % content_type)
+        except Exception:
+            response.stream.release()
+            raise
+
+        return self.iter_json(response, self.object_hook(schema))
+
+    async def iter_json(self, response, object_hook):
+        if self.get_status_code(response) == 204:
+            response.stream.release()
+            return
+
+        decoder = ContentDecoder(response.headers.get('Content-Encoding'))
+        parser = JsonArrayParser(object_hook)
+        compressed = decompressed = 0
+
+        try:
+            async for chunk in response.stream.content.iter_chunked(65536):
+                compressed += len(chunk)
+                chunk = decoder.decompress(chunk)
+                decompressed += len(chunk)
+                for element in parser.feed(chunk):
+                    yield element
+
+            tail = decoder.flush()
+            decompressed += len(tail)
+            for element in parser.feed(tail) + parser.close():
+                yield element
+        finally:
+            response.stream.release()
+            self.transfer_stats.record(urlparse(response.url).path, compressed, decompressed)
+
+    def request_async(self, method, url, params=None, data=None, files=None, headers=None, timeout=None,
+                      retry_policy=None, **kwargs):
+        """
+        Schedule the request on the running event loop
+        :return: asyncio.Task
+        """
+        return asyncio.ensure_future(self.request(method, url, params, data, files, headers, timeout, retry_policy,
+                                                  **kwargs))
+
+    async def resolve_future(self, future):
+        return await future
+
+
+class AsyncResourceRequest(ResourceRequest):
+    """
+    A ResourceRequest whose request() and resolve() are coroutines.
+    """
+
+    @staticmethod
+    def default_request_handler():
+        return default_async_request_handler()
+
+    async def resolve(self, get_content=True):
+        if self.flight is not None and (get_content or self.future is None):
+            # Coalesced requests resolve to the content parsed by the leader
+            return await asyncio.wrap_future(self.flight)
+
+        response = await self.request_handler.resolve_future(self.future)
+        if get_content:
+            return self.parse_result(response)
+        return response
+
+    async def iter_records(self, content):
+        async for value in content:
+            yield self.record_class.from_dict(value)
+
+    async def request(self, method, path=None, headers=None, params=None, data=None, files=None,
+                      _limit_concurrent_requests=False, _limit_concurrent_wait_time_interval=0.25,
+                      _limit_concurrent_max_wait_time=20, _use_cached_results=True):
+        """
+        Make a request. See ResourceRequest.request
+        :return:
+        """
+        if headers is None:
+            headers = {}
+
+        self.prepare_request(headers, params)
+
+        self.storage_key = None
+        self.flight = None
+
+        url = '%s/%s' % (self.api_url, path) if path else self.api_url
+        params = self.normalize_params(path, params)
+
+        if self.storage:
+            cacheable = self.apply_cache_policy(method, path, params) and _use_cached_results and self.use_cache and \
+                not self.stream and self.result_keyable
+            self.storage_key = self.create_cache_key(path, params, data) if cacheable else None
+
+            # See if a cached result exists
+            cached_result = self.read_cache(partial(self.revalidate, method, url, params, data, files, headers))
+            if cached_result is not CACHE_MISS:
+                return cached_result
+            elif self.storage_key:
+                self.cache_stats.record('miss', self.storage_key)
+                self.add_validators(headers)
+
+        flight_key = None
+
+        # Coalesce identical concurrent requests. Only the leader performs the request.
+        if _limit_concurrent_requests and not self.stream and self.result_keyable and \
+                method.upper() in CACHEABLE_METHODS:
+            flight_key = self.create_flight_key(method, path, params, data)
+            flight, leader = single_flight.join(flight_key)
+
+            if not leader:
+                if self.run_async:
+                    self.flight = flight
+                    return self
+
+                try:
+                    # Shield the flight so a timeout does not cancel it for the leader and other waiters
+                    return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight)),
+                                                  _limit_concurrent_max_wait_time)
+                except asyncio.TimeoutError:
+                    # The leader is taking too long, perform the request independently
+                    flight_key = None
+            else:
+                self.flight = flight
+
+                cached_result = CACHE_MISS
+                if self.storage:
+                    try:
+                        cached_result = await self.acquire_lease('limit_concurrent_requests_%s' % flight_key,
+                                                                 _limit_concurrent_wait_time_interval,
+                                                                 _limit_concurrent_max_wait_time)
+                    except BaseException as e:
+                        self.release_lease()
+                        single_flight.complete(flight_key, flight, exception=e)
+                        raise
+
+                if cached_result is not CACHE_MISS:
+                    single_flight.complete(flight_key, flight, result=cached_result)
+                    return cached_result
+
+        # Writes are always sent, see ResourceRequest.request
+        elif _limit_concurrent_requests and self.storage:
+            await self.acquire_lease('limit_concurrent_requests_%s' % self.create_flight_key(method, path, params, data),
+                                     _limit_concurrent_wait_time_interval, _limit_concurrent_max_wait_time)
+
+        try:
+
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async(path, self.access_token)
+
+            if self.run_async:
+                # Return with a Task to resolve
+                self.future = self.request_handler.request_async(method, url, params, data, files, headers, self.timeout,
+                                                                 **self.request_options())
+                self.future.add_done_callback(self.invalidate_cache)
+                if flight_key:
+                    self.future.add_done_callback(partial(self.complete_flight, flight_key, self.flight))
+                elif self.lease_token:
+                    self.future.add_done_callback(lambda future: self.release_lease())
+                return self
+            else:
+                response = await self.request_handler.request(method, url, params, data, files, headers, self.timeout,
+                                                              **self.request_options())
+                self.invalidate_cache()
+                result = self.parse_result(response)
+
+        except BaseException as e:
+            # Failures, and cancellation, are passed on so no follower waits on the flight forever
+            self.release_lease()
+            if flight_key:
+                single_flight.complete(flight_key, self.flight, exception=e)
+            raise
+
+        self.release_lease()
+        if flight_key:
+            single_flight.complete(flight_key, self.flight, result=result)
+        return result
+
+    async def acquire_lease(self, lease_key, wait_time_interval, max_wait_time):
+        """
+        Acquire the storage lease for this request. See ResourceRequest.acquire_lease
+        :return: The cached result stored by the lease holder, if found while waiting, otherwise CACHE_MISS
+        """
+        wait_time = 0
+
+        while True:
+            self.lease_token = self.storage.acquire_lease(lease_key, max_wait_time)
+
+            if self.lease_token:
+                self.lease_key = lease_key
+                return CACHE_MISS
+
+            if wait_time >= max_wait_time:
+                return CACHE_MISS
+
+            await asyncio.sleep(wait_time_interval)
+            wait_time += wait_time_interval
+
+            cached_result = self.read_cache()
+            if cached_result is not CACHE_MISS:
+                return cached_result
+
+
+class AsyncAuthenticatedResourceRequest(AuthenticatedResourceRequest, AsyncResourceRequest):
+    pass
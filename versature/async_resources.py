@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+from functools import partial
+
+from .resources import Versature, UserResults
+from .async_request_handler import AsyncResourceRequest, AsyncAuthenticatedResourceRequest
+from .exceptions import AuthenticationException, BadRequest, ScopeException, NotFound
+
+__author__ = 'DavidWard'
+
+
+class AsyncVersature(Versature):
+    """
+    A Versature client for asyncio. Every endpoint returns an awaitable and all requests share one event loop.
+
+        v = AsyncVersature(client_id='zzzzzzz', client_secret='xxxxxx')
+        active_calls = await v.active_calls()
+    """
+
+    is_async = True
+    resource_request_class = AsyncResourceRequest
+    authenticated_resource_request_class = AsyncAuthenticatedResourceRequest
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncVersature, self).__init__(*args, **kwargs)
+        self._async_token_lock = None
+
+    @property
+    def async_token_lock(self):
+        # Created on first use so it belongs to the running event loop
+        if self._async_token_lock is None:
+            self._async_token_lock = asyncio.Lock()
+        return self._async_token_lock
+
+    async def gather(self, calls, concurrency=8, return_exceptions=True):
+        """
+        Perform many endpoint calls at once on the event loop. See Versature.gather
+
+            users = await v.gather([partial(v.users, user=extension) for extension in extensions])
+
+        :param calls: Functions taking no arguments, each returning an awaitable for one endpoint
+        :param concurrency: The maximum number of calls performed at once
+        :param return_exceptions:
+        :return: The results in the order of calls
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(func):
+            async with semaphore:
+                return await func()
+
+        return await asyncio.gather(*[call(func) for func in calls], return_exceptions=return_exceptions)
+
+    async def fan_out(self, method, users, concurrency=8, **kwargs):
+        """
+        Call an endpoint once for each user. See Versature.fan_out
+        :return: UserResults
+        """
+        users = list(OrderedDict.fromkeys(users))
+        results = await self.gather([partial(method, user=user, **kwargs) for user in users], concurrency=concurrency)
+        return UserResults(users, results)
+
+    async def obtain_access_async(self, func, *args, **kwargs):
+        """
+        The asyncio equivalent of obtain_access.
+        :param func:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        access_token = await self.obtain_token()
+
+        try:
+            return await func(self, *args, **kwargs)
+        except AuthenticationException:
+
+            if not await self.renew_token(stale_access_token=access_token):
+                raise
+
+            return await func(self, *args, **kwargs)
+
+    async def obtain_token(self):
+        """
+        Get the access token to use for a request. See Versature.obtain_token
+        :return:
+        """
+        access_token = self.user.access_token
+
+        if access_token is None:
+            async with self.async_token_lock:
+                if self.token_store is not None:
+                    await self.token_store.renew_async(self.user, self.grant_token, refresh_margin=self.refresh_margin)
+                else:
+                    await self.authenticate()
+
+        elif self.token_expiring() and self.can_renew_token():
+            try:
+                await self.renew_token(stale_access_token=access_token)
+            except AuthenticationException:
+                # The current token may still be valid, let the request decide
+                pass
+
+        return self.user.access_token
+
+    async def renew_token(self, stale_access_token=None):
+        """
+        Replace the access token. See Versature.renew_token
+        :param stale_access_token: The token being replaced
+        :return: True if a new token is available
+        """
+        async with self.async_token_lock:
+            if stale_access_token is not None and self.user.access_token != stale_access_token:
+                return True
+
+            if self.token_store is not None:
+                return await self.token_store.renew_async(self.user, self.grant_token, stale_access_token,
+                                                          self.refresh_margin)
+
+            return await self.grant_token()
+
+    async def grant_token(self):
+        """
+        Obtain a new access token. See Versature.grant_token. Must be called while holding async_token_lock.
+        :return: True if a new token was obtained
+        """
+        if self.user.refresh_token:
+            try:
+                result = await self.refresh_token_grant(self.user.refresh_token)
+                if not result.get('refresh_token'):
+                    result = dict(result, refresh_token=self.user.refresh_token)
+                self.user.update_from_authentication_result(result)
+                return True
+            except AuthenticationException:
+                # If we know the username and password then get a new set of tokens
+                if not (self.user.username and self.user.password):
+                    raise
+
+        if self.user.username and self.user.password:
+            result = await self.password_grant(self.user.username, self.user.password)
+        elif self.client_id and self.client_secret:
+            result = await self.client_credentials_grant()
+        else:
+            return False
+
+        self.user.update_from_authentication_result(result)
+        return True
+
+    async def authenticate(self):
+        """
+        Authenticate the current user
+        :return:
+        """
+        # If already  have token then return
+        if self.user.access_token:
+            return
+
+        if self.user.username and self.user.password:
+            result = await self.password_grant(self.user.username, self.user.password)
+            self.user.update_from_authentication_result(result)
+        elif self.client_id and self.client_secret:
+            result = await self.client_credentials_grant()
+            self.user.update_from_authentication_result(result)
+
+    async def iter_cdrs(self, start_date=None, end_date=None, user=None, page_size=100, limit=None, **kwargs):
+        """
+        An async generator of call records. See Versature.iter_cdrs
+
+            async for cdr in v.iter_cdrs(start_date=start_date):
+                ...
+        """
+        def fetch(cursor):
+            return asyncio.ensure_future(self.cdrs(start_date=start_date, end_date=end_date, user=user, offset=None,
+                                                   limit=limit, page_size=page_size, cursor=cursor, use_cache=False,
+                                                   cursor_response=True, **kwargs))
+
+        request = fetch(None)
+
+        while request is not None:
+            page = await request
+
+            request = None
+            if page.more and page.cursor:
+                request = fetch(page.cursor)
+
+            for record in page.data or []:
+                yield record
+
+    async def export_cdrs(self, start_date, end_date=None, user=None, window=timedelta(hours=6),
+                          min_window=timedelta(minutes=5), limit=200, max_workers=4, retries=3, retry_interval=1,
+                          **kwargs):
+        """
+        An async generator exporting the call records for a large time period. See Versature.export_cdrs
+
+            async for cdr in v.export_cdrs(start_date, end_date):
+                ...
+        """
+        end_date = end_date or datetime.utcnow()
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def fetch(window_start, window_end, offset):
+            for attempt in range(retries + 1):
+                try:
+                    return await self.cdrs(start_date=window_start, end_date=window_end, user=user, offset=offset,
+                                           limit=limit, use_cache=False, **kwargs) or []
+                except (BadRequest, ScopeException, NotFound):
+                    raise
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    await asyncio.sleep(retry_interval * 2 ** attempt)
+
+        async def fetch_window(window_start, window_end):
+            """
+            :return: The records for the window or None if it must be split
+            """
+            async with semaphore:
+                records = await fetch(window_start, window_end, 0)
+
+                if len(records) < limit:
+                    return records
+                elif window_end - window_start > min_window:
+                    return None
+
+                while True:
+                    page = await fetch(window_start, window_end, len(records))
+                    records.extend(page)
+                    if len(page) < limit:
+                        return records
+
+        def submit(window_start, window_end):
+            return window_start, window_end, asyncio.ensure_future(fetch_window(window_start, window_end))
+
+        windows = deque()
+        try:
+            window_start = start_date
+            while window_start < end_date:
+                window_end = min(window_start + window, end_date)
+                windows.append(submit(window_start, window_end))
+                window_start = window_end
+
+            while windows:
+                window_start, window_end, task = windows.popleft()
+                records = await task
+
+                if records is None:
+                    # Too many records, replace the window with its two halves
+                    middle = window_start + (window_end - window_start) // 2
+                    windows.appendleft(submit(middle, window_end))
+                    windows.appendleft(submit(window_start, middle))
+                    continue
+
+                for record in records:
+                    yield record
+        finally:
+            for _, _, task in windows:
+                task.cancel()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import re
+from datetime import datetime, date, timedelta
+from uuid import uuid4
+
+from .storage import digest
+from .request_handler import utc_datetime
+
+__author__ = 'DavidWard'
+
+
+# The params holding the range of a report
+DATE_PARAMS = ('start_date', 'end_date')
+
+
+def floor_datetime(value, period=None):
+    """
+    Truncate a datetime to the start of its report period, or to the second
+    :param value:
+    :param period: 'hour', 'day', 'month' or None
+    :return:
+    """
+    value = value.replace(microsecond=0)
+    if period in ('hour', 'day', 'month'):
+        value = value.replace(minute=0, second=0)
+    if period in ('day', 'month'):
+        value = value.replace(hour=0)
+    if period == 'month':
+        value = value.replace(day=1)
+    return value
+
+
+def ceil_datetime(value, period=None):
+    """
+    Round a datetime up to the start of the next report period, or to the next second, unless it is on a boundary
+    :param value:
+    :param period: 'hour', 'day', 'month' or None
+    :return:
+    """
+    floor = floor_datetime(value, period)
+    if floor == value:
+        return value
+    elif period == 'month':
+        return (floor + timedelta(days=32)).replace(day=1)
+    return floor + {'hour': timedelta(hours=1), 'day': timedelta(days=1)}.get(period, timedelta(seconds=1))
+
+
+class CachePolicy(object):
+    """
+    How the results for a family of paths are cached. Results are tagged when stored and any write (POST, PUT or
+    DELETE) to a path of the family invalidates every result with its tags.
+
+    Reports over a range which closed in the past never change. A policy with a historical_timeout caches them for
+    that long instead, and widens their start_date and end_date to the boundaries of the report period (or the
+    second) so requests made a moment apart, e.g. from datetime.utcnow(), are sent and cached as the same request.
+    """
+
+    def __init__(self, path, timeout=None, cacheable=True, tags=(), max_stale=None, historical_timeout=None,
+                 settle_time=3600):
+        """
+
+        :param path: The path prefix of the family. {name} matches one path segment, which can be used in tags, and *
+        matches one path segment. e.g. 'call_queues/{queue}/agents/'
+        :param timeout: The number of seconds results are cached for. None uses the request's default
+        :param cacheable: If False results are never cached
+        :param tags: The tags of the family's results, formatted with the path segments, e.g.
+        'call_queues/{queue}/agents/'
+        :param max_stale: See ResourceRequest. None uses the request's default
+        :param historical_timeout: The number of seconds results for a closed range are cached for. If set the range
+        params are normalized
+        :param settle_time: The number of seconds after its end_date before a range is closed, allowing for calls
+        still in progress
+        """
+        self.path = path
+        self.timeout = timeout
+        self.cacheable = cacheable
+        self.tags = tuple(tags)
+        self.max_stale = max_stale
+        self.historical_timeout = historical_timeout
+        self.settle_time = settle_time
+
+        pattern = re.escape(path).replace(r'\*', '[^/]+')
+        self.pattern = re.compile(re.sub(r'\\{(\w+)\\}', r'(?P<\1>[^/]+)', pattern))
+
+    def match(self, path):
+        """
+        Match the path against the policy
+        :param path:
+        :return: The tags for the path, or None if the policy does not apply
+        """
+        match = self.pattern.match(path or '')
+        if match is None:
+            return None
+        return [tag.format(**match.groupdict()) for tag in self.tags]
+
+    def normalize(self, params):
+        """
+        Widen the datetime range params to the boundaries of the report period
+        :param params:
+        :return: The params to send and cache the request with
+        """
+        if self.historical_timeout is None or not params:
+            return params
+
+        params = dict(params)
+        period = params.get('period')
+        for name, rounding in zip(DATE_PARAMS, (floor_datetime, ceil_datetime)):
+            if isinstance(params.get(name), datetime):
+                params[name] = rounding(params[name], period)
+        return params
+
+    def closed(self, params, now=None):
+        """
+        Check if the range of a request ended long enough ago that its result will not change
+        :param params:
+        :param now: A naive datetime in UTC, defaults to the current time
+        :return:
+        """
+        end_date = (params or {}).get('end_date')
+        if self.historical_timeout is None or end_date is None:
+            return False
+
+        if isinstance(end_date, date) and not isinstance(end_date, datetime):
+            end_date = datetime(end_date.year, end_date.month, end_date.day)
+
+        try:
+            end_date = utc_datetime(end_date)
+        except (TypeError, ValueError):
+            return False
+
+        now = now or datetime.utcnow()
+        return end_date <= now - timedelta(seconds=self.settle_time)
+
+
+class CachePolicies(object):
+    """
+    A table of CachePolicy. The first policy matching a path applies. Tags are invalidated by changing the version
+    stored for them in Storage, which is part of the key of every tagged result, so it works across every process
+    sharing the storage.
+    """
+
+    def __init__(self, policies):
+        self.policies = list(policies)
+
+    def match(self, path):
+        """
+        Find the policy for a path
+        :param path:
+        :return: A tuple of the CachePolicy and the path's tags, or (None, []) if no policy applies
+        """
+        for policy in self.policies:
+            tags = policy.match(path)
+            if tags is not None:
+                return policy, tags
+        return None, []
+
+    @staticmethod
+    def tag_key(tag):
+        return 'cache_tag_%s' % tag
+
+    def tag_versions(self, storage, tags):
+        """
+        A digest of the current versions of the tags, to be added to the storage key of a tagged result
+        :param storage:
+        :param tags:
+        :return:
+        """
+        return digest(dict((tag, storage.get(self.tag_key(tag))) for tag in tags))
+
+    def invalidate(self, storage, tags):
+        """
+        Invalidate every result stored with any of the tags
+        :param storage:
+        :param tags:
+        :return:
+        """
+        for tag in tags:
+            storage.set(self.tag_key(tag), uuid4().hex)
+
+
+# The cache timeout of reports over a closed range
+HISTORICAL_CACHE_TIMEOUT = 30 * 86400
+
+DEFAULT_CACHE_POLICIES = CachePolicies([
+    CachePolicy('oauth/', cacheable=False),
+    CachePolicy('calls/', tags=['calls/']),
+    CachePolicy('cdrs/'),
+    CachePolicy('call_queues/stats/', historical_timeout=HISTORICAL_CACHE_TIMEOUT),
+    CachePolicy('call_queues/agents/stats/', historical_timeout=HISTORICAL_CACHE_TIMEOUT),
+    CachePolicy('call_queues/reports/', historical_timeout=HISTORICAL_CACHE_TIMEOUT),
+    CachePolicy('call_queues/{queue}/stats/', historical_timeout=HISTORICAL_CACHE_TIMEOUT),
+    CachePolicy('call_queues/{queue}/agents/stats/', historical_timeout=HISTORICAL_CACHE_TIMEOUT),
+    CachePolicy('call_queues/{queue}/reports/', historical_timeout=HISTORICAL_CACHE_TIMEOUT),
+    CachePolicy('call_queues/{queue}/agents/', tags=['call_queues/{queue}/agents/']),
+    CachePolicy('caller_id_numbers/', timeout=3600, tags=['caller_id_numbers/']),
+    CachePolicy('subscriptions/', tags=['subscriptions/']),
+    CachePolicy('users/', timeout=3600),
+    CachePolicy('phone_numbers/', timeout=3600),
+])
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from datetime import datetime, timedelta
+from time import time
+
+from .storage import SQLiteDatabase
+from .request_handler import default_request_handler, utc_datetime
+
+__author__ = 'DavidWard'
+
+_logger = logging.getLogger(__name__)
+# Add NullHandler to prevent logging warnings on startup
+null_handler = logging.NullHandler()
+_logger.addHandler(null_handler)
+
+# Start times are stored in UTC in this format, which sorts and compares as text
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS cdrs (domain TEXT NOT NULL, key TEXT NOT NULL, call_id TEXT, start_time TEXT, '
+    'from_user TEXT, to_user TEXT, record TEXT NOT NULL, PRIMARY KEY (domain, key))',
+    'CREATE INDEX IF NOT EXISTS cdrs_start_time ON cdrs (domain, start_time)',
+    'CREATE INDEX IF NOT EXISTS cdrs_from_user ON cdrs (domain, from_user, start_time)',
+    'CREATE INDEX IF NOT EXISTS cdrs_to_user ON cdrs (domain, to_user, start_time)',
+    'CREATE INDEX IF NOT EXISTS cdrs_call_id ON cdrs (call_id)',
+    'CREATE TABLE IF NOT EXISTS cdr_watermarks (domain TEXT NOT NULL, user TEXT NOT NULL, watermark TEXT NOT NULL, '
+    'synced REAL, PRIMARY KEY (domain, user))',
+)
+
+
+def format_time(value):
+    value = utc_datetime(value)
+    return value.strftime(TIME_FORMAT) if value is not None else None
+
+
+class CdrStore(SQLiteDatabase):
+    """
+    A local copy of the call records of a domain, or some of its users, kept in a SQLite database. Each sync only
+    requests the records since the high-watermark of the last one, so reports over past periods are answered locally.
+
+        store = CdrStore(v, 'cdrs.sqlite', domain='example.com')
+        store.sync(start_date=datetime(2018, 1, 1))
+        records = store.cdrs(start_date=datetime(2018, 3, 1), end_date=datetime(2018, 4, 1), user='101')
+
+    Call records are only created once a call has ended, so every sync requests again the overlap before the
+    high-watermark to pick up calls which were still in progress. Records are stored once however often they are
+    received.
+    """
+
+    def __init__(self, versature, path, domain='', overlap=timedelta(hours=1), busy_timeout=30):
+        """
+
+        :param versature: The Versature client the records are requested with
+        :param path: The database file. Several processes may share it
+        :param domain: The domain of the records, so several domains can be kept in one database
+        :param overlap: How far before the high-watermark each sync starts
+        :param busy_timeout: The number of seconds to wait for another process's write lock
+        """
+        if versature.is_async:
+            raise TypeError('CdrStore syncs with a Versature client, not an AsyncVersature')
+
+        super(CdrStore, self).__init__(path, busy_timeout)
+        self.versature = versature
+        self.domain = domain
+        self.overlap = overlap
+
+        with self.transaction() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+
+    def watermark(self, user=None):
+        """
+        The time up to which the records have been synced
+        :param user: The user synced, or None for the domain
+        :return: A naive datetime in UTC, or None if never synced
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT watermark FROM cdr_watermarks WHERE domain = ? AND user = ?', (self.domain, user or ''))
+        row = cursor.fetchone()
+        return datetime.strptime(row[0], TIME_FORMAT) if row else None
+
+    def sync(self, user=None, start_date=None, **kwargs):
+        """
+        Request and store the records created since the last sync
+        :param user: The user whose records are synced, or None for every record the credentials can see
+        :param start_date: Where the first sync starts. Ignored once a high-watermark exists
+        :param kwargs: Passed to Versature.export_cdrs, e.g. window or max_workers
+        :return: The number of records received
+        """
+        watermark = self.watermark(user)
+        if watermark is not None:
+            start_date = watermark - self.overlap
+        elif start_date is None:
+            raise ValueError('A start_date is required for the first sync')
+
+        end_date = datetime.utcnow().replace(microsecond=0)
+        start_date = utc_datetime(start_date)
+
+        count = 0
+        rows = []
+        # Fields are stored as received, they are coerced when the records are read
+        for record in self.versature.export_cdrs(start_date, end_date, user=user, schema={}, **kwargs):
+            rows.append(self.row(record))
+            count += 1
+            if len(rows) >= 1000:
+                with self.transaction() as cursor:
+                    self.insert(cursor, rows)
+                rows = []
+
+        # The high-watermark only moves once every record before it has been stored
+        with self.transaction() as cursor:
+            self.insert(cursor, rows)
+            cursor.execute('INSERT OR REPLACE INTO cdr_watermarks (domain, user, watermark, synced) '
+                           'VALUES (?, ?, ?, ?)', (self.domain, user or '', format_time(end_date), time()))
+
+        _logger.debug('Synced %s call records for %s from %s to %s', count, user or self.domain, start_date, end_date)
+        return count
+
+    def row(self, record):
+        """
+        The row stored for a record
+        :param record: A call record as received
+        :return:
+        """
+        parties = [record.get('from') or {}, record.get('to') or {}]
+        key = '_'.join([record.get('call_id') or ''] + [party.get('call_id') or '' for party in parties])
+        return (self.domain, key, record.get('call_id'), format_time(record.get('start_time')),
+                parties[0].get('user'), parties[1].get('user'), json.dumps(record))
+
+    @staticmethod
+    def insert(cursor, rows):
+        cursor.executemany('INSERT OR REPLACE INTO cdrs (domain, key, call_id, start_time, from_user, to_user, record) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def cdrs(self, start_date=None, end_date=None, user=None, call_id=None, schema=None, record_class=None):
+        """
+        Get the stored records, in order of start time. Records are coerced as the request handler's would be.
+        :param start_date: Inclusive
+        :param end_date: Exclusive
+        :param user: Only records from or to this user
+        :param call_id:
+        :param schema: Coerce only these fields, see ResourceRequest
+        :param record_class: Return instances of this Record class, see ResourceRequest
+        :return: A list of call records
+        """
+        conditions, params = ['domain = ?'], [self.domain]
+
+        if start_date is not None:
+            conditions.append('start_time >= ?')
+            params.append(format_time(start_date))
+        if end_date is not None:
+            conditions.append('start_time < ?')
+            params.append(format_time(end_date))
+        if user is not None:
+            conditions.append('(from_user = ? OR to_user = ?)')
+            params.extend([user, user])
+        if call_id is not None:
+            conditions.append('call_id = ?')
+            params.append(call_id)
+
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT record FROM cdrs WHERE %s ORDER BY start_time' % ' AND '.join(conditions), params)
+
+        if record_class is not None:
+            return [record_class.from_dict(json.loads(row[0])) for row in cursor]
+
+        request_handler = self.versature.request_handler or default_request_handler()
+        object_hook = request_handler.object_hook(schema)
+        return [json.loads(row[0], object_hook=object_hook) for row in cursor]
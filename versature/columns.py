@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from datetime import datetime
+
+from .records import Record
+from .request_handler import DATETIME_PATTERN, FLOAT_PATTERN, utc_datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+__author__ = 'DavidWard'
+
+# The column types which can be named in types
+COLUMN_TYPES = ('datetime', 'float', 'int', 'bool', 'str')
+
+
+def flatten(value, separator='.', prefix=''):
+    """
+    Flatten the nested objects of a record into one dict, e.g. {'from': {'user': '101'}} to {'from.user': '101'}
+    :param value: A dict or Record
+    :param separator:
+    :param prefix:
+    :return:
+    """
+    if isinstance(value, Record):
+        value = value.to_dict(coerce_values=False)
+
+    flat = {}
+    for k, v in value.items():
+        if isinstance(v, Record):
+            v = v.to_dict(coerce_values=False)
+        if isinstance(v, dict):
+            flat.update(flatten(v, separator, '%s%s%s' % (prefix, k, separator)))
+        else:
+            flat['%s%s' % (prefix, k)] = v
+    return flat
+
+
+def is_float(value):
+    """
+    True if the string is one json_parser would coerce to a float. Strings such as '10.0.0.1' or '1.7.0' only start
+    with the float pattern.
+    :param value:
+    :return:
+    """
+    if not FLOAT_PATTERN.match(value):
+        return False
+
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def column_type(values):
+    """
+    Infer the type of a column from its values. Strings in the API's datetime and float formats are typed as
+    datetime and float, as json_parser would have coerced them.
+    :param values:
+    :return: One of COLUMN_TYPES
+    """
+    types = set()
+    for v in values:
+        if v is None:
+            continue
+        elif isinstance(v, bool):
+            types.add('bool')
+        elif isinstance(v, int):
+            types.add('int')
+        elif isinstance(v, float):
+            types.add('float')
+        elif isinstance(v, datetime):
+            types.add('datetime')
+        elif isinstance(v, str) and DATETIME_PATTERN.match(v):
+            types.add('datetime')
+        elif isinstance(v, str) and is_float(v):
+            types.add('float')
+        else:
+            return 'str'
+
+    if types == set(['int', 'float']):
+        return 'float'
+    elif len(types) == 1:
+        return types.pop()
+    return 'str'
+
+
+def datetime_array(values):
+    """
+    Convert datetime strings to a datetime64[s] array in UTC. Strings in the API's fixed format are converted by
+    numpy and their offsets applied per distinct offset, anything else is parsed individually.
+    :param values:
+    :return:
+    """
+    if all(v is None or (isinstance(v, str) and v[10:11] == 'T' and (len(v) == 19 or len(v) == 25 and v[19] in '+-'))
+           for v in values):
+        strings = numpy.array([v or 'NaT' for v in values], dtype='U25')
+        try:
+            # Truncating to 19 characters drops the offsets
+            local = strings.astype('U19').astype('datetime64[s]')
+        except ValueError:
+            pass
+        else:
+            # The offsets of a report are few, so each distinct offset is only parsed once
+            offsets, inverse = numpy.unique([v[19:] if v else '' for v in values], return_inverse=True)
+            seconds = numpy.array([offset_seconds(offset) for offset in offsets], dtype='timedelta64[s]')
+            return local - seconds[inverse]
+
+    return numpy.array([utc_datetime(v) for v in values], dtype='datetime64[s]')
+
+
+def offset_seconds(offset):
+    """
+    :param offset: A UTC offset, e.g. '-05:00', or blank for UTC
+    :return: The offset in seconds
+    """
+    if not offset:
+        return 0
+    seconds = int(offset[1:3]) * 3600 + int(offset[4:6]) * 60
+    return -seconds if offset[0] == '-' else seconds
+
+
+def column_array(values, type):
+    """
+    Convert a column to a numpy array of its type. Missing numbers are NaN and missing datetimes NaT. Columns of int
+    or bool with missing values are float and object arrays.
+    :param values:
+    :param type: One of COLUMN_TYPES
+    :return:
+    """
+    if type == 'datetime':
+        return datetime_array(values)
+    elif type == 'float' or (type == 'int' and None in values):
+        return numpy.array(['nan' if v is None else v for v in values], dtype=float)
+    elif type == 'int':
+        return numpy.array(values, dtype=numpy.int64)
+    elif type == 'bool' and None not in values:
+        return numpy.array(values, dtype=bool)
+    return numpy.array(values, dtype=object)
+
+
+def column_list(values, type):
+    """
+    Coerce the values of a column to its type, leaving missing values as None
+    :param values:
+    :param type: One of COLUMN_TYPES
+    :return:
+    """
+    if type == 'datetime':
+        return [utc_datetime(v) for v in values]
+    elif type in ('float', 'int'):
+        coerce = float if type == 'float' else int
+        return [None if v is None else coerce(v) for v in values]
+    return list(values)
+
+
+def to_columns(records, types=None, arrays=True, separator='.'):
+    """
+    Convert a list of records (e.g. from cdrs() or call_queue_split_report()) to typed columns. Nested objects are
+    flattened into columns named with the separator, e.g. 'from.user'. Datetimes are converted to UTC.
+
+    The conversion is vectorized, so request the records with schema={} (or as Cdr records) to skip coercing every
+    value while decoding:
+
+        columns = to_columns(v.cdrs(start_date=start_date, schema={}))
+        numpy.bincount(columns['start_time'].astype('datetime64[h]').astype(int) % 24)
+
+    :param records: A list of dicts or Records
+    :param types: A dict of column name to one of COLUMN_TYPES. The type of other columns is inferred from their values
+    :param arrays: If True columns are numpy arrays, otherwise lists of coerced values
+    :param separator:
+    :return: An OrderedDict of column name to column, in the order the fields were first seen
+    """
+    if arrays and numpy is None:
+        raise ImportError('numpy must be installed to export columns as arrays')
+
+    rows = [flatten(record, separator) for record in records or []]
+
+    names = OrderedDict()
+    for row in rows:
+        for name in row:
+            names[name] = None
+
+    types = types or {}
+    columns = OrderedDict()
+    for name in names:
+        values = [row.get(name) for row in rows]
+        type = types.get(name) or column_type(values)
+        columns[name] = column_array(values, type) if arrays else column_list(values, type)
+    return columns
+
+
+def to_arrow(records, types=None, separator='.'):
+    """
+    Convert a list of records to a pyarrow Table, see to_columns. Datetimes are timestamps in UTC.
+    :param records: A list of dicts or Records
+    :param types: A dict of column name to one of COLUMN_TYPES
+    :param separator:
+    :return: pyarrow.Table
+    """
+    if pyarrow is None:
+        raise ImportError('pyarrow must be installed to export records to arrow')
+
+    columns = to_columns(records, types, arrays=numpy is not None, separator=separator)
+
+    arrays = []
+    for name, column in columns.items():
+        if numpy is not None:
+            # NaN and NaT are missing values
+            kind = column.dtype.kind
+            timestamp = pyarrow.timestamp('s', tz='UTC') if kind == 'M' else None
+            arrays.append(pyarrow.array(column, type=timestamp, from_pandas=True))
+        elif any(isinstance(v, datetime) for v in column):
+            arrays.append(pyarrow.array(column, type=pyarrow.timestamp('s', tz='UTC')))
+        else:
+            arrays.append(pyarrow.array(column))
+    return pyarrow.Table.from_arrays(arrays, names=list(columns))
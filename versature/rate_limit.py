@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import re
+import asyncio
+import logging
+from threading import RLock
+from time import time, sleep
+
+from .storage import DictionaryStorage, digest, token_fingerprint
+
+__author__ = 'DavidWard'
+
+_logger = logging.getLogger(__name__)
+# Add NullHandler to prevent logging warnings on startup
+null_handler = logging.NullHandler()
+_logger.addHandler(null_handler)
+
+
+class RateLimit(object):
+    """
+    A token bucket for a family of paths. Up to burst requests are sent immediately after which requests are spaced
+    to rate per second.
+    """
+
+    def __init__(self, path, rate, burst=None):
+        """
+
+        :param path: The path prefix of the family, e.g. 'cdrs/' or 'call_queues/*/stats/'. * matches one path segment
+        :param rate: The number of requests per second
+        :param burst: The number of requests which may be sent at once. Defaults to rate, or 1 if rate is lower
+        """
+        self.path = path
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.pattern = re.compile(re.escape(path).replace(r'\*', '[^/]+'))
+
+    def matches(self, path):
+        return path is not None and self.pattern.match(path) is not None
+
+    def take(self, state, now):
+        """
+        Reserve a token from the bucket
+        :param state: The (tokens, updated) state of the bucket or None if it is full
+        :param now:
+        :return: The new state and the number of seconds to wait before the token may be used
+        """
+        tokens, updated = state if state else (self.burst, now)
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        return (tokens, now), max(0.0, -tokens / self.rate)
+
+
+class RateLimiter(object):
+    """
+    Hold a token bucket per path family and access token and make callers wait for a token before their request is
+    sent, rather than sending requests the API will reject. Buckets are kept in storage; use a Storage shared between
+    processes (e.g. SQLiteStorage) to limit several processes together.
+
+        rate_limiter = RateLimiter([RateLimit('cdrs/', rate=2, burst=5),
+                                    RateLimit('call_queues/*/stats/', rate=1),
+                                    RateLimit('calls/', rate=5)])
+        v = Versature(..., rate_limiter=rate_limiter)
+    """
+
+    def __init__(self, limits, storage=None):
+        """
+
+        :param limits: A list of RateLimit. The first one matching a path applies
+        :param storage: Where the buckets are kept. Defaults to a DictionaryStorage for this process
+        """
+        self.limits = list(limits)
+        self.storage = storage or DictionaryStorage()
+        self.lock = RLock()
+        self.stats = {}
+
+    def match(self, path):
+        """
+        Find the RateLimit for the path
+        :param path:
+        :return: RateLimit or None
+        """
+        for limit in self.limits:
+            if limit.matches(path):
+                return limit
+        return None
+
+    @staticmethod
+    def bucket_key(limit, access_token):
+        return 'rate_limit_%s' % digest({'path': limit.path, 'access_token': token_fingerprint(access_token)})
+
+    def reserve(self, path, access_token=None):
+        """
+        Reserve a token for a request to the path. Callers are queued in the order they reserve.
+        :param path:
+        :param access_token: Requests with different access tokens have separate buckets
+        :return: The number of seconds to wait before sending the request
+        """
+        limit = self.match(path)
+        if limit is None:
+            return 0
+
+        key = self.bucket_key(limit, access_token)
+
+        while True:
+            state = self.storage.get(key)
+            new_state, delay = limit.take(state, time())
+
+            # The bucket is full again once the reserved tokens have been refilled
+            timeout = (limit.burst - new_state[0]) / limit.rate + 1
+            if self.storage.cas(key, state, new_state, timeout):
+                break
+
+        self.record(limit, delay)
+        return delay
+
+    def acquire(self, path, access_token=None):
+        """
+        Block until a request to the path may be sent
+        :param path:
+        :param access_token:
+        :return: The number of seconds spent waiting
+        """
+        delay = self.reserve(path, access_token)
+        if delay:
+            _logger.debug('Throttling request to %s for %.3f seconds', path, delay)
+            sleep(delay)
+        return delay
+
+    async def acquire_async(self, path, access_token=None):
+        """
+        The asyncio equivalent of acquire
+        """
+        delay = self.reserve(path, access_token)
+        if delay:
+            _logger.debug('Throttling request to %s for %.3f seconds', path, delay)
+            await asyncio.sleep(delay)
+        return delay
+
+    def record(self, limit, delay):
+        with self.lock:
+            stats = self.stats.setdefault(limit.path, {'requests': 0, 'throttled': 0, 'throttled_time': 0.0})
+            stats['requests'] += 1
+            if delay:
+                stats['throttled'] += 1
+                stats['throttled_time'] += delay
+
+    def throttled_time(self, path=None):
+        """
+        The total number of seconds callers in this process were made to wait
+        :param path: Only count this path family
+        :return:
+        """
+        with self.lock:
+            return sum(stats['throttled_time'] for family, stats in self.stats.items() if path in (None, family))
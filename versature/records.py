@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from .request_handler import parse_datetime
+
+__author__ = 'DavidWard'
+
+
+def coerce(value, coercion):
+    """
+    Coerce a raw json value, leaving None and values which have already been coerced as they are
+    :param value:
+    :param coercion:
+    :return:
+    """
+    if isinstance(value, str):
+        try:
+            return coercion(value)
+        except ValueError:
+            pass
+    return value
+
+
+class Record(object):
+    """
+    A compact, read only record of the API. Values are held as received in slots rather than a dict and the coerced
+    fields are parsed each time they are accessed, so holding millions of records costs a fraction of the memory of
+    the coerced dicts. Fields the record does not know of are kept in extra.
+
+    Records can be read as attributes or, like the dicts they replace, by their json names:
+
+        cdr.start_time == cdr['start_time']
+    """
+
+    # A tuple of (attribute, json name) pairs held in slots of the same names
+    fields = ()
+    # The attributes of nested records, mapped to their Record class
+    nested = {}
+    # The attributes parsed on access by a coerced_field. The raw value is held in the slot '_<attribute>'.
+    coerced = ()
+
+    __slots__ = ('extra',)
+
+    def __init__(self, **values):
+        for attribute, name in self.fields:
+            slot = '_%s' % attribute if attribute in self.coerced else attribute
+            object.__setattr__(self, slot, values.pop(attribute, None))
+        object.__setattr__(self, 'extra', values or None)
+
+    @classmethod
+    def from_dict(cls, value):
+        """
+        Create a record from a decoded json object
+        :param value:
+        :return:
+        """
+        if not isinstance(value, dict):
+            return value
+
+        value = dict(value)
+        values = {}
+        for attribute, name in cls.fields:
+            v = value.pop(name, None)
+            if attribute in cls.nested:
+                v = cls.nested[attribute].from_dict(v)
+            values[attribute] = v
+
+        values.update(value)
+        return cls(**values)
+
+    def to_dict(self, coerce_values=True):
+        """
+        Convert the record to the dict the API returned
+        :param coerce_values: If True the coerced fields are parsed, as json_parser would have done
+        :return:
+        """
+        value = {}
+        for attribute, name in self.fields:
+            if attribute in self.coerced and not coerce_values:
+                v = getattr(self, '_%s' % attribute)
+            else:
+                v = getattr(self, attribute)
+
+            if isinstance(v, Record):
+                v = v.to_dict(coerce_values)
+            value[name] = v
+
+        if self.extra:
+            value.update(self.extra)
+        return value
+
+    def __getitem__(self, name):
+        for attribute, field in self.fields:
+            if field == name:
+                v = getattr(self, attribute)
+                return v.to_dict() if isinstance(v, Record) else v
+
+        if self.extra and name in self.extra:
+            return self.extra[name]
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setattr__(self, key, value):
+        raise AttributeError('%s is read only' % type(self).__name__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict(False) == other.to_dict(False)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return type(self).from_dict, (self.to_dict(False),)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.to_dict(False))
+
+
+def coerced_field(attribute, coercion):
+    """
+    A property parsing the raw value of an attribute on access
+    :param attribute:
+    :param coercion:
+    :return:
+    """
+    slot = '_%s' % attribute
+    return property(lambda self: coerce(getattr(self, slot), coercion))
+
+
+class CdrParty(Record):
+    """
+    The caller or callee of a call record
+    """
+
+    fields = (('user', 'user'), ('domain', 'domain'), ('name', 'name'), ('id', 'id'), ('call_id', 'call_id'))
+
+    __slots__ = ('user', 'domain', 'name', 'id', 'call_id')
+
+
+class Cdr(Record):
+    """
+    A call record. Timestamps are parsed to datetimes and the cost to a float only when accessed.
+
+        for cdr in v.iter_cdrs(start_date=start_date, record_class=Cdr):
+            total += cdr.cost
+    """
+
+    fields = (('call_id', 'call_id'), ('from_', 'from'), ('to', 'to'), ('start_time', 'start_time'),
+              ('answer_time', 'answer_time'), ('end_time', 'end_time'), ('duration', 'duration'), ('cost', 'cost'),
+              ('release_text', 'release_text'), ('direction', 'direction'))
+    nested = {'from_': CdrParty, 'to': CdrParty}
+    coerced = ('start_time', 'answer_time', 'end_time', 'cost')
+
+    __slots__ = ('call_id', 'from_', 'to', '_start_time', '_answer_time', '_end_time', 'duration', '_cost',
+                 'release_text', 'direction')
+
+    start_time = coerced_field('start_time', parse_datetime)
+    answer_time = coerced_field('answer_time', parse_datetime)
+    end_time = coerced_field('end_time', parse_datetime)
+    cost = coerced_field('cost', float)
@@ -1,15 +1,32 @@
 # -*- coding: utf-8 -*-
+import os
 import re
+import copy
+import json
+import codecs
 import logging
-from datetime import datetime
-from time import sleep
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from random import uniform
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from functools import partial
+from threading import Lock
+from time import sleep, monotonic, time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 from dateutil import parser
 
+from .storage import Storage, digest
 from .exceptions import HTTPError, NotFound, ContentTypeNotSupported, RateLimitExceeded, ScopeException, \
     UnprocessableEntityError, AuthenticationException, BadRequest
 
 try:
+    from requests import Session
+    from requests.adapters import HTTPAdapter
     from requests_futures.sessions import FuturesSession
 except ImportError:
     pass
@@ -21,36 +38,485 @@ _logger = logging.getLogger(__name__)
 null_handler = logging.NullHandler()
 _logger.addHandler(null_handler)
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# The content codings requested from the API. Brotli is only requested when it can be decoded.
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+
+# The cache timeout of results without one provided or set by their cache policy
+DEFAULT_CACHE_TIMEOUT = 60
+# Only the results of these methods are cached, other methods invalidate cached results
+CACHEABLE_METHODS = ('GET', 'HEAD')
+# Failures which are the same every time for the same request and may be cached
+NEGATIVE_CACHE_EXCEPTIONS = (NotFound, UnprocessableEntityError)
+# Returned by read_cache when there is no result to serve, as a cached result may be empty, 0 or None
+CACHE_MISS = object()
+
+DATETIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:(?:\+|\-)\d{2}:\d{2})?')
+FLOAT_PATTERN = re.compile(r'\d*\.\d*')
+
+
+def parse_datetime(value):
+    """
+    Parse an ISO 8601 datetime. The fixed formats sent by the API are parsed natively and anything else falls back to
+    dateutil.
+    :param value:
+    :return:
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return parser.parse(value)
+
+
+def utc_datetime(value):
+    """
+    Convert a datetime, or a string in a datetime format, to a naive datetime in UTC
+    :param value:
+    :return:
+    """
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = parse_datetime(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# Coercions which can be named in a field schema
+COERCIONS = {'datetime': parse_datetime,
+             'float': float,
+             'int': int}
+
+
+def schema_key(schema):
+    """
+    A stable digest of a field schema, keeping results decoded with different schemas apart. Coercions are keyed by
+    name and functions by their qualified name.
+    :param schema:
+    :return: The digest, or None if a function has no stable name, e.g. a lambda
+    """
+    names = {}
+    for field, coercion in schema.items():
+        if not isinstance(coercion, basestring):
+            name = getattr(coercion, '__qualname__', None)
+            if name is None or '<' in name:
+                return None
+            coercion = '%s.%s' % (coercion.__module__, name)
+        names[field] = coercion
+    return digest(names)
+
+
+def apply_object_hook(value, object_hook):
+    """
+    Apply an object_hook to every dict within a decoded json value, innermost first, as json.loads does
+    :param value:
+    :param object_hook:
+    :return:
+    """
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if isinstance(v, (dict, list)):
+                value[k] = apply_object_hook(v, object_hook)
+        return object_hook(value)
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            if isinstance(v, (dict, list)):
+                value[i] = apply_object_hook(v, object_hook)
+    return value
+
+
+class JsonArrayParser(object):
+    """
+    Incrementally parse a json array, returning each element as soon as it has been received in full. Only the
+    elements not yet returned are held in memory.
+    """
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, object_hook=None):
+        self.decoder = json.JSONDecoder(object_hook=object_hook)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk):
+        """
+        Add the next chunk of the body
+        :param chunk: bytes
+        :return: A list of the elements completed by the chunk
+        """
+        self.buffer += self.text_decoder.decode(chunk)
+        return self.parse()
+
+    def close(self):
+        """
+        End the body
+        :return: A list of the remaining elements
+        """
+        self.buffer += self.text_decoder.decode(b'', final=True)
+        elements = self.parse()
+        if not self.finished:
+            raise ValueError('Incomplete json array')
+        return elements
+
+    def parse(self):
+        elements = []
+        buffer = self.buffer
+        position = 0
+
+        while True:
+            position = self.WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+
+            character = buffer[position]
+
+            if not self.started:
+                if character != '[':
+                    raise ValueError('Expected a json array')
+                self.started = True
+                position += 1
+            elif self.finished:
+                raise ValueError('Unexpected data after the json array')
+            elif character == ']':
+                self.finished = True
+                position += 1
+            elif character == ',':
+                position += 1
+            else:
+                try:
+                    element, end = self.decoder.raw_decode(buffer, position)
+                except ValueError:
+                    # The element has not been received in full
+                    break
+
+                following = self.WHITESPACE.match(buffer, end).end()
+                if following == len(buffer) or buffer[following] not in ',]':
+                    # Only complete once followed by a delimiter, a number may continue in the next chunk
+                    break
+
+                elements.append(element)
+                position = end
+
+        self.buffer = buffer[position:]
+        return elements
+
+
+def iter_json_array(chunks, object_hook=None):
+    """
+    Yield the elements of a json array received in chunks
+    :param chunks: An iterable of bytes
+    :param object_hook:
+    :return:
+    """
+    parser = JsonArrayParser(object_hook)
+
+    for chunk in chunks:
+        for element in parser.feed(chunk):
+            yield element
+
+    for element in parser.close():
+        yield element
+
+_default_request_handler = None
+_default_request_handler_pid = None
+_default_request_handler_lock = Lock()
+
+
+def default_request_handler():
+    """
+    Get the process wide RequestHandler shared by every request which is not provided a handler. The handler (and the
+    thread and connection pools it owns) is created on first use and re-created after a fork.
+    :return:
+    """
+    global _default_request_handler, _default_request_handler_pid
+
+    pid = os.getpid()
+    if _default_request_handler is None or _default_request_handler_pid != pid:
+        with _default_request_handler_lock:
+            if _default_request_handler is None or _default_request_handler_pid != pid:
+                _default_request_handler = RequestHandler()
+                _default_request_handler_pid = pid
+
+    return _default_request_handler
+
+
+class CursorResponse(object):
+    """
+    A cursor response object contains details about additional data which is available for this request.
+    """
+
+    def __init__(self, data, headers):
+        self.data = data
+        more = headers.get('more', False)
+        self.more = more.lower() in ('true', '1') if isinstance(more, basestring) else bool(more)
+        self.cursor = headers.get('cursor', False)
+
+
+class SingleFlight(object):
+    """
+    Coalesce identical in flight requests. The first caller for a key becomes the leader and performs the request. Every
+    caller which joins while the leader is in flight waits on the same future and receives the leader's result.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights = {}
+
+    def join(self, key):
+        """
+        Join the flight for the provided key, starting one if none is in progress
+        :param key:
+        :return: A tuple of the flight's future and True if the caller is the leader
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+
+            flight = Future()
+            self._flights[key] = flight
+            return flight, True
+
+    def complete(self, key, flight, result=None, exception=None):
+        """
+        End the flight and pass the result or exception to everyone waiting on it
+        :param key:
+        :param flight:
+        :param result:
+        :param exception:
+        :return:
+        """
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        if exception is not None:
+            flight.set_exception(exception)
+        else:
+            flight.set_result(result)
+
+
+single_flight = SingleFlight()
+
+
+class CacheEntry(object):
+    """
+    A result stored in Storage along with the time it stops being fresh
+    """
+
+    etag = None
+    last_modified = None
+    exception = None
+
+    def __init__(self, content, fresh_until=None, etag=None, last_modified=None, exception=None):
+        """
+
+        :param content:
+        :param fresh_until: The time (seconds since the epoch) after which the content is stale. None never goes stale
+        :param etag: The ETag of the response, used to revalidate the content once stale
+        :param last_modified: The Last-Modified date of the response, used to revalidate the content once stale
+        :param exception: The exception raised by the request instead of content, see NEGATIVE_CACHE_EXCEPTIONS
+        """
+        self.content = content
+        self.fresh_until = fresh_until
+        self.etag = etag
+        self.last_modified = last_modified
+        self.exception = exception
+
+    @property
+    def fresh(self):
+        return self.fresh_until is None or time() < self.fresh_until
+
+    def stale_for(self, seconds):
+        """
+        True if the content went stale no more than seconds ago
+        :param seconds:
+        :return:
+        """
+        return self.fresh_until is not None and time() < self.fresh_until + seconds
+
+    @property
+    def validators(self):
+        """
+        The headers making a request conditional on the content having changed
+        :return:
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class CacheStats(object):
+    """
+    Count cache events: 'hit', 'miss', 'stale' (stale content served), 'revalidate' (stale content refreshed),
+    'revalidate_failed', 'conditional' (a request made with the validators of stale content) and 'not_modified' (stale
+    content confirmed unchanged by a 304) and 'negative_hit' (a cached failure raised). Listeners are called with the
+    event and the storage key.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counts = {}
+        self.listeners = []
+
+    def __getitem__(self, event):
+        return self.counts.get(event, 0)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def record(self, event, storage_key=None):
+        with self._lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+
+        for listener in self.listeners:
+            listener(event, storage_key)
+
+
+cache_stats = CacheStats()
+
+
+class TransferStats(object):
+    """
+    Count the response bytes received per endpoint (the url path), both as sent over the wire and once decompressed
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, compressed, decompressed):
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {'responses': 0, 'compressed_bytes': 0,
+                                                         'decompressed_bytes': 0})
+            stats['responses'] += 1
+            stats['compressed_bytes'] += compressed
+            stats['decompressed_bytes'] += decompressed
+
+    def savings(self, endpoint=None):
+        """
+        The fraction of bytes saved by compression
+        :param endpoint: Only count this endpoint
+        :return:
+        """
+        with self._lock:
+            stats = [v for k, v in self.endpoints.items() if endpoint in (None, k)]
+            compressed = sum(v['compressed_bytes'] for v in stats)
+            decompressed = sum(v['decompressed_bytes'] for v in stats)
+
+        return 1 - float(compressed) / decompressed if decompressed else 0.0
+
+
+transfer_stats = TransferStats()
+
 
 class ResourceRequest(object):
 
-    def __init__(self, api_url, api_version, async=False, timeout=60, request_handler=None, storage=None,
-                 cache_timeout=60, content_type='Application/json; charset=utf-8'):
+    # Set by AuthenticatedResourceRequest. Requests are rate limited per access token.
+    access_token = None
+
+    # Where cache hits, misses and stale results are counted
+    cache_stats = cache_stats
+
+    # Stale results with an ETag or Last-Modified date are kept to revalidate for this many times their cache_timeout
+    validator_retention = 3
+
+    def __init__(self, api_url, api_version, run_async=False, timeout=60, request_handler=None, storage=None,
+                 cache_timeout=None, content_type='Application/json; charset=utf-8', schema=None, use_cache=True,
+                 cursor_response=False, retry_policy=None, rate_limiter=None, max_stale=None, cache_policies=None,
+                 negative_cache_timeout=None, stream=False, record_class=None, **kwargs):
         """
 
         :param api_url:
         :param api_version:
-        :param async:
+        :param run_async: If True request() returns this object with a future to resolve. The legacy keyword "async"
+        is still accepted.
         :param timeout:
         :param request_handler:
         :param storage:
-        :param cache_timeout:
+        :param cache_timeout: The number of seconds results are cached for. Defaults to the timeout of the cache
+        policy or DEFAULT_CACHE_TIMEOUT
         :param content_type:
+        :param schema: Coerce only these fields of the json response. A dict of field name to 'datetime', 'float',
+        'int' or a function. If not provided every string which looks like a datetime or float is converted.
+        :param use_cache: If False results are neither read from nor written to storage
+        :param cursor_response: If True return a CursorResponse holding the content and the cursor headers
+        :param retry_policy: Overrides the request handler's RetryPolicy for this request
+        :param rate_limiter: A RateLimiter to wait on before the request is sent
+        :param max_stale: Serve a cached result for up to this many seconds after cache_timeout while a single
+        background request refreshes it. Defaults to the max_stale of the cache policy or 0
+        :param cache_policies: The CachePolicies deciding how results are cached and which results writes invalidate
+        :param negative_cache_timeout: If set NotFound and UnprocessableEntityError are cached for this many seconds
+        and raised again for the same request
+        :param stream: If True the result is a generator of the elements of the json array returned, parsed as they
+        are received so memory use does not grow with the size of the response. Streamed results are not cached or
+        coalesced.
+        :param record_class: A Record class (e.g. records.Cdr) each json object of the result is converted to, in
+        place of the coerced dicts. Its fields are left as received and coerced when they are accessed.
         :param wait_time_interval: The number of seconds before checking for the key again
         :param max_wait_time: The maximum number of seconds to wait between requests
         """
+        if 'async' in kwargs:
+            run_async = kwargs.pop('async')
+
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+
         self.api_url = api_url
         self.api_version = api_version
         self._request_handler = None
-        self.request_handler = request_handler or RequestHandler()
-        self.async = async
+        self.request_handler = request_handler or self.default_request_handler()
+        self.run_async = run_async
         self.timeout = timeout
         self.result = None
         self.future = None
+        self.flight = None
+        self.lease_key = None
+        self.lease_token = None
         self.storage_key = None
         self.storage = storage
         self.cache_timeout = cache_timeout
         self.content_type = content_type
+        self.schema = schema
+        self.use_cache = use_cache
+        self.cursor_response = cursor_response
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.max_stale = max_stale
+        self.cache_policies = cache_policies
+        self.negative_cache_timeout = negative_cache_timeout
+        self.stream = stream
+        self.record_class = record_class
+        self.cache_tags = []
+        self.invalidate_tags = []
+        self.stale_entry = None
+
+    @staticmethod
+    def default_request_handler():
+        return default_request_handler()
 
     @property
     def request_handler(self):
@@ -76,6 +542,10 @@ class ResourceRequest(object):
             headers['Accept'] = "application/vnd.integrate.v%s+json" % self.api_version
 
     def resolve(self, get_content=True):
+        if self.flight is not None and (get_content or self.future is None):
+            # Coalesced requests resolve to the content parsed by the leader
+            return self.flight.result()
+
         response = self.request_handler.resolve_future(self.future)
         if get_content:
             return self.parse_result(response)
@@ -88,20 +558,91 @@ class ResourceRequest(object):
         :param callback:
         :return:
         """
-        content, _ = self.get_content(response)
+        if self.stream:
+            return self.stream_content(response)
+
+        if self.stale_entry is not None and self.request_handler.get_status_code(response) == 304:
+            # The stale content is unchanged
+            self.cache_stats.record('not_modified', self.storage_key)
+            content = self.stale_entry.content
+            self.write_cache(content, response.headers.get('ETag') or self.stale_entry.etag,
+                             response.headers.get('Last-Modified') or self.stale_entry.last_modified)
+        else:
+            try:
+                content, headers = self.get_content(response)
+            except NEGATIVE_CACHE_EXCEPTIONS as e:
+                self.write_negative_cache(e)
+                raise
+
+            if self.cursor_response:
+                content = CursorResponse(content, headers)
 
-        if self.storage and self.storage_key:
-            self.storage.set(self.storage_key, content, self.cache_timeout)
+            self.write_cache(content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
 
         if callback:
             callback(content)
         return content
 
+    def request_options(self):
+        """
+        The keyword arguments passed on to the request handler
+        :return:
+        """
+        options = {}
+        if self.retry_policy is not None:
+            options['retry_policy'] = self.retry_policy
+        if self.stream:
+            options['stream'] = True
+        return options
+
+    @property
+    def content_schema(self):
+        """
+        The schema the content is decoded with. Records coerce their own fields, so their content is not coerced.
+        :return:
+        """
+        if self.schema is None and self.record_class is not None:
+            return {}
+        return self.schema
+
     def get_content(self, response):
-        return self.request_handler.get_content(response)
+        schema = self.content_schema
+        if schema is not None:
+            content, headers = self.request_handler.get_content(response, schema=schema)
+        else:
+            content, headers = self.request_handler.get_content(response)
+
+        if self.record_class is not None:
+            content = self.to_records(content)
+        return content, headers
+
+    def stream_content(self, response):
+        schema = self.content_schema
+        if schema is not None:
+            content = self.request_handler.stream_content(response, schema=schema)
+        else:
+            content = self.request_handler.stream_content(response)
+
+        if self.record_class is not None:
+            content = self.iter_records(content)
+        return content
+
+    def to_records(self, content):
+        """
+        Convert a json object, or a list of them, to record_class
+        :param content:
+        :return:
+        """
+        if isinstance(content, list):
+            return [self.record_class.from_dict(value) for value in content]
+        return self.record_class.from_dict(content)
+
+    def iter_records(self, content):
+        for value in content:
+            yield self.record_class.from_dict(value)
 
     def request(self, method, path=None, headers=None, params=None, data=None, files=None,
-                _limit_concurrent_requests=False, _limit_concurrent_wait_time_interval=5,
+                _limit_concurrent_requests=False, _limit_concurrent_wait_time_interval=0.25,
                 _limit_concurrent_max_wait_time=20, _use_cached_results=True):
         """
         Make a request
@@ -111,9 +652,13 @@ class ResourceRequest(object):
         :param params:
         :param data:
         :param files:
-        :param _limit_concurrent_requests:
-        :param _limit_concurrent_wait_time_interval:
-        :param _limit_concurrent_max_wait_time:
+        :param _limit_concurrent_requests: If True identical requests made while this one is in flight wait for and
+        share its result instead of making their own request. When storage is used a lease is held in storage so other
+        processes sharing it wait for the stored result as well.
+        :param _limit_concurrent_wait_time_interval: The number of seconds between checks of a lease held by another
+        process
+        :param _limit_concurrent_max_wait_time: The maximum number of seconds to wait for an in flight request before
+        making the request independently
         :param _use_cached_results: If True will use cached results if they exist
 
         :return:
@@ -133,47 +678,379 @@ class ResourceRequest(object):
             filter(None, data)
 
         self.storage_key = None
-        limit_concurrent_requests_storage_key = None
+        self.flight = None
+
+        url = '%s/%s' % (self.api_url, path) if path else self.api_url
+        params = self.normalize_params(path, params)
 
         if self.storage:
-            self.storage_key = self.create_storage_key(path, params, data) if _use_cached_results else None
+            cacheable = self.apply_cache_policy(method, path, params) and _use_cached_results and self.use_cache and \
+                not self.stream and self.result_keyable
+            self.storage_key = self.create_cache_key(path, params, data) if cacheable else None
 
             # See if a cached result exists
-            cached_result = self.storage.get(self.storage_key) if self.storage_key else None
-            if cached_result:
+            cached_result = self.read_cache(partial(self.revalidate, method, url, params, data, files, headers))
+            if cached_result is not CACHE_MISS:
                 return cached_result
+            elif self.storage_key:
+                self.cache_stats.record('miss', self.storage_key)
+                self.add_validators(headers)
 
-            # Limit concurrent request rate
-            if _limit_concurrent_requests:
-                limit_concurrent_requests_storage_key = 'limit_concurrent_requests_%s' % self.create_storage_key(path, params, data)
-                wait_time = 0
+        flight_key = None
 
-                # Wait up until max_wait_time for the key to be removed. If the key isn't present or we reach the max
-                # wait time then move forward with the request
-                while self.storage.get(limit_concurrent_requests_storage_key) and wait_time <= _limit_concurrent_max_wait_time:
-                    sleep(_limit_concurrent_wait_time_interval)
-                    wait_time += _limit_concurrent_wait_time_interval
+        # Coalesce identical concurrent requests. Only the leader performs the request.
+        if _limit_concurrent_requests and not self.stream and self.result_keyable and \
+                method.upper() in CACHEABLE_METHODS:
+            flight_key = self.create_flight_key(method, path, params, data)
+            flight, leader = single_flight.join(flight_key)
 
-                # If we didn't reach teh max wait time then add a limiter
-                if wait_time <= _limit_concurrent_max_wait_time:
-                    self.storage.set(limit_concurrent_requests_storage_key, datetime.utcnow(), _limit_concurrent_max_wait_time)
+            if not leader:
+                if self.run_async:
+                    self.flight = flight
+                    return self
+
+                try:
+                    return flight.result(timeout=_limit_concurrent_max_wait_time)
+                except FuturesTimeoutError:
+                    # The leader is taking too long, perform the request independently
+                    flight_key = None
+            else:
+                self.flight = flight
+
+                try:
+                    # The result may have been stored between the cache lookup and becoming the leader
+                    cached_result = self.read_cache()
+
+                    if self.storage and cached_result is CACHE_MISS:
+                        cached_result = self.acquire_lease('limit_concurrent_requests_%s' % flight_key,
+                                                           _limit_concurrent_wait_time_interval,
+                                                           _limit_concurrent_max_wait_time)
+                except BaseException as e:
+                    self.release_lease()
+                    single_flight.complete(flight_key, flight, exception=e)
+                    raise
+
+                if cached_result is not CACHE_MISS:
+                    single_flight.complete(flight_key, flight, result=cached_result)
+                    return cached_result
+
+        # Writes are always sent and never share a result, but identical writes, e.g. token grants, wait for each
+        # other's lease across every process sharing the storage
+        elif _limit_concurrent_requests and self.storage:
+            self.acquire_lease('limit_concurrent_requests_%s' % self.create_flight_key(method, path, params, data),
+                               _limit_concurrent_wait_time_interval, _limit_concurrent_max_wait_time)
 
         try:
 
-            url = '%s/%s' % (self.api_url, path) if path else self.api_url
-            if self.async:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(path, self.access_token)
+
+            if self.run_async:
                 # Return a Future Object
-                self.future = self.request_handler.request_async(method, url, params, data, files, headers, self.timeout)
+                self.future = self.request_handler.request_async(method, url, params, data, files, headers, self.timeout,
+                                                                 **self.request_options())
+                self.future.add_done_callback(self.invalidate_cache)
+                if flight_key:
+                    self.future.add_done_callback(partial(self.complete_flight, flight_key, self.flight))
+                elif self.lease_token:
+                    self.future.add_done_callback(lambda future: self.release_lease())
                 return self
             else:
-                response = self.request_handler.request(method, url, params, data, files, headers, self.timeout)
-                return self.parse_result(response)
+                response = self.request_handler.request(method, url, params, data, files, headers, self.timeout,
+                                                        **self.request_options())
+                self.invalidate_cache()
+                result = self.parse_result(response)
+
+        except BaseException as e:
+            # Failures, and cancellation, are passed on so no follower waits on the flight forever
+            self.release_lease()
+            if flight_key:
+                single_flight.complete(flight_key, self.flight, exception=e)
+            raise
+
+        self.release_lease()
+        if flight_key:
+            single_flight.complete(flight_key, self.flight, result=result)
+        return result
+
+    def complete_flight(self, flight_key, flight, future):
+        """
+        Parse the result of a leader's future and pass it to the coalesced requests waiting on the flight
+        :param flight_key:
+        :param flight:
+        :param future:
+        :return:
+        """
+        try:
+            result = self.parse_result(future.result())
+        except BaseException as e:
+            self.release_lease()
+            single_flight.complete(flight_key, flight, exception=e)
+        else:
+            self.release_lease()
+            single_flight.complete(flight_key, flight, result=result)
+
+    def acquire_lease(self, lease_key, wait_time_interval, max_wait_time):
+        """
+        Acquire the storage lease for this request. While another process holds the lease wait for the result it will
+        store. If the lease can't be acquired within max_wait_time move forward without it.
+        :param lease_key:
+        :param wait_time_interval:
+        :param max_wait_time:
+        :return: The cached result stored by the lease holder, if found while waiting, otherwise CACHE_MISS
+        """
+        wait_time = 0
+
+        while True:
+            self.lease_token = self.storage.acquire_lease(lease_key, max_wait_time)
 
+            if self.lease_token:
+                self.lease_key = lease_key
+                return CACHE_MISS
+
+            if wait_time >= max_wait_time:
+                return CACHE_MISS
+
+            sleep(wait_time_interval)
+            wait_time += wait_time_interval
+
+            cached_result = self.read_cache()
+            if cached_result is not CACHE_MISS:
+                return cached_result
+
+    def normalize_params(self, path, params):
+        """
+        Normalize the range params of a report as its cache policy requires, see CachePolicy.normalize
+        :param path:
+        :param params:
+        :return: The params to send
+        """
+        policy = self.cache_policies.match(path)[0] if self.cache_policies else None
+        return policy.normalize(params) if policy is not None else params
+
+    def apply_cache_policy(self, method, path, params=None):
+        """
+        Apply the cache policy for the path. Sets the cache timeout and max_stale unless they were provided, and the
+        tags of the result or, for a write, the tags it invalidates. Results for a closed range are cached for the
+        policy's historical_timeout.
+        :param method:
+        :param path:
+        :param params:
+        :return: True if the result may be cached
+        """
+        policy, tags = self.cache_policies.match(path) if self.cache_policies else (None, [])
+
+        if self.cache_timeout is None and policy is not None and policy.closed(params):
+            self.cache_timeout = policy.historical_timeout
+        elif self.cache_timeout is None:
+            self.cache_timeout = DEFAULT_CACHE_TIMEOUT if policy is None or policy.timeout is None else policy.timeout
+
+        if self.max_stale is None:
+            self.max_stale = 0 if policy is None or policy.max_stale is None else policy.max_stale
+
+        if method.upper() not in CACHEABLE_METHODS:
+            self.invalidate_tags = tags
+            return False
+
+        self.cache_tags = tags
+        return policy is None or policy.cacheable
+
+    def create_cache_key(self, path, params, data):
+        """
+        Create the storage key for the result. The key of a tagged result includes the current versions of its tags.
+        :param path:
+        :param params:
+        :param data:
+        :return:
+        """
+        storage_key = self.create_result_key(path, params, data)
+
+        if self.cache_tags:
+            storage_key = '%s_%s' % (storage_key, self.cache_policies.tag_versions(self.storage, self.cache_tags))
+        return storage_key
+
+    def create_result_key(self, path, params, data):
+        """
+        Create the key of the result of a request. Requests for records, decoded with a schema or returning a
+        CursorResponse are kept apart from requests for dicts.
+        :param path:
+        :param params:
+        :param data:
+        :return:
+        """
+        storage_key = self.create_storage_key(path, params, data)
+
+        if self.record_class is not None:
+            storage_key = '%s_%s' % (storage_key, self.record_class.__name__)
+        if self.schema is not None:
+            storage_key = '%s_schema_%s' % (storage_key, schema_key(self.schema))
+        if self.cursor_response:
+            storage_key = '%s_cursor' % storage_key
+        return storage_key
+
+    @property
+    def result_keyable(self):
+        """
+        False if the content is decoded with a schema function which has no stable name, e.g. a lambda. Such results are
+        neither cached nor shared with coalesced requests.
+        :return:
+        """
+        return self.schema is None or schema_key(self.schema) is not None
+
+    def create_flight_key(self, method, path, params, data):
+        """
+        Create the key identical requests are coalesced on
+        :param method:
+        :param path:
+        :param params:
+        :param data:
+        :return:
+        """
+        return '%s_%s' % (method.upper(), self.create_result_key(path, params, data))
+
+    def invalidate_cache(self, future=None):
+        """
+        Invalidate the cached results with the tags of a write. Called once the write has been performed.
+        :param future:
+        :return:
+        """
+        if self.storage and self.invalidate_tags:
+            self.cache_policies.invalidate(self.storage, self.invalidate_tags)
+
+    def read_cache(self, revalidate=None):
+        """
+        Get the cached result for this request. A result which went stale less than max_stale seconds ago is only
+        returned if revalidate is provided, which is called to refresh it.
+        :param revalidate:
+        :return: The cached content, which may be empty, or CACHE_MISS
+        """
+        entry = self.storage.get(self.storage_key) if self.storage and self.storage_key else None
+
+        if entry is None:
+            return CACHE_MISS
+
+        if not isinstance(entry, CacheEntry):
+            # Stored directly in storage
+            return entry
+
+        if entry.exception is not None:
+            if not entry.fresh:
+                return CACHE_MISS
+            self.cache_stats.record('negative_hit', self.storage_key)
+            # Raise a copy so concurrent requests don't share a traceback
+            raise copy.copy(entry.exception)
+
+        if entry.fresh:
+            self.cache_stats.record('hit', self.storage_key)
+            return entry.content
+
+        self.stale_entry = entry
+
+        if revalidate is None or not entry.stale_for(self.max_stale):
+            return CACHE_MISS
+
+        self.cache_stats.record('stale', self.storage_key)
+        revalidate()
+        return entry.content
+
+    def write_cache(self, content, etag=None, last_modified=None):
+        """
+        Store the result of this request for cache_timeout seconds, plus max_stale seconds in which it may be served
+        stale. Results with an ETag or Last-Modified date are kept for validator_retention times cache_timeout seconds
+        to be revalidated.
+        :param content:
+        :param etag:
+        :param last_modified:
+        :return:
+        """
+        if not self.storage or not self.storage_key:
+            return
+
+        fresh_until = None
+        timeout = self.cache_timeout
+        if self.cache_timeout is not None:
+            fresh_until = time() + self.cache_timeout
+            validator_timeout = self.validator_retention * self.cache_timeout if etag or last_modified else 0
+            timeout += max(self.max_stale, validator_timeout)
+
+        self.storage.set(self.storage_key, CacheEntry(content, fresh_until, etag, last_modified), timeout)
+
+    def write_negative_cache(self, exception):
+        """
+        Store a failure of this request for negative_cache_timeout seconds
+        :param exception:
+        :return:
+        """
+        if not self.storage or not self.storage_key or not self.negative_cache_timeout:
+            return
+
+        self.storage.set(self.storage_key,
+                         CacheEntry(None, time() + self.negative_cache_timeout, exception=exception),
+                         self.negative_cache_timeout)
+
+    def add_validators(self, headers):
+        """
+        Make the request conditional on the stale cached result having changed, if it has validators
+        :param headers:
+        :return:
+        """
+        if self.stale_entry is not None and self.stale_entry.validators:
+            headers.update(self.stale_entry.validators)
+            self.cache_stats.record('conditional', self.storage_key)
+
+    def revalidate(self, method, url, params, data, files, headers):
+        """
+        Refresh a stale cached result in the background. Only one refresh per storage key is made at a time, across
+        every process sharing the storage.
+        :return:
+        """
+        lease_key = 'revalidate_%s' % self.storage_key
+        lease_token = self.storage.acquire_lease(lease_key, self.timeout or 60)
+        if not lease_token:
+            return
+
+        self.add_validators(headers)
+
+        try:
+            future = self.request_handler.request_async(method, url, params, data, files, headers, self.timeout,
+                                                        **self.request_options())
+        except Exception:
+            self.storage.release_lease(lease_key, lease_token)
+            raise
+
+        future.add_done_callback(partial(self.revalidated, lease_key, lease_token))
+
+    def revalidated(self, lease_key, lease_token, future):
+        """
+        Store the result of a background refresh
+        :param lease_key:
+        :param lease_token:
+        :param future:
+        :return:
+        """
+        try:
+            if future.cancelled():
+                # The event loop closed before the refresh finished
+                self.cache_stats.record('revalidate_failed', self.storage_key)
+                return
+
+            self.parse_result(future.result())
+            self.cache_stats.record('revalidate', self.storage_key)
+        except Exception as e:
+            _logger.warning('Failed to refresh a stale result: %s', e)
+            self.cache_stats.record('revalidate_failed', self.storage_key)
         finally:
+            self.storage.release_lease(lease_key, lease_token)
 
-            # If storage is used then remove the current requests storage key
-            if self.storage and limit_concurrent_requests_storage_key:
-                self.storage.delete(limit_concurrent_requests_storage_key)
+    def release_lease(self):
+        """
+        Release the storage lease held by this request, if any
+        :return:
+        """
+        if self.lease_token:
+            self.storage.release_lease(self.lease_key, self.lease_token)
+            self.lease_key = None
+            self.lease_token = None
 
     def create_storage_key(self, path, params, data):
         """
@@ -183,14 +1060,21 @@ class ResourceRequest(object):
         :param data:
         :return:
         """
-        return self.storage.create_storage_key(access_token=None, api_version=self.api_version, path=path,
-                                               params=params, data=data)
+        return (self.storage or Storage).create_storage_key(access_token=None, api_version=self.api_version,
+                                                            path=path, params=params, data=data)
 
 
 class AuthenticatedResourceRequest(ResourceRequest):
 
-    def __init__(self, access_token, **kwargs):
+    def __init__(self, access_token, cache_scope=None, **kwargs):
+        """
+
+        :param access_token:
+        :param cache_scope: Key cached results on this value (e.g. a tenant id) instead of the access token
+        :param kwargs:
+        """
         self.access_token = access_token
+        self.cache_scope = cache_scope
         super(AuthenticatedResourceRequest, self).__init__(**kwargs)
 
     def prepare_request(self, headers, params):
@@ -211,13 +1095,117 @@ class AuthenticatedResourceRequest(ResourceRequest):
         :param data:
         :return:
         """
-        return self.storage.create_storage_key(access_token=self.access_token, api_version=self.api_version, path=path,
-                                               params=params, data=data)
+        kwargs = {'scope': self.cache_scope} if self.cache_scope is not None else {}
+        return (self.storage or Storage).create_storage_key(access_token=self.access_token,
+                                                            api_version=self.api_version, path=path, params=params,
+                                                            data=data, **kwargs)
+
+
+class RetryPolicy(object):
+    """
+    When and how long to wait before retrying a request which was rate limited or failed on the server. Only idempotent
+    methods are retried by default.
+    """
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30, jitter=True, budget=60,
+                 status_codes=(429, 500, 502, 503, 504), methods=('GET', 'HEAD', 'OPTIONS')):
+        """
+
+        :param max_retries: The maximum number of retries for a request
+        :param backoff_factor: The wait before the first retry, doubling for each further retry
+        :param max_backoff: The longest wait between retries, unless the server asks for longer with Retry-After
+        :param jitter: If True waits are randomized between half and the full backoff
+        :param budget: The maximum number of seconds spent on a request including its retries
+        :param status_codes: The status codes which are retried
+        :param methods: The methods which are retried
+        """
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.budget = budget
+        self.status_codes = frozenset(status_codes)
+        self.methods = frozenset(m.upper() for m in methods)
+
+    def allows(self, method):
+        """
+        True if requests with the method may be retried
+        :param method:
+        :return:
+        """
+        return self.max_retries > 0 and method.upper() in self.methods
+
+    @staticmethod
+    def retry_after(headers):
+        """
+        The number of seconds requested by a Retry-After header, if any
+        :param headers:
+        :return:
+        """
+        value = headers.get('Retry-After') if headers else None
+        if not value:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt):
+        """
+        The exponential backoff before retry number attempt (starting at 0)
+        :param attempt:
+        :return:
+        """
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return uniform(delay / 2, delay) if self.jitter else delay
+
+    def delay(self, method, status_code, headers, attempt, elapsed):
+        """
+        The number of seconds to wait before retrying, or None if the request should not be retried
+        :param method:
+        :param status_code:
+        :param headers:
+        :param attempt: The number of retries made so far
+        :param elapsed: The number of seconds spent on the request so far
+        :return:
+        """
+        if status_code not in self.status_codes or attempt >= self.max_retries or not self.allows(method):
+            return None
+
+        delay = self.retry_after(headers)
+        if delay is None:
+            delay = self.backoff(attempt)
+
+        if self.budget is not None and elapsed + delay > self.budget:
+            return None
+
+        return delay
 
 
 class RequestHandlerBase(object):
 
-    def get_content(self, response):
+    # The RetryPolicy applied to requests which are not given one
+    retry_policy = RetryPolicy()
+
+    # Where the bytes received per endpoint are counted
+    transfer_stats = transfer_stats
+
+    # Decode json with the standard library ('json') or orjson ('orjson')
+    json_backend = 'json'
+
+    # Coerce values with fixed format parsing in fast_json_parser instead of json_parser
+    fast_json = False
+
+    def get_content(self, response, schema=None):
+        raise NotImplementedError()
+
+    def stream_content(self, response, schema=None):
         raise NotImplementedError()
 
     def get_status_code(self, response):
@@ -248,7 +1236,7 @@ class RequestHandlerBase(object):
         """
         for k, v in value.items():
 
-            if isinstance(v, basestring) and re.match('\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:(?:\+|\-)\d{2}:\d{2})?', v):
+            if isinstance(v, basestring) and DATETIME_PATTERN.match(v):
 
                 try:
                     value[k] = parser.parse(v)
@@ -256,7 +1244,36 @@ class RequestHandlerBase(object):
                     logging.warning('Datetime format found but could not parse. Attribute: %s, Value: %s, error: %s', k, v, value_error)
 
             # Convert Float values
-            elif isinstance(v, basestring) and re.match('\d*\.\d*', v):
+            elif isinstance(v, basestring) and FLOAT_PATTERN.match(v):
+
+                try:
+                    value[k] = float(v)
+                except ValueError:
+                    pass
+
+        return value
+
+    def fast_json_parser(self, value):
+        """
+        Equivalent to json_parser, but cheap checks skip the patterns for most strings and datetimes in the API's fixed
+        format are parsed natively. Parsed datetimes use datetime.timezone rather than dateutil's tz classes.
+        :param value:
+        :return:
+        """
+        for k, v in value.items():
+
+            if not isinstance(v, basestring):
+                continue
+
+            if len(v) >= 19 and v[10] == 'T' and DATETIME_PATTERN.match(v):
+
+                try:
+                    value[k] = parse_datetime(v)
+                except ValueError as value_error:
+                    logging.warning('Datetime format found but could not parse. Attribute: %s, Value: %s, error: %s', k, v, value_error)
+
+            # Convert Float values
+            elif '.' in v and FLOAT_PATTERN.match(v):
 
                 try:
                     value[k] = float(v)
@@ -265,31 +1282,175 @@ class RequestHandlerBase(object):
 
         return value
 
+    @staticmethod
+    def schema_parser(schema):
+        """
+        Create an object_hook which only coerces the fields named in the schema. Every other value is left as decoded.
+
+        :param schema: A dict of field name to a coercion name in COERCIONS (e.g. 'datetime') or a function
+        :return:
+        """
+        coercions = [(field, COERCIONS.get(coercion, coercion)) for field, coercion in schema.items()]
+
+        def parse(value):
+            for field, coerce in coercions:
+                v = value.get(field)
+                if isinstance(v, basestring):
+                    try:
+                        value[field] = coerce(v)
+                    except ValueError:
+                        pass
+            return value
+
+        return parse
+
+    def object_hook(self, schema=None):
+        """
+        The parser applied to every json object decoded
+        :param schema: Optional field schema, see schema_parser
+        :return:
+        """
+        if schema is not None:
+            return self.schema_parser(schema)
+        elif self.fast_json:
+            return self.fast_json_parser
+        return self.json_parser
+
+    def decode_json(self, response, schema=None):
+        """
+        Decode the json body of the response using the configured backend and parser
+        :param response:
+        :param schema: Optional field schema, see schema_parser
+        :return:
+        """
+        object_hook = self.object_hook(schema)
+
+        if self.json_backend == 'orjson':
+            return apply_object_hook(orjson.loads(response.content), object_hook)
+        return response.json(object_hook=object_hook)
+
 
 class RequestHandler(RequestHandlerBase):
 
-    def __init__(self):
-        self.session = FuturesSession()
+    def __init__(self, max_workers=8, pool_connections=10, pool_maxsize=10, keep_alive=True, json_backend='json',
+                 fast_json=False, retry_policy=None):
+        """
 
-    def get_content(self, response):
+        :param max_workers: The number of threads used to perform requests
+        :param pool_connections: The number of host connection pools to cache
+        :param pool_maxsize: The maximum number of connections kept open per host
+        :param keep_alive: If False connections are closed after each request
+        :param json_backend: 'json' or 'orjson'. orjson must be installed
+        :param fast_json: If True use fast_json_parser to coerce values
+        :param retry_policy: The RetryPolicy for requests. Use RetryPolicy(max_retries=0) to disable retries
+        """
+        if json_backend == 'orjson' and orjson is None:
+            raise ImportError('orjson must be installed to use the orjson json_backend')
+
+        self.json_backend = json_backend
+        self.fast_json = fast_json
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+
+        self.http_session = session
+        self.session = FuturesSession(max_workers=max_workers, session=session)
+
+    def close(self):
+        """
+        Release the thread pool and any open connections
+        :return:
+        """
+        self.session.close()
+
+    def get_content(self, response, schema=None):
         """
         Extract the content and the response headers
 
         :param response:
+        :param schema: Optional field schema used to coerce json values, see schema_parser
         :return:
         """
+        self.record_transfer(response)
         self.validate_response(response)
         content_type = response.headers['content-type']
 
         if self.get_status_code(response) == 204:
             return None, response.headers
         elif 'application/json' in content_type:
-            return response.json(object_hook=self.json_parser), response.headers
+            return self.decode_json(response, schema), response.headers
         elif 'text/plain' in content_type:
             return response.text, response.headers
         else:
             raise ContentTypeNotSupported('Content Type: %s is not supported' % content_type)
 
+    def stream_content(self, response, schema=None):
+        """
+        Validate a response requested with stream=True and parse its json array as it is received
+        :param response:
+        :param schema: Optional field schema used to coerce json values, see schema_parser
+        :return: A generator of the elements of the array
+        """
+        try:
+            self.validate_response(response)
+            if self.get_status_code(response) == 204:
+                response.close()
+                return iter(())
+
+            content_type = response.headers['content-type']
+            if 'application/json' not in content_type:
+                raise ContentTypeNotSupported('Content Type: %s is not supported' % content_type)
+        except Exception:
+            response.close()
+            raise
+
+        return self.iter_json(response, self.object_hook(schema))
+
+    def iter_json(self, response, object_hook):
+        decompressed = [0]
+
+        def chunks():
+            for chunk in response.iter_content(chunk_size=65536):
+                decompressed[0] += len(chunk)
+                yield chunk
+
+        try:
+            for element in iter_json_array(chunks(), object_hook):
+                yield element
+        finally:
+            response.close()
+            raw = getattr(response, 'raw', None)
+            compressed = raw.tell() if hasattr(raw, 'tell') else decompressed[0]
+            self.transfer_stats.record(urlparse(response.url).path, compressed, decompressed[0])
+
+    def transfer_sizes(self, response):
+        """
+        The size of the response body as received and once decompressed
+        :param response:
+        :return: A tuple of the compressed and decompressed sizes
+        """
+        decompressed = len(response.content or b'')
+        raw = getattr(response, 'raw', None)
+        # urllib3 counts the bytes read from the connection before decoding
+        compressed = raw.tell() if hasattr(raw, 'tell') else decompressed
+        return compressed, decompressed
+
+    def record_transfer(self, response):
+        """
+        Count the bytes received for the response's endpoint in transfer_stats
+        :param response:
+        :return:
+        """
+        compressed, decompressed = self.transfer_sizes(response)
+        self.transfer_stats.record(urlparse(response.url).path, compressed, decompressed)
+
     def get_status_code(self, response):
         """
         Get the status code from the response object
@@ -329,7 +1490,8 @@ class RequestHandler(RequestHandlerBase):
     def request(self, method, url, params=None, data=None, files=None, headers=None, timeout=None, **kwargs):
         return self.resolve_future(self.request_async(method, url, params, data, files, headers, timeout, **kwargs))
 
-    def request_async(self, method, url, params=None, data=None, files=None, headers=None, timeout=None, **kwargs):
+    def request_async(self, method, url, params=None, data=None, files=None, headers=None, timeout=None,
+                      retry_policy=None, **kwargs):
         """
         Perform an async request. Can pass background_callback to be called with the result if desired
 
@@ -340,10 +1502,42 @@ class RequestHandler(RequestHandlerBase):
         :param files:
         :param headers:
         :param timeout:
+        :param retry_policy: Overrides the handler's RetryPolicy for this request
+        :param kwargs:
+        :return:
+        """
+        retry_policy = retry_policy or self.retry_policy
+
+        if not retry_policy.allows(method):
+            return self.session.request(method, url, params=params, data=data, files=files, headers=headers, timeout=timeout, **kwargs)
+
+        return self.session.executor.submit(self.send, retry_policy, method, url, params=params, data=data, files=files,
+                                            headers=headers, timeout=timeout, **kwargs)
+
+    def send(self, retry_policy, method, url, **kwargs):
+        """
+        Perform the request in the current thread, retrying as permitted by the retry policy
+        :param retry_policy:
+        :param method:
+        :param url:
         :param kwargs:
         :return:
         """
-        return self.session.request(method, url, params=params, data=data, files=files, headers=headers, timeout=timeout, **kwargs)
+        start = monotonic()
+        attempt = 0
+
+        while True:
+            response = self.http_session.request(method, url, **kwargs)
+            delay = retry_policy.delay(method, self.get_status_code(response), response.headers, attempt,
+                                       monotonic() - start)
+            if delay is None:
+                return response
+
+            _logger.info('Retrying %s %s in %.2f seconds. Status Code: %s', method, url, delay,
+                         self.get_status_code(response))
+            response.close()
+            sleep(delay)
+            attempt += 1
 
     def resolve_future(self, future):
         """
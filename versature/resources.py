@@ -1,62 +1,52 @@
 # -*- coding: utf-8 -*-
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, partial
+from threading import RLock
+from time import sleep
 
 from .settings import CLIENT_ID, CLIENT_SECRET, VENDOR_ID, API_URL, API_VERSION
-from .request_handler import ResourceRequest, AuthenticatedResourceRequest
-from .exceptions import AuthenticationException
+from .token_store import TokenStore
+from .cache_policy import DEFAULT_CACHE_POLICIES
+from .request_handler import ResourceRequest, AuthenticatedResourceRequest, CursorResponse
+from .exceptions import AuthenticationException, BadRequest, ScopeException, NotFound
 
 __author__ = 'DavidWard'
 
 
 def obtain_access(func):
     """
-    If the is not found or if an access_token has expired and a refresh token is found then attempt to update the token
+    Make sure a current access token is available before calling func. A token which is about to expire is renewed
+    beforehand. If the request still fails authentication the token is renewed once and the request retried once.
+    Renewal is serialized so threads sharing a Versature perform a single renewal and reuse its token.
     :param func:
     :return:
     """
     @wraps(func)
     def retry_if_token_expired(self, *args, **kwargs):
-        try:
-            if self.user.access_token is None:
-                self.authenticate()
+        if self.is_async:
+            return self.obtain_access_async(func, *args, **kwargs)
+
+        access_token = self.obtain_token()
 
+        try:
             return func(self, *args, **kwargs)
         except AuthenticationException:
 
-            if self.user.refresh_token:
-
-                try:
-
-                    result = self.refresh_token_grant(self.user.refresh_token)
-                    self.user.expires = result['expires']
-                    self.user.access_token = result['access_token']
-                    return func(self, *args, **kwargs)
-
-                except AuthenticationException:
-
-                    # If we know the username and password then get a new set of tokens
-                    if self.user.username and self.user.password:
-                        result = self.password_grant(self.user.username, self.user.password)
-                        self.user.update_from_authentication_result(result)
-                        return func(self, *args, **kwargs)
-                    else:
-                        raise
-
-            elif self.client_id and self.client_secret:
-
-                result = self.client_credentials_grant()
-                self.user.access_token = result['access_token']
-                return func(self, *args, **kwargs)
-
-            else:
+            if not self.renew_token(stale_access_token=access_token):
                 raise
 
+            return func(self, *args, **kwargs)
+
     return retry_if_token_expired
 
 
 class User(object):
 
+    # A TokenStore the tokens are published to when they change
+    token_store = None
+
     def __init__(self, username=None, password=None, access_token=None, refresh_token=None,
                  expires=None, expires_in=None, scope=None):
         self.username = username
@@ -66,7 +56,7 @@ class User(object):
         self.scope = scope
         self.expires = expires
         if expires_in:
-            self.expires_in = datetime.utcnow() + timedelta(seconds=expires_in)
+            self.expires_in = expires_in
 
     @property
     def access_token(self):
@@ -92,30 +82,111 @@ class User(object):
         self.scope = result.get('scope', None)
         self.access_token = result.get('access_token', None)
 
+    def update_from_token_store(self, tokens):
+        """
+        Use tokens published to the token store by another process. They are not published again.
+        :param tokens:
+        :return:
+        """
+        self.refresh_token = tokens.get('refresh_token', None)
+        self.expires = tokens.get('expires', None)
+        self.scope = tokens.get('scope', None)
+        self._access_token = tokens.get('access_token', None)
+
     def token_change(self):
         """
-        Function called when the access token is updated. Override for custom functionality when the token chagnes
+        Function called when the access token is updated. Override for custom functionality when the token chagnes.
+        Publishes the tokens to the token store if there is one.
         :return:
         """
-        pass
+        if self.token_store is not None:
+            self.token_store.publish(self)
+
+
+class Batch(object):
+    """
+    Collect endpoint calls and perform them together with Versature.gather when the block exits. Calling an endpoint
+    on the batch returns the index of its result.
+
+        with v.batch(concurrency=8) as batch:
+            for extension in extensions:
+                batch.users(user=extension)
+        users = batch.results
+
+    With an AsyncVersature use "async with".
+    """
+
+    def __init__(self, versature, concurrency=8):
+        self.versature = versature
+        self.concurrency = concurrency
+        self.calls = []
+        self.results = None
+
+    def __getattr__(self, name):
+        method = getattr(self.versature, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(partial(method, *args, **kwargs))
+            return len(self.calls) - 1
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.versature.is_async:
+            raise TypeError('Use "async with" to batch the calls of an AsyncVersature')
+        if exc_type is None:
+            self.results = self.versature.gather(self.calls, concurrency=self.concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.results = await self.versature.gather(self.calls, concurrency=self.concurrency)
 
 
-class CursorResponse(object):
+class UserResults(dict):
     """
-    A cursor response object contains details about additional data which is available for this request.
+    The results of a call made for many users, keyed by user. Users whose call failed are in errors instead, mapped to
+    the exception raised.
     """
 
-    def __init__(self, data, headers):
-        self.data = data
-        self.more = headers.get('more', False)
-        self.cursor = headers.get('cursor', False)
+    def __init__(self, users, results):
+        super(UserResults, self).__init__()
+        self.errors = {}
+
+        for user, result in zip(users, results):
+            if isinstance(result, BaseException):
+                self.errors[user] = result
+            else:
+                self[user] = result
 
 
 class Versature(object):
 
+    is_async = False
+    resource_request_class = ResourceRequest
+    authenticated_resource_request_class = AuthenticatedResourceRequest
+
     def __init__(self, user=None, username=None, password=None, access_token=None, refresh_token=None,
                  expires=None, expires_in=None, api_url=API_URL, api_version=API_VERSION, client_id=CLIENT_ID,
-                 client_secret=CLIENT_SECRET, vendor_id=VENDOR_ID, request_handler=None, storage=None):
+                 client_secret=CLIENT_SECRET, vendor_id=VENDOR_ID, request_handler=None, storage=None,
+                 cache_scope=None, refresh_margin=60, token_storage=None, rate_limiter=None,
+                 cache_policies=DEFAULT_CACHE_POLICIES, negative_cache_timeout=None):
+        """
+
+        :param cache_scope: Key cached results on this value, e.g. the domain, instead of the access token so they
+        are shared by every token for it and survive token refreshes. Only set if results are not user specific.
+        :param refresh_margin: Renew the access token this many seconds before it expires
+        :param token_storage: A Storage shared between processes. Tokens are published to it and taken from it so
+        processes using the same credentials share one token and one grant at a time.
+        :param rate_limiter: A RateLimiter applied to every request
+        :param cache_policies: The CachePolicies for cached results, see versature.cache_policy
+        :param negative_cache_timeout: If set NotFound and UnprocessableEntityError responses are cached for this many
+        seconds, e.g. for lookups which are often repeated with the same bad input
+        """
         self.user = user
 
         if user is None:
@@ -129,6 +200,18 @@ class Versature(object):
         self.vendor_id = vendor_id
         self.request_handler = request_handler
         self.storage = storage
+        self.cache_scope = cache_scope
+        self.refresh_margin = refresh_margin
+        self.rate_limiter = rate_limiter
+        self.cache_policies = cache_policies
+        self.negative_cache_timeout = negative_cache_timeout
+        self.token_lock = RLock()
+        self.token_store = None
+
+        if token_storage is not None:
+            key = TokenStore.credential_key(api_url, client_id, self.user.username, vendor_id)
+            self.token_store = TokenStore(token_storage, key)
+            self.user.token_store = self.token_store
 
     def request_api_version(self, kwargs):
         """
@@ -156,9 +239,10 @@ class Versature(object):
         """
 
         api_version = self.request_api_version(kwargs)
-        return ResourceRequest(api_url=self.api_url, api_version=api_version, request_handler=self.request_handler,
-                               storage=self.storage,
-                               **kwargs)
+        return self.resource_request_class(api_url=self.api_url, api_version=api_version,
+                                           request_handler=self.request_handler, storage=self.storage,
+                                           rate_limiter=self.rate_limiter, cache_policies=self.cache_policies,
+                                           negative_cache_timeout=self.negative_cache_timeout, **kwargs)
 
     def authenticated_resource_request(self, **kwargs):
         """
@@ -167,12 +251,96 @@ class Versature(object):
         """
 
         api_version = self.request_api_version(kwargs)
-        return AuthenticatedResourceRequest(api_url=self.api_url,
-                                            api_version=api_version,
-                                            access_token=self.user.access_token,
-                                            request_handler=self.request_handler,
-                                            storage=self.storage,
-                                            **kwargs)
+        return self.authenticated_resource_request_class(api_url=self.api_url,
+                                                         api_version=api_version,
+                                                         access_token=self.user.access_token,
+                                                         request_handler=self.request_handler,
+                                                         storage=self.storage,
+                                                         cache_scope=self.cache_scope,
+                                                         rate_limiter=self.rate_limiter,
+                                                         cache_policies=self.cache_policies,
+                                                         negative_cache_timeout=self.negative_cache_timeout,
+                                                         **kwargs)
+
+    def batch(self, concurrency=8):
+        """
+        Collect endpoint calls to perform together. See Batch
+        :param concurrency: The maximum number of calls performed at once
+        :return: Batch
+        """
+        return Batch(self, concurrency)
+
+    def gather(self, calls, concurrency=8, return_exceptions=True):
+        """
+        Perform many endpoint calls at once. The calls are dispatched with run_async=True on the pooled request handler
+        and resolved in order. Every call shares the token, the cache and the request coalescing, and if the token has
+        expired it is renewed once for all of them and each rejected call is made once more.
+
+            users = v.gather([partial(v.users, user=extension) for extension in extensions])
+
+        :param calls: Functions calling one endpoint, which pass their keyword arguments on to the request, e.g.
+        partial(v.users, user=extension)
+        :param concurrency: The maximum number of calls performed at once
+        :param return_exceptions: If True a failed call's exception is returned in place of its result, otherwise the
+        first failure is raised
+        :return: The results in the order of calls
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+
+        access_token = self.obtain_token()
+
+        def dispatch(func):
+            try:
+                return func, func(run_async=True)
+            except Exception as e:
+                return func, e
+
+        def resolve(func, request):
+            try:
+                if isinstance(request, Exception):
+                    raise request
+                if not isinstance(request, ResourceRequest):
+                    # Served from the cache
+                    return request
+
+                try:
+                    return request.resolve()
+                except AuthenticationException:
+                    if not self.renew_token(stale_access_token=access_token):
+                        raise
+                    return func()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        results = []
+        pending = deque()
+        for func in calls:
+            if len(pending) >= concurrency:
+                results.append(resolve(*pending.popleft()))
+            pending.append(dispatch(func))
+
+        while pending:
+            results.append(resolve(*pending.popleft()))
+        return results
+
+    def fan_out(self, method, users, concurrency=8, **kwargs):
+        """
+        Call an endpoint once for each user with gather. Repeated users are called once. Cached results are returned
+        without a request and identical requests in flight are shared.
+
+        :param method: The endpoint taking a user keyword, e.g. self.devices
+        :param users:
+        :param concurrency: The maximum number of calls performed at once
+        :param kwargs: Passed to every call
+        :return: UserResults
+        """
+        users = list(OrderedDict.fromkeys(users))
+        results = self.gather([partial(method, user=user, **kwargs) for user in users], concurrency=concurrency)
+        return UserResults(users, results)
 
     #######################
     #### Authorization ####
@@ -194,6 +362,92 @@ class Versature(object):
             result = self.client_credentials_grant()
             self.user.update_from_authentication_result(result)
 
+    def can_renew_token(self):
+        """
+        True if a new access token can be obtained without outside help
+        :return:
+        """
+        return bool(self.user.refresh_token or (self.user.username and self.user.password) or
+                    (self.client_id and self.client_secret))
+
+    def token_expiring(self):
+        """
+        True if the access token expires within the refresh margin
+        :return:
+        """
+        expires = self.user.expires
+        return bool(expires and expires - timedelta(seconds=self.refresh_margin) <= datetime.utcnow())
+
+    def obtain_token(self):
+        """
+        Get the access token to use for a request. Authenticates if there is no token and renews a token which is about
+        to expire.
+        :return:
+        """
+        access_token = self.user.access_token
+
+        if access_token is None:
+            with self.token_lock:
+                if self.token_store is not None:
+                    self.token_store.renew(self.user, self.grant_token, refresh_margin=self.refresh_margin)
+                else:
+                    self.authenticate()
+
+        elif self.token_expiring() and self.can_renew_token():
+            try:
+                self.renew_token(stale_access_token=access_token)
+            except AuthenticationException:
+                # The current token may still be valid, let the request decide
+                pass
+
+        return self.user.access_token
+
+    def renew_token(self, stale_access_token=None):
+        """
+        Replace the access token, see grant_token. Renewal is serialized; if another thread (or, with a token store,
+        another process) has already replaced stale_access_token its token is used instead.
+
+        :param stale_access_token: The token being replaced
+        :return: True if a new token is available
+        """
+        with self.token_lock:
+            if stale_access_token is not None and self.user.access_token != stale_access_token:
+                return True
+
+            if self.token_store is not None:
+                return self.token_store.renew(self.user, self.grant_token, stale_access_token, self.refresh_margin)
+
+            return self.grant_token()
+
+    def grant_token(self):
+        """
+        Obtain a new access token. Uses the refresh token if present, falling back to the password grant and then to
+        the client credentials grant.
+        :return: True if a new token was obtained
+        """
+        with self.token_lock:
+            if self.user.refresh_token:
+                try:
+                    result = self.refresh_token_grant(self.user.refresh_token)
+                    if not result.get('refresh_token'):
+                        result = dict(result, refresh_token=self.user.refresh_token)
+                    self.user.update_from_authentication_result(result)
+                    return True
+                except AuthenticationException:
+                    # If we know the username and password then get a new set of tokens
+                    if not (self.user.username and self.user.password):
+                        raise
+
+            if self.user.username and self.user.password:
+                result = self.password_grant(self.user.username, self.user.password)
+            elif self.client_id and self.client_secret:
+                result = self.client_credentials_grant()
+            else:
+                return False
+
+            self.user.update_from_authentication_result(result)
+            return True
+
     def client_credentials_grant(self):
         """
         Get an Access Token with the provided confidential client id and secret. No refresh token will be available
@@ -281,6 +535,16 @@ class Versature(object):
 
         return self.authenticated_resource_request(**kwargs).request('GET', path=path, _limit_concurrent_requests=True)
 
+    def active_calls_many(self, users, concurrency=8, **kwargs):
+        """
+        Get the active calls for many users at once. See fan_out
+        :param users:
+        :param concurrency: The maximum number of requests at once
+        :param kwargs:
+        :return: UserResults of user to active calls
+        """
+        return self.fan_out(self.active_calls, users, concurrency, **kwargs)
+
     @obtain_access
     def place_call(self, fr, to, auto_answer=False, **kwargs):
         """
@@ -341,6 +605,7 @@ class Versature(object):
         :param user: The user whos calls should be collected. i.e. 101
         :param offset: Offset the result by this amount.
         :param limit: Max 200, the number of results to be returned
+        :param kwargs: Pass stream=True to get a generator parsing the records as they are received
         :return:
         """
 
@@ -358,6 +623,127 @@ class Versature(object):
 
         return self.authenticated_resource_request(**kwargs).request('GET', path=path, params=params, _limit_concurrent_requests=True)
 
+    def iter_cdrs(self, start_date=None, end_date=None, user=None, page_size=100, limit=None, **kwargs):
+        """
+        Iterate over the call records for a given time period one record at a time, following the cursor from page to
+        page. The next page is requested while the current one is consumed and pages are not cached, so memory use
+        stays constant however many records are returned.
+
+        :param start_date:
+        :param end_date:
+        :param user: The user whos calls should be collected. i.e. 101
+        :param page_size: The number of records requested per page
+        :param limit: The limit sent with each request. Not sent if None
+        :param kwargs:
+        :return: A generator of call records
+        """
+        def fetch(cursor, run_async):
+            return self.cdrs(start_date=start_date, end_date=end_date, user=user, offset=None, limit=limit,
+                             page_size=page_size, cursor=cursor, use_cache=False, cursor_response=True,
+                             run_async=run_async, **kwargs)
+
+        def resolve(request, cursor):
+            if isinstance(request, CursorResponse):
+                return request
+
+            try:
+                return request.resolve()
+            except AuthenticationException:
+                # Let obtain_access refresh the token and request the page again
+                return fetch(cursor, run_async=False)
+
+        cursor = None
+        request = fetch(cursor, run_async=True)
+
+        while request is not None:
+            page = resolve(request, cursor)
+
+            request = None
+            if page.more and page.cursor:
+                cursor = page.cursor
+                request = fetch(cursor, run_async=True)
+
+            for record in page.data or []:
+                yield record
+
+    def export_cdrs(self, start_date, end_date=None, user=None, window=timedelta(hours=6),
+                    min_window=timedelta(minutes=5), limit=200, max_workers=4, retries=3, retry_interval=1, **kwargs):
+        """
+        Export the call records for a large time period. The period is split into windows which are fetched
+        concurrently. A window which returns a full page (limit records) is split in half and fetched again, down to
+        min_window, below which it is paged with offset. A failed window is retried on its own while the others
+        continue. Records are yielded in time order, one window at a time.
+
+        :param start_date: The start of the period, inclusive
+        :param end_date: The end of the period, exclusive. Defaults to now
+        :param user: The user whos calls should be collected. i.e. 101
+        :param window: The initial size of each window
+        :param min_window: Windows this size or smaller are paged instead of split
+        :param limit: The number of records requested per window
+        :param max_workers: The maximum number of windows fetched at once
+        :param retries: The number of times a failed window is retried
+        :param retry_interval: The number of seconds before the first retry, doubling for each further retry
+        :param kwargs:
+        :return: A generator of call records
+        """
+        end_date = end_date or datetime.utcnow()
+
+        def fetch(window_start, window_end, offset):
+            for attempt in range(retries + 1):
+                try:
+                    return self.cdrs(start_date=window_start, end_date=window_end, user=user, offset=offset,
+                                     limit=limit, use_cache=False, **kwargs) or []
+                except (BadRequest, ScopeException, NotFound):
+                    raise
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    sleep(retry_interval * 2 ** attempt)
+
+        def fetch_window(window_start, window_end):
+            """
+            :return: The records for the window or None if it must be split
+            """
+            records = fetch(window_start, window_end, 0)
+
+            if len(records) < limit:
+                return records
+            elif window_end - window_start > min_window:
+                return None
+
+            while True:
+                page = fetch(window_start, window_end, len(records))
+                records.extend(page)
+                if len(page) < limit:
+                    return records
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        windows = deque()
+        try:
+            window_start = start_date
+            while window_start < end_date:
+                window_end = min(window_start + window, end_date)
+                windows.append((window_start, window_end, executor.submit(fetch_window, window_start, window_end)))
+                window_start = window_end
+
+            while windows:
+                window_start, window_end, future = windows.popleft()
+                records = future.result()
+
+                if records is None:
+                    # Too many records, replace the window with its two halves
+                    middle = window_start + (window_end - window_start) // 2
+                    windows.appendleft((middle, window_end, executor.submit(fetch_window, middle, window_end)))
+                    windows.appendleft((window_start, middle, executor.submit(fetch_window, window_start, middle)))
+                    continue
+
+                for record in records:
+                    yield record
+        finally:
+            for _, _, future in windows:
+                future.cancel()
+            executor.shutdown(wait=False)
+
     #####################
     #### Call Queues ####
     #####################
@@ -698,7 +1084,7 @@ class Versature(object):
                   'subscriber': subscriber,
                   'user': user}
 
-        return self.authenticated_resource_request(**kwargs).request('POST', path=path, params=params, _limit_concurrent_requests=True)
+        return self.authenticated_resource_request(**kwargs).request('POST', path=path, params=params)
 
     @obtain_access
     def read_subscription(self, subscription_id, **kwargs):
@@ -720,7 +1106,7 @@ class Versature(object):
         :return:
         """
         path = 'subscriptions/{subscriptions_id}'.format(subscriptions_id=subscription_id)
-        return self.authenticated_resource_request(**kwargs).request('DELETE', path=path, _limit_concurrent_requests=True)
+        return self.authenticated_resource_request(**kwargs).request('DELETE', path=path)
 
     #################
     #### Devices ####
@@ -744,6 +1130,16 @@ class Versature(object):
 
         return self.authenticated_resource_request(**kwargs).request('GET', path=path, _limit_concurrent_requests=True)
 
+    def devices_many(self, users, concurrency=8, **kwargs):
+        """
+        Get the devices for many users at once. See fan_out
+        :param users:
+        :param concurrency: The maximum number of requests at once
+        :param kwargs:
+        :return: UserResults of user to devices
+        """
+        return self.fan_out(self.devices, users, concurrency, **kwargs)
+
     @obtain_access
     def current_user_devices(self, **kwargs):
         """
@@ -775,6 +1171,16 @@ class Versature(object):
 
         return self.authenticated_resource_request(**kwargs).request('GET', path=path, _limit_concurrent_requests=True)
 
+    def voicemails_count_many(self, users, concurrency=8, **kwargs):
+        """
+        Count the voicemails of many users at once. See fan_out
+        :param users:
+        :param concurrency: The maximum number of requests at once
+        :param kwargs:
+        :return: UserResults of user to voicemail count
+        """
+        return self.fan_out(self.voicemails_count, users, concurrency, **kwargs)
+
 
     ####################
     #### Recordings ####
@@ -861,7 +1267,7 @@ class Versature(object):
         params = {'e164': e164,
                   'description': description}
 
-        return self.authenticated_resource_request(**kwargs).request('POST', params=params, path='caller_id_numbers/', _limit_concurrent_requests=True)
+        return self.authenticated_resource_request(**kwargs).request('POST', params=params, path='caller_id_numbers/')
 
     @obtain_access
     def update_caller_id_number(self, e164, description, **kwargs):
@@ -875,7 +1281,7 @@ class Versature(object):
         """
         path = 'caller_id_numbers/{e164}/'.format(e164=e164)
         params = {'description': description}
-        return self.authenticated_resource_request(**kwargs).request('PUT', params=params, path=path, _limit_concurrent_requests=True)
+        return self.authenticated_resource_request(**kwargs).request('PUT', params=params, path=path)
 
     @obtain_access
     def delete_caller_id_number(self, e164, **kwargs):
@@ -887,7 +1293,7 @@ class Versature(object):
         :return:
         """
         path = 'caller_id_numbers/{e164}/'.format(e164=e164)
-        return self.authenticated_resource_request(**kwargs).request('DELETE', path=path, _limit_concurrent_requests=True)
+        return self.authenticated_resource_request(**kwargs).request('DELETE', path=path)
 
 
 #############################
@@ -1,11 +1,56 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import json
-from datetime import datetime, timedelta, date
+import heapq
+import pickle
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import blake2b
+from datetime import datetime, date
+from threading import RLock, local
+from time import time, monotonic
+from uuid import uuid4
 
 __author__ = 'DavidWard'
 
 
+def pickled_size(value):
+    """
+    Approximate the memory used by a value with the size of its pickled form
+    """
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return sys.getsizeof(value)
+
+
+def token_fingerprint(access_token):
+    """
+    A short, stable fingerprint identifying an access token without exposing it
+    """
+    if not access_token:
+        return access_token
+    return blake2b(access_token.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def digest(value):
+    """
+    A stable digest of the canonical JSON encoding of a dict of request params or data. None values are dropped as they
+    are never sent.
+    """
+    if isinstance(value, dict):
+        value = dict((k, v) for k, v in value.items() if v is not None)
+
+    if not value:
+        return 0
+
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':'), default=json_serial)
+    return blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
 
@@ -20,23 +65,24 @@ class Storage(object):
     """
 
     @staticmethod
-    def create_storage_key(access_token, api_version, path, params, data):
+    def create_storage_key(access_token, api_version, path, params, data, scope=None):
         """
-        Generate a key for this type of request
+        Generate a key for this type of request. Keys are stable across processes and restarts so storage shared by
+        several processes is shared by their requests as well. The access token itself is never part of the key.
 
         :param access_token:
         :param api_version:
         :param path:
         :param params:
         :param data:
+        :param scope: Key on this value, e.g. a tenant id, instead of the access token. Keys then survive token
+        refreshes. Only use for data which is not specific to the authenticated user.
         :return:
         """
-        params_hash = hash(json.dumps(params, sort_keys=True, default=json_serial)) if params else 0
-        data_hash = hash(json.dumps(data, sort_keys=True, default=json_serial)) if data else 0
-        return '{access_token}_{api_version}_{name}_{param_hash}_{data_hash}'.format(access_token=access_token,
-                                                                                     api_version=api_version, name=path,
-                                                                                     param_hash=abs(params_hash),
-                                                                                     data_hash=abs(data_hash))
+        owner = scope if scope is not None else token_fingerprint(access_token)
+        return '{owner}_{api_version}_{name}_{param_hash}_{data_hash}'.format(owner=owner, api_version=api_version,
+                                                                              name=path, param_hash=digest(params),
+                                                                              data_hash=digest(data))
 
     def get(self, key):
         """
@@ -66,14 +112,100 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def add(self, key, value, timeout=None):
+        """
+        Add the key only if it is not already present. Backends shared between threads or processes must override
+        this to make the check and set atomic; this default is best effort.
+
+        :param key:
+        :param value:
+        :param timeout:
+        :return: True if the key was added
+        """
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, timeout)
+        return True
+
+    def cas(self, key, expected, value, timeout=None):
+        """
+        Compare and set. Replace the key's value only if it currently equals expected. A value of None deletes the
+        key. Backends shared between threads or processes must override this to make it atomic; this default is best
+        effort.
+
+        :param key:
+        :param expected:
+        :param value:
+        :param timeout:
+        :return: True if the value was replaced
+        """
+        if self.get(key) != expected:
+            return False
+
+        if value is None:
+            self.delete(key)
+        else:
+            self.set(key, value, timeout)
+        return True
+
+    def acquire_lease(self, key, timeout):
+        """
+        Acquire an exclusive lease on the key which expires after timeout seconds.
+
+        :param key:
+        :param timeout:
+        :return: The lease token or None if the lease is held elsewhere
+        """
+        token = uuid4().hex
+        return token if self.add(key, token, timeout) else None
+
+    def renew_lease(self, key, token, timeout):
+        """
+        Extend a held lease for another timeout seconds
+
+        :param key:
+        :param token:
+        :param timeout:
+        :return: True if the lease is still held
+        """
+        return self.cas(key, token, token, timeout)
+
+    def release_lease(self, key, token):
+        """
+        Release a held lease. A lease which has expired and been acquired by someone else is left untouched.
+
+        :param key:
+        :param token:
+        :return: True if the lease was released
+        """
+        return self.cas(key, token, None)
+
 
 class DictionaryStorage(Storage):
+    """
+    In memory storage shared by the threads of a process. Optionally bounded by the number of entries and/or their
+    approximate size in bytes, evicting the least recently used entries first. Expired entries are purged as new
+    entries are stored rather than only when the same key is read again.
+    """
 
     NO_TIMEOUT = 'No Timeout'
 
-    def __init__(self):
-        self.storage_dict = dict()
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        """
+
+        :param max_entries: The maximum number of entries to keep
+        :param max_bytes: The maximum total size of the stored values
+        :param sizeof: A function returning the size of a value in bytes. Defaults to the size of the pickled value
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or pickled_size
+        self.storage_dict = OrderedDict()
         self.expiry_dict = dict()
+        self.size_dict = dict()
+        self.expiry_heap = []
+        self.bytes = 0
+        self.lock = RLock()
 
     def get(self, key):
         """
@@ -81,35 +213,315 @@ class DictionaryStorage(Storage):
 
         :param str key: the key to get the counter value for
         """
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
         expires = self.expiry_dict.get(key, None)
         result = self.storage_dict.get(key, None)
 
-        if result and expires and (expires == self.NO_TIMEOUT or expires > datetime.utcnow()):
+        if result and expires and (expires == self.NO_TIMEOUT or expires > monotonic()):
+            self.storage_dict.move_to_end(key)
             return result
         else:
-            self.expiry_dict.pop(key, None)
-            self.storage_dict.pop(key, None)
+            self._delete(key)
 
     def set(self, key, value, timeout=None):
         """
-        Add the key to the dict storage for the timeout period. None means
+        Add the key to the dict storage for the timeout period. None means no timeout
         :param key:
         :param value:
         :param timeout:
         :return:
         """
+        with self.lock:
+            self._set(key, value, timeout)
+
+    def _set(self, key, value, timeout=None):
+        self._delete(key)
         self.storage_dict[key] = value
 
         if timeout:
-            self.expiry_dict[key] = datetime.utcnow() + timedelta(seconds=timeout)
+            expires = monotonic() + timeout
+            self.expiry_dict[key] = expires
+            heapq.heappush(self.expiry_heap, (expires, key))
         else:
             self.expiry_dict[key] = self.NO_TIMEOUT
 
+        if self.max_bytes is not None:
+            self.size_dict[key] = self.sizeof(value)
+            self.bytes += self.size_dict[key]
+
+        self.purge_expired()
+        self._evict()
+
+    def _delete(self, key):
+        self.expiry_dict.pop(key, None)
+        self.storage_dict.pop(key, None)
+        self.bytes -= self.size_dict.pop(key, 0)
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until storage is within its bounds
+        :return:
+        """
+        while self.storage_dict and ((self.max_entries is not None and len(self.storage_dict) > self.max_entries) or
+                                     (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            key, _ = self.storage_dict.popitem(last=False)
+            self.expiry_dict.pop(key, None)
+            self.bytes -= self.size_dict.pop(key, 0)
+
+    def purge_expired(self):
+        """
+        Remove every expired entry
+        :return:
+        """
+        with self.lock:
+            now = monotonic()
+
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                expires, key = heapq.heappop(self.expiry_heap)
+
+                # Skip heap entries left behind by keys which have since been replaced or deleted
+                if self.expiry_dict.get(key) == expires:
+                    self._delete(key)
+
+            # Rebuild the heap once replaced and deleted keys make up most of it
+            if len(self.expiry_heap) > 2 * len(self.storage_dict) + 64:
+                self.expiry_heap = [(expires, key) for key, expires in self.expiry_dict.items()
+                                    if expires != self.NO_TIMEOUT]
+                heapq.heapify(self.expiry_heap)
+
     def delete(self, key):
         """
         Remove the provided key from storage
         :param key:
         :return:
         """
-        self.expiry_dict.pop(key, None)
-        self.storage_dict.pop(key, None)
\ No newline at end of file
+        with self.lock:
+            self._delete(key)
+
+    def add(self, key, value, timeout=None):
+        """
+        Atomically add the key if it is not already present
+        :param key:
+        :param value:
+        :param timeout:
+        :return: True if the key was added
+        """
+        with self.lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def cas(self, key, expected, value, timeout=None):
+        """
+        Atomically replace the key's value if it currently equals expected. A value of None deletes the key.
+        :param key:
+        :param expected:
+        :param value:
+        :param timeout:
+        :return: True if the value was replaced
+        """
+        with self.lock:
+            if self._get(key) != expected:
+                return False
+
+            if value is None:
+                self._delete(key)
+            else:
+                self._set(key, value, timeout)
+            return True
+
+
+class SQLiteDatabase(object):
+    """
+    A SQLite database file in WAL mode, which several threads and processes can read while one of them writes.
+
+    Each thread uses its own connection and a process forked from this one opens new connections, as SQLite
+    connections must not be carried across a fork. Close the database before forking, or use it as a context manager,
+    so the child does not inherit the parent's open connections to the file:
+
+        with SQLiteStorage(path) as storage:
+            storage.add(key, value)
+    """
+
+    def __init__(self, path, busy_timeout=30):
+        """
+
+        :param path: The database file shared by the processes
+        :param busy_timeout: The number of seconds to wait for another process's write lock
+        """
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = local()
+        self.lock = RLock()
+        self.connections = []
+        self.pid = os.getpid()
+
+    @property
+    def connection(self):
+        if self.pid != os.getpid():
+            # Forked, the parent's connections belong to the parent
+            with self.lock:
+                self.local = local()
+                self.connections = []
+                self.pid = os.getpid()
+
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Connections are only used by their thread, but may be closed by close() from any thread
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def close(self):
+        """
+        Close the connections opened by this process. A later use opens a new connection.
+        :return:
+        """
+        if self.pid != os.getpid():
+            return
+
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.local = local()
+
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed statements in a transaction holding the database write lock
+        :return:
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        else:
+            cursor.execute('COMMIT')
+
+
+class SQLiteStorage(SQLiteDatabase, Storage):
+    """
+    Storage kept in a SQLite database file. Every process opening the same file shares the cache, and add, cas and the
+    leases built on them are atomic across those processes. Expired rows are purged as rows are stored, at most once
+    every purge_interval seconds, so the file does not grow with keys which are never read again.
+    """
+
+    def __init__(self, path, busy_timeout=30, purge_interval=60):
+        """
+
+        :param path: The database file shared by the processes
+        :param busy_timeout: The number of seconds to wait for another process's write lock
+        :param purge_interval: The minimum number of seconds between purges of the expired rows
+        """
+        super(SQLiteStorage, self).__init__(path, busy_timeout)
+        self.purge_interval = purge_interval
+        self.next_purge = monotonic() + purge_interval
+
+        with self.transaction() as cursor:
+            cursor.execute('CREATE TABLE IF NOT EXISTS storage (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS storage_expires ON storage (expires)')
+
+    @staticmethod
+    def _expires(timeout):
+        return time() + timeout if timeout else None
+
+    @staticmethod
+    def _select(cursor, key):
+        cursor.execute('SELECT value FROM storage WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time()))
+        row = cursor.fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def get(self, key):
+        """
+        Get the provided item from storage
+
+        :param str key: the key to get the counter value for
+        """
+        return self._select(self.connection.cursor(), key)
+
+    def set(self, key, value, timeout=None):
+        """
+        Add the key to storage for the timeout period. None means no timeout
+        :param key:
+        :param value:
+        :param timeout:
+        :return:
+        """
+        self.connection.execute('INSERT OR REPLACE INTO storage (key, value, expires) VALUES (?, ?, ?)',
+                                (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                                 self._expires(timeout)))
+
+        if monotonic() >= self.next_purge:
+            self.purge_expired()
+
+    def purge_expired(self):
+        """
+        Remove every expired row
+        :return:
+        """
+        self.next_purge = monotonic() + self.purge_interval
+        self.connection.execute('DELETE FROM storage WHERE expires <= ?', (time(),))
+
+    def delete(self, key):
+        """
+        Remove the provided key from storage
+        :param key:
+        :return:
+        """
+        self.connection.execute('DELETE FROM storage WHERE key = ?', (key,))
+
+    def add(self, key, value, timeout=None):
+        """
+        Atomically add the key if it is not already present
+        :param key:
+        :param value:
+        :param timeout:
+        :return: True if the key was added
+        """
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM storage WHERE key = ? AND expires <= ?', (key, time()))
+            cursor.execute('INSERT OR IGNORE INTO storage (key, value, expires) VALUES (?, ?, ?)',
+                           (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                            self._expires(timeout)))
+            return cursor.rowcount == 1
+
+    def cas(self, key, expected, value, timeout=None):
+        """
+        Atomically replace the key's value if it currently equals expected. A value of None deletes the key.
+        :param key:
+        :param expected:
+        :param value:
+        :param timeout:
+        :return: True if the value was replaced
+        """
+        with self.transaction() as cursor:
+            if self._select(cursor, key) != expected:
+                return False
+
+            if value is None:
+                cursor.execute('DELETE FROM storage WHERE key = ?', (key,))
+            else:
+                cursor.execute('INSERT OR REPLACE INTO storage (key, value, expires) VALUES (?, ?, ?)',
+                               (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                                self._expires(timeout)))
+            return True
\ No newline at end of file
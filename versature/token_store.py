@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+
+from .storage import digest
+
+__author__ = 'DavidWard'
+
+
+class TokenStore(object):
+    """
+    Share the tokens for one set of credentials between processes through a Storage backend. Tokens are published
+    whenever they change and a storage lease makes sure only one process performs a grant while the others wait for
+    its token.
+    """
+
+    def __init__(self, storage, key, lease_timeout=30, wait_time_interval=0.1):
+        """
+
+        :param storage: A Storage shared by the processes, e.g. SQLiteStorage
+        :param key: The storage key for the credentials, see credential_key
+        :param lease_timeout: The maximum number of seconds a grant may hold the lease
+        :param wait_time_interval: The number of seconds between checks for a token granted by another process
+        """
+        self.storage = storage
+        self.key = key
+        self.lease_key = '%s_lease' % key
+        self.lease_timeout = lease_timeout
+        self.wait_time_interval = wait_time_interval
+
+    @staticmethod
+    def credential_key(api_url, client_id, username=None, vendor_id=None):
+        """
+        Create the storage key for a set of credentials. The password and client secret are not part of the key.
+        :return:
+        """
+        return 'token_%s' % digest({'api_url': api_url, 'client_id': client_id, 'username': username,
+                                    'vendor_id': vendor_id})
+
+    def publish(self, user):
+        """
+        Store the user's tokens for the other processes
+        :param user:
+        :return:
+        """
+        if not user.access_token:
+            return
+
+        timeout = None
+        if user.expires:
+            timeout = (user.expires - datetime.utcnow()).total_seconds()
+            if timeout <= 0:
+                return
+
+        self.storage.set(self.key, {'access_token': user.access_token,
+                                    'refresh_token': user.refresh_token,
+                                    'expires': user.expires,
+                                    'scope': user.scope}, timeout)
+
+    def adopt(self, user, stale_access_token=None, refresh_margin=0):
+        """
+        Replace the user's tokens with the stored tokens if they are not stale_access_token and not about to expire
+        :param user:
+        :param stale_access_token:
+        :param refresh_margin:
+        :return: True if the stored tokens were adopted
+        """
+        tokens = self.storage.get(self.key)
+
+        if not tokens or not tokens.get('access_token') or tokens['access_token'] == stale_access_token:
+            return False
+
+        expires = tokens.get('expires')
+        if expires and expires - timedelta(seconds=refresh_margin) <= datetime.utcnow():
+            return False
+
+        if tokens['access_token'] != user.access_token:
+            user.update_from_token_store(tokens)
+        return True
+
+    def renew(self, user, grant, stale_access_token=None, refresh_margin=0):
+        """
+        Obtain a new token for the user. Adopt a token published by another process if there is one, otherwise hold the
+        lease and perform the grant. If the lease can't be acquired within lease_timeout perform the grant anyway.
+
+        :param user:
+        :param grant: Performs the grant and updates the user, returning True if a token was obtained
+        :param stale_access_token: The token being replaced
+        :param refresh_margin:
+        :return: True if a new token is available
+        """
+        deadline = monotonic() + self.lease_timeout
+
+        while True:
+            if self.adopt(user, stale_access_token, refresh_margin):
+                return True
+
+            lease_token = self.storage.acquire_lease(self.lease_key, self.lease_timeout)
+
+            if lease_token:
+                try:
+                    # Another process may have published between the check and the lease
+                    if self.adopt(user, stale_access_token, refresh_margin):
+                        return True
+                    return grant()
+                finally:
+                    self.storage.release_lease(self.lease_key, lease_token)
+
+            if monotonic() >= deadline:
+                return grant()
+
+            sleep(self.wait_time_interval)
+
+    async def renew_async(self, user, grant, stale_access_token=None, refresh_margin=0):
+        """
+        The asyncio equivalent of renew. grant is a coroutine function.
+        :return: True if a new token is available
+        """
+        deadline = monotonic() + self.lease_timeout
+
+        while True:
+            if self.adopt(user, stale_access_token, refresh_margin):
+                return True
+
+            lease_token = self.storage.acquire_lease(self.lease_key, self.lease_timeout)
+
+            if lease_token:
+                try:
+                    if self.adopt(user, stale_access_token, refresh_margin):
+                        return True
+                    return await grant()
+                finally:
+                    self.storage.release_lease(self.lease_key, lease_token)
+
+            if monotonic() >= deadline:
+                return await grant()
+
+            await asyncio.sleep(self.wait_time_interval)